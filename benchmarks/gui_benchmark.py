@@ -0,0 +1,102 @@
+"""
+Замер количества запросов к ДПМ на действия GUI.
+
+Для каждого способа загрузки нод (см. dpm.storage.LOADING_STRATEGIES)
+на случайных нодах повторяются действия пользователя: выбор ноды
+(загрузка модели и всех её полей) и построение графа зависимостей на
+разную глубину. Печатается среднее количество запросов и время на
+одно действие.
+
+ДПМ берётся из файла (--dpm) или генерируется так же, как в
+benchmarks.sync_benchmark.
+
+Запуск из корня проекта:
+    python -m benchmarks.gui_benchmark --tables 500
+    python -m benchmarks.gui_benchmark --dpm path/to/dpm.sqlite
+"""
+import os
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from dpm.models import Node
+from dpm.storage import NodeStorage, LOADING_STRATEGIES
+from dpm.graphsworks import DpmGraph
+from dpm.query_counter import QueryCounter
+from .sync_benchmark import run_once
+
+
+# действия: название и глубина графа (None - только выбор ноды)
+ACTIONS = [
+    ("выбор ноды", None),
+    ("граф 1/2", (1, 2)),
+    ("граф 3/3", (3, 3)),
+    ("граф 0/до конца", (0, float("inf"))),
+]
+
+
+def select_node(storage, node_id):
+    node = storage.get_node_by_id(node_id)
+    # панель свойств показывает все поля ноды, кроме отложенных (sql)
+    for attribute in node.__mapper__.column_attrs:
+        if not attribute.deferred:
+            getattr(node, attribute.key)
+    return node
+
+
+def measure(session, loading, node_ids):
+    """
+    Возвращает список (действие, запросов на действие, мс на действие).
+    """
+    results = []
+    for action, levels in ACTIONS:
+        with QueryCounter(session.bind) as counter:
+            started = time.perf_counter()
+            for node_id in node_ids:
+                # каждое действие - с холодным кэшем, как при первом клике
+                storage = NodeStorage(session, loading=loading)
+                node = select_node(storage, node_id)
+                if levels is not None:
+                    DpmGraph(storage, node).load_dependencies(*levels)
+                session.expunge_all()
+            elapsed = time.perf_counter() - started
+        results.append((action, counter.count / len(node_ids), elapsed * 1000 / len(node_ids)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер количества запросов на действия GUI")
+    parser.add_argument("--dpm", help="файл ДПМ; если не задан, ДПМ генерируется")
+    parser.add_argument("--tables", type=int, default=500, help="количество таблиц в сгенерированной базе")
+    parser.add_argument("--nodes", type=int, default=50, help="на скольких случайных нодах повторять действия")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = None
+    path = args.dpm
+    if path is None:
+        directory = tempfile.mkdtemp(prefix="dpm_gui_bench_")
+        run_once(directory, args.tables, 2, args.seed)
+        path = os.path.join(directory, "dpm.sqlite")
+    try:
+        session = sessionmaker(bind=create_engine(f"sqlite:///{path}"))()
+        random.seed(args.seed)
+        ids = [node_id for (node_id,) in session.query(Node.id)]
+        node_ids = random.sample(ids, min(args.nodes, len(ids)))
+        print(f"{'загрузка':>10} {'действие':>18} {'запросов':>9} {'мс':>8}")
+        for loading in LOADING_STRATEGIES:
+            for action, queries, milliseconds in measure(session, loading, node_ids):
+                print(f"{loading:>10} {action:>18} {queries:>9.1f} {milliseconds:>8.1f}")
+        session.close()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Планы и время частых запросов к ДПМ до и после индексов поиска.
+
+Запросы повторяют то, что делают синхронизация (поиск форм по пути,
+объектов базы, связей, отметок) и просмотр (ноды класса, поиск по имени,
+компоненты формы, триггеры таблицы, соседи ноды). Для копии ДПМ без
+индексов LOOKUP_INDEXES и SEARCH_NAME_INDEX (схема версии 1) и для неё
+же после миграций (dpm.migrations) печатаются план каждого запроса
+(EXPLAIN QUERY PLAN) и медианное время выполнения.
+
+ДПМ берётся из файла (--dpm) или генерируется так же, как в
+benchmarks.sync_benchmark; в сгенерированной ДПМ нет АРМов и форм,
+поэтому запросы к ним имеет смысл смотреть на настоящей ДПМ.
+
+Запуск из корня проекта:
+    python -m benchmarks.query_plans --tables 500
+    python -m benchmarks.query_plans --dpm path/to/dpm.sqlite --json plans.json
+"""
+import os
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+from sqlalchemy import create_engine, select, or_, text
+from sqlalchemy.orm import sessionmaker
+from dpm.models import Node, DatabaseObject, DBScript, DBTable, DBTrigger, Form, ClientQuery, Application, Edge, SyncCheckpoint
+from dpm.migrations import prepare_dpm, set_version, LOOKUP_INDEXES, SEARCH_NAME_INDEX
+from .sync_benchmark import run_once
+
+
+def pick_sample(session, seed):
+    """
+    Случайные значения параметров запросов из ДПМ.
+    """
+    random.seed(seed)
+
+    def one(query, default):
+        values = [value for (value,) in query]
+        return random.choice(values) if values else default
+
+    names = [name.lower() for (name,) in session.query(Node.name)]
+    node_ids = [node_id for (node_id,) in session.query(Node.id)]
+    return {
+        "database_id": one(session.query(DatabaseObject.database_id).distinct(), 0),
+        "object": one(session.query(DatabaseObject.database_object_id), 0),
+        "table_id": one(session.query(DBTable.id), 0),
+        "form_path": one(session.query(Form.path), ""),
+        "form_id": one(session.query(Form.id), 0),
+        "application_id": one(session.query(Application.id), 0),
+        "names": random.sample(names, min(20, len(names))),
+        "node_ids": random.sample(node_ids, min(20, len(node_ids))),
+    }
+
+
+def _form_nodes(session, sample):
+    condition = or_(Form.applications.any(id=sample["application_id"]), Form.path.in_([sample["form_path"]]))
+    return session.query(Form).filter(condition)
+
+
+def _database_edges(session, sample):
+    return session.query(Edge.sourse_id, Edge.dest_id, Edge.operations, Edge.is_verified, Edge.is_broken)\
+        .join(DatabaseObject, Edge.dest_id == DatabaseObject.id)\
+        .filter(DatabaseObject.database_id == sample["database_id"])
+
+
+# запросы: название, где выполняется, функция (сессия, параметры) -> запрос
+QUERIES = [
+    ("формы АРМа", "синхронизация", _form_nodes),
+    ("скрипты базы", "синхронизация", lambda session, sample: session.query(DBScript).filter(
+        DBScript.database_id == sample["database_id"])),
+    ("объект по object_id", "синхронизация", lambda session, sample: session.query(DatabaseObject.id).filter(
+        DatabaseObject.database_id == sample["database_id"],
+        DatabaseObject.database_object_id == sample["object"])),
+    ("связи базы", "синхронизация", _database_edges),
+    ("отметки синхронизации", "синхронизация", lambda session, sample: session.query(SyncCheckpoint).filter(
+        SyncCheckpoint.node_id == sample["database_id"], SyncCheckpoint.stage == "links")),
+    ("ноды класса", "просмотр", lambda session, sample: select([Node.__table__.c.id]).where(
+        Node.__table__.c.type == DBTable.__mapper__.polymorphic_identity)),
+    ("поиск по имени", "просмотр", lambda session, sample: select([Node.__table__.c.id]).where(
+        Node.__table__.c.search_name.in_(sample["names"]))),
+    ("компоненты формы", "просмотр", lambda session, sample: session.query(ClientQuery).filter(
+        ClientQuery.form_id == sample["form_id"])),
+    ("триггеры таблицы", "просмотр", lambda session, sample: session.query(DBTrigger).filter(
+        DBTrigger.table_id == sample["table_id"])),
+    ("потомки нод", "просмотр", lambda session, sample: Edge.select_outgoing(sample["node_ids"])),
+]
+
+
+def drop_lookup_indexes(engine):
+    """
+    Возвращает файл ДПМ к схеме версии 1 (без индексов LOOKUP_INDEXES
+    и SEARCH_NAME_INDEX; поле search_name остаётся, миграция его перезаполняет).
+    """
+    with engine.begin() as connection:
+        for name, _ in LOOKUP_INDEXES + [SEARCH_NAME_INDEX]:
+            connection.execute(f'DROP INDEX IF EXISTS "{name}"')
+        set_version(connection, 1)
+
+
+def measure(session, sample, repeats):
+    """
+    Возвращает словарь {название запроса: (план, мс на запрос)}.
+    """
+    results = {}
+    for name, _, build in QUERIES:
+        query = build(session, sample)
+        statement = getattr(query, "statement", query)
+        sql = str(statement.compile(dialect=session.bind.dialect, compile_kwargs={"literal_binds": True}))
+        plan = "; ".join(row[-1] for row in session.execute(text("EXPLAIN QUERY PLAN " + sql)))
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            session.execute(statement).fetchall()
+            timings.append(time.perf_counter() - started)
+        results[name] = (plan, statistics.median(timings) * 1000)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Планы и время частых запросов к ДПМ до и после индексов")
+    parser.add_argument("--dpm", help="файл ДПМ (не меняется, замеры идут на копии); если не задан, ДПМ генерируется")
+    parser.add_argument("--tables", type=int, default=500, help="количество таблиц в сгенерированной базе")
+    parser.add_argument("--repeats", type=int, default=20, help="сколько раз выполнять каждый запрос")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="сохранить планы и время в JSON-файл")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp(prefix="dpm_plans_bench_")
+    try:
+        path = os.path.join(directory, "dpm.sqlite")
+        if args.dpm is None:
+            run_once(directory, args.tables, 2, args.seed)
+        else:
+            shutil.copy(args.dpm, path)
+        engine = create_engine(f"sqlite:///{path}")
+        drop_lookup_indexes(engine)
+        session = sessionmaker(bind=engine)()
+        sample = pick_sample(session, args.seed)
+        before = measure(session, sample, args.repeats)
+        session.close()
+        prepare_dpm(engine)
+        session = sessionmaker(bind=engine)()
+        after = measure(session, sample, args.repeats)
+        session.close()
+        report = []
+        for name, place, _ in QUERIES:
+            print(f"{name} ({place})")
+            for title, (plan, milliseconds) in (("до", before[name]), ("после", after[name])):
+                print(f"    {title:>5}: {milliseconds:8.3f} мс  {plan}")
+            report.append({
+                "query": name,
+                "place": place,
+                "before": {"plan": before[name][0], "ms": before[name][1]},
+                "after": {"plan": after[name][0], "ms": after[name][1]},
+            })
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Замер масштабирования разбора кода (dpm.scanner.scan_scripts) по процессам.
+
+Генерируются и синхронизируются каталоги баз, как в
+benchmarks.sync_benchmark, после чего код всех скриптов разбирается
+на объекты всех баз с разным количеством процессов. Для каждого
+количества печатаются время разбора и ускорение относительно одного
+процесса. С --jobs разбор запускается одновременно в нескольких потоках
+с общим пулом процессов (ScanPool), как это делают анализы связей
+разных баз в планировщике синхронизации.
+
+Запуск из корня проекта:
+    python -m benchmarks.scan_benchmark --tables 2000 --processes 1 2 4 8
+    python -m benchmarks.scan_benchmark --tables 2000 --processes 4 --jobs 4
+"""
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm import undefer
+from dpm.connector import Connector
+from dpm.models import Database, DBScript, DBTable, DBTrigger
+from dpm.scanner import scan_scripts, target_from_object, script_from_node, ScanPool, PARALLEL_THRESHOLD
+from dpm.catalog_generator import generate_catalogs
+from sync.scan_db import scan_database
+from sync.scheduler import NEVER_UPDATED
+from .sync_benchmark import catalog_sizes
+
+
+def load_workload(directory, tables, databases, seed):
+    """
+    Генерирует и синхронизирует каталоги, возвращает (объекты, скрипты)
+    в виде ScanTarget и ScanScript.
+    """
+    db_names = [f"bench{number}" for number in range(1, databases + 1)]
+    generate_catalogs(directory, db_names, seed=seed, **catalog_sizes(tables))
+    connector = Connector(
+        host_dpm=f"sqlite:///{os.path.join(directory, 'dpm.sqlite')}",
+        offline=True,
+        catalog_snapshots=directory)
+    session = connector.connect_to_dpm()
+    for db_name in db_names:
+        base = Database(name=db_name, last_update=NEVER_UPDATED)
+        session.add(base)
+        session.flush()
+        with connector.connect_to(db_name) as conn:
+            scan_database(base, session, conn)
+        session.commit()
+    scripts = session.query(DBScript).options(undefer("sql")).all()
+    objects = [script for script in scripts if not isinstance(script, DBTrigger)] + session.query(DBTable).all()
+    workload = [target_from_object(obj) for obj in objects], [script_from_node(script) for script in scripts]
+    session.close()
+    return workload
+
+
+def measure(targets, scripts, processes, jobs):
+    """
+    Время, за которое jobs потоков с общим пулом из processes процессов
+    разбирают все скрипты (вместе с запуском процессов); возвращает
+    (секунды, количество найденных связей).
+    """
+    started = time.perf_counter()
+    with ScanPool(processes) as pool, ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(lambda _: scan_scripts(targets, scripts, pool), range(jobs)))
+    return time.perf_counter() - started, len(results[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер масштабирования разбора кода по процессам")
+    parser.add_argument("--tables", type=int, default=2000, help="количество таблиц в базе")
+    parser.add_argument("--databases", type=int, default=2, help="количество баз")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4], help="количество процессов")
+    parser.add_argument("--jobs", type=int, default=1, help="сколько разборов запускать одновременно")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp(prefix="dpm_scan_bench_")
+    try:
+        targets, scripts = load_workload(directory, args.tables, args.databases, args.seed)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    size = sum(len(script.sql) for script in scripts)
+    print(f"Объектов: {len(targets)}, скриптов: {len(scripts)}, кода: {size / 1024 / 1024:.1f} МБ, ядер: {os.cpu_count()}")
+    if size < PARALLEL_THRESHOLD:
+        print(f"Кода меньше {PARALLEL_THRESHOLD / 1024 / 1024:.0f} МБ, разбор идёт без пула процессов; увеличьте --tables")
+    print(f"{'процессов':>10} {'потоков':>8} {'время, с':>9} {'ускорение':>10} {'связей':>8}")
+    base = None
+    for processes in args.processes:
+        elapsed, found = measure(targets, scripts, processes, args.jobs)
+        base = base or elapsed
+        print(f"{processes:>10} {args.jobs:>8} {elapsed:>9.2f} {base / elapsed:>10.2f} {found:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Замер скорости синхронизации баз и анализа связей.
+
+Для каждого размера генерируются искусственные каталоги баз
+(см. dpm.catalog_generator), после чего они синхронизируются в пустую ДПМ
+и для них строятся связи. Печатается время каждого этапа и количество
+объектов, обрабатываемых за секунду.
+
+Запуск из корня проекта:
+    python -m benchmarks.sync_benchmark --sizes 100 500 2000
+"""
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from dpm.connector import Connector
+from dpm.models import Database, DatabaseObject, Edge
+from dpm.linking import analize_links
+from dpm.catalog_generator import generate_catalogs
+from sync.scan_db import scan_database
+from sync.scheduler import NEVER_UPDATED
+
+
+def catalog_sizes(tables):
+    """
+    Пропорции объектов в сгенерированной базе в зависимости
+    от количества таблиц.
+    """
+    return {
+        "tables": tables,
+        "procedures": tables * 2,
+        "views": tables // 2,
+        "triggers": tables // 2,
+        "table_functions": tables // 5,
+        "scalar_functions": tables // 5,
+    }
+
+
+def run_once(directory, tables, databases, seed):
+    """
+    Один замер: генерирует каталоги, синхронизирует их и строит связи.
+    Возвращает словарь с результатами.
+    """
+    db_names = [f"bench{number}" for number in range(1, databases + 1)]
+    started = time.perf_counter()
+    generate_catalogs(directory, db_names, seed=seed, **catalog_sizes(tables))
+    generated = time.perf_counter()
+
+    connector = Connector(
+        host_dpm=f"sqlite:///{os.path.join(directory, 'dpm.sqlite')}",
+        offline=True,
+        catalog_snapshots=directory)
+    session = connector.connect_to_dpm()
+    bases = []
+    for db_name in db_names:
+        base = Database(name=db_name, last_update=NEVER_UPDATED)
+        session.add(base)
+        bases.append(base)
+    session.commit()
+
+    for base in bases:
+        with connector.connect_to(base.name) as conn:
+            scan_database(base, session, conn)
+        session.commit()
+    scanned = time.perf_counter()
+
+    for base in bases:
+        with connector.connect_to(base.name) as conn:
+            analize_links(session, conn, database=base)
+        session.commit()
+    linked = time.perf_counter()
+
+    result = {
+        "tables": tables,
+        "objects": session.query(DatabaseObject).count(),
+        "edges": session.query(Edge).count(),
+        "generate": generated - started,
+        "scan": scanned - generated,
+        "links": linked - scanned,
+    }
+    session.close()
+    return result
+
+
+def print_results(results):
+    header = f"{'таблиц':>8} {'объектов':>9} {'связей':>8} {'генерация, с':>13} {'синхр., с':>10} {'объект/с':>9} {'связи, с':>9} {'объект/с':>9}"
+    print(header)
+    for r in results:
+        print(
+            f"{r['tables']:>8} {r['objects']:>9} {r['edges']:>8} {r['generate']:>13.2f} "
+            f"{r['scan']:>10.2f} {r['objects'] / r['scan']:>9.0f} "
+            f"{r['links']:>9.2f} {r['objects'] / r['links']:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер скорости синхронизации и анализа связей")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 500, 1000], help="количество таблиц в базе")
+    parser.add_argument("--databases", type=int, default=2, help="количество баз")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="не удалять сгенерированные файлы")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = []
+    for tables in args.sizes:
+        directory = tempfile.mkdtemp(prefix=f"dpm_bench_{tables}_")
+        try:
+            results.append(run_once(directory, tables, args.databases, args.seed))
+        finally:
+            if args.keep:
+                print(f"Файлы замера: {directory}")
+            else:
+                shutil.rmtree(directory, ignore_errors=True)
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+"""
+Снимок связей всей ДПМ в памяти.
+
+Для анализа и быстрого просмотра графа связи всех нод загружаются один раз
+в компактные массивы (модуль array). id нод заменяются плотными номерами;
+потомки и предки хранятся в формате CSR: соседи ноды с номером i лежат
+в targets[offsets[i]:offsets[i + 1]], маски действий - в параллельном
+массиве masks (CONTAIN - вложенность), классы нод - кодами в classes.
+Для каждого списка хранится и обратный индекс (у каких нод сосед есть
+в списке), по нему refresh находит ноды, связанные с изменившимися.
+
+Потомки и предки строятся по тем же правилам, что и в NodeStorage
+(select_children/select_parents классов нод), поэтому граф, загруженный
+из снимка, совпадает с загруженным из ДПМ.
+
+После синхронизации снимок обновляется частично (refresh): списки соседей
+изменившихся нод перечитываются из ДПМ и хранятся поверх массивов, а когда
+таких нод становится много, массивы перестраиваются.
+"""
+from array import array
+from collections import deque
+from sqlalchemy import select, literal, union_all, or_
+from . import models
+from .storage import NodeStorage, Closure, CHUNK_SIZE
+
+
+# маска вложенности (в ДПМ - NULL)
+CONTAIN = -1
+# направления связей
+DOWN = 0
+UP = 1
+# доля нод с перечитанными списками соседей, после которой массивы перестраиваются
+COMPACT_RATIO = 0.1
+
+
+class CSR:
+    """
+    Списки соседей всех нод в формате CSR: offsets - начало списка
+    каждой ноды (и конец последнего), targets - номера соседей,
+    masks - маски действий. holder_offsets и holders - обратный индекс
+    в том же формате: номера нод, в списках которых есть сосед.
+    """
+
+    def __init__(self, offsets, targets, masks):
+        self.offsets = offsets
+        self.targets = targets
+        self.masks = masks
+        self.holder_offsets, self.holders = self._reverse()
+
+    @classmethod
+    def from_lists(cls, lists):
+        """
+        Строит CSR из списка списков пар (номер соседа, маска).
+        """
+        offsets = array("q", [0])
+        targets = array("q")
+        masks = array("h")
+        for items in lists:
+            for target, mask in items:
+                targets.append(target)
+                masks.append(mask)
+            offsets.append(len(targets))
+        return cls(offsets, targets, masks)
+
+    def neighbours(self, index):
+        if index + 1 >= len(self.offsets):
+            return []
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return list(zip(self.targets[start:end], self.masks[start:end]))
+
+    def holders_of(self, indexes):
+        """
+        Возвращает номера нод, у которых в списке соседей есть indexes.
+        """
+        holders = set()
+        for index in indexes:
+            if index + 1 < len(self.holder_offsets):
+                holders.update(self.holders[self.holder_offsets[index]:self.holder_offsets[index + 1]])
+        return holders
+
+    def _reverse(self):
+        """
+        Строит обратный индекс сортировкой подсчётом за один проход по спискам.
+        """
+        size = max(len(self.offsets) - 1, max(self.targets, default=-1) + 1)
+        counts = array("q", [0]) * (size + 1)
+        for target in self.targets:
+            counts[target + 1] += 1
+        for index in range(size):
+            counts[index + 1] += counts[index]
+        holder_offsets = array("q", counts)
+        holders = array("q", [0]) * len(self.targets)
+        for number in range(len(self.offsets) - 1):
+            for position in range(self.offsets[number], self.offsets[number + 1]):
+                target = self.targets[position]
+                holders[counts[target]] = number
+                counts[target] += 1
+        return holder_offsets, holders
+
+
+class AdjacencySnapshot:
+    """
+    Потомки и предки всех нод ДПМ в памяти.
+
+    Использование:
+        snapshot = AdjacencySnapshot.build(session)
+        storage = NodeStorage(session, snapshot=snapshot)
+        ...
+        snapshot.refresh(session, changed_ids)
+
+    ids - id нод по номерам, index - словарь {id: номер}, classes - коды
+    классов нод (номера в class_names), alive - 0 у удалённых нод.
+    """
+
+    def __init__(self, ids, classes, class_names, adjacency):
+        self.ids = ids
+        self.index = {node_id: number for number, node_id in enumerate(ids)}
+        self.classes = classes
+        self.class_names = class_names
+        self.alive = bytearray(b"\x01" * len(ids))
+        self.adjacency = adjacency
+        # перечитанные после синхронизации списки соседей: {номер: [(номер, маска)]}
+        self.overlay = ({}, {})
+        # обратный индекс для overlay: {номер соседа: множество номеров нод}
+        self.overlay_holders = ({}, {})
+
+    # region public methods
+    @classmethod
+    def build(cls, session):
+        """
+        Загружает снимок из ДПМ: один запрос на ноды и один на все связи.
+        """
+        snapshot = cls(array("q"), array("B"), [], (CSR.from_lists([]), CSR.from_lists([])))
+        nodes = models.Node.__table__
+        for node_id, node_type in session.execute(select([nodes.c.id, nodes.c.type]).order_by(nodes.c.id)):
+            snapshot._add_node(node_id, node_type)
+        lists = ([[] for _ in snapshot.ids], [[] for _ in snapshot.ids])
+        for direction, node_id, neighbour_id, mask in session.execute(cls._select_rows()):
+            if node_id in snapshot.index and neighbour_id in snapshot.index:
+                lists[direction][snapshot.index[node_id]].append(
+                    (snapshot.index[neighbour_id], CONTAIN if mask is None else mask))
+        snapshot.adjacency = (CSR.from_lists(lists[DOWN]), CSR.from_lists(lists[UP]))
+        return snapshot
+
+    def children_of(self, ids):
+        """
+        То же, что NodeStorage.get_children_of, но по id нод и без обращения к ДПМ.
+        """
+        return {node_id: self._attributes(DOWN, node_id) for node_id in ids}
+
+    def parents_of(self, ids):
+        """
+        То же, что NodeStorage.get_parents_of, но по id нод и без обращения к ДПМ.
+        """
+        return {node_id: self._attributes(UP, node_id) for node_id in ids}
+
+    def closure(self, ids, upwards=False, max_depth=None):
+        """
+        То же, что NodeStorage.get_closure, но без обращения к ДПМ.
+        """
+        direction = UP if upwards else DOWN
+        ids = list(dict.fromkeys(ids))
+        depths = {node_id: 0 for node_id in ids}
+        neighbours = {}
+        queue = deque(ids)
+        while queue:
+            node_id = queue.popleft()
+            if max_depth is not None and depths[node_id] > max_depth:
+                continue
+            neighbours[node_id] = self._attributes(direction, node_id)
+            for neighbour_id, _ in neighbours[node_id]:
+                if neighbour_id not in depths:
+                    depths[neighbour_id] = depths[node_id] + 1
+                    queue.append(neighbour_id)
+        return Closure(depths, neighbours)
+
+    def neighbour_ids(self, node_id, upwards=False):
+        """
+        Возвращает id потомков (или предков, если upwards) ноды без масок.
+        """
+        number = self.index.get(node_id)
+        if number is None:
+            return []
+        return [
+            self.ids[target]
+            for target, _ in self._items(UP if upwards else DOWN, number)
+            if self.alive[target]
+        ]
+
+    def class_of(self, node_id):
+        """
+        Возвращает имя класса ноды или None, если ноды нет в снимке.
+        """
+        number = self.index.get(node_id)
+        return None if number is None else self.class_names[self.classes[number]]
+
+    def refresh(self, session, ids=None):
+        """
+        Обновляет снимок после синхронизации. ids - id изменившихся нод
+        (новых, удалённых, с изменившимися связями); перечитываются списки
+        соседей этих нод и нод, связанных с ними. Без ids снимок
+        загружается заново.
+        Возвращает множество id нод, списки соседей которых перечитаны
+        (включая новые и удалённые ноды), или None, если снимок загружен заново.
+        """
+        if ids is None:
+            self.__dict__.update(self.build(session).__dict__)
+            return None
+        ids = set(ids)
+        if not ids:
+            return set()
+        changed = {self.index[node_id] for node_id in ids if node_id in self.index}
+        affected = set(ids)
+        # ноды, у которых изменившиеся ноды были в списке соседей
+        for direction in (DOWN, UP):
+            affected.update(self.ids[number] for number in self._holders_of(direction, changed))
+        # ноды, у которых изменившиеся ноды появились в списке соседей
+        for chunk in _chunks(ids):
+            for _, node_id, neighbour_id, _ in session.execute(self._select_rows(chunk, chunk)):
+                affected.update((node_id, neighbour_id))
+        self._refresh_nodes(session, affected)
+        pending = {node_id for node_id in affected if node_id in self.index}
+        while pending:
+            rows = list(self._load_rows(session, pending))
+            # соседи, которых ещё нет в снимке, - новые ноды; их списки тоже читаются
+            unknown = {neighbour_id for _, _, neighbour_id, _ in rows if neighbour_id not in self.index}
+            self._refresh_nodes(session, unknown)
+            lists = {node_id: ([], []) for node_id in pending}
+            for direction, node_id, neighbour_id, mask in rows:
+                if neighbour_id in self.index:
+                    lists[node_id][direction].append((self.index[neighbour_id], CONTAIN if mask is None else mask))
+            for node_id, (down, up) in lists.items():
+                self._set_overlay(DOWN, self.index[node_id], down)
+                self._set_overlay(UP, self.index[node_id], up)
+            pending = {node_id for node_id in unknown if node_id in self.index}
+            affected.update(pending)
+        if len(self.overlay[DOWN]) > COMPACT_RATIO * len(self.ids):
+            self._compact()
+        return affected
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, node_id):
+        return node_id in self.index
+    # endregion
+
+    # region utility methods
+    @staticmethod
+    def _select_rows(node_ids=None, neighbour_ids=None):
+        """
+        Запрос связей в обе стороны: строки (направление, id ноды, id соседа,
+        маска); node_ids и neighbour_ids ограничивают ноды и соседей
+        (если заданы оба, достаточно одного из условий).
+        """
+        queries = []
+        for direction in (DOWN, UP):
+            relation = NodeStorage.select_relation(direction == UP).alias()
+            node_column, neighbour_column, mask_column = relation.c
+            query = select([literal(direction), node_column, neighbour_column, mask_column])
+            conditions = []
+            if node_ids is not None:
+                conditions.append(node_column.in_(node_ids))
+            if neighbour_ids is not None:
+                conditions.append(neighbour_column.in_(neighbour_ids))
+            if conditions:
+                query = query.where(or_(*conditions))
+            queries.append(query)
+        return union_all(*queries)
+
+    def _load_rows(self, session, ids):
+        for chunk in _chunks(ids):
+            yield from session.execute(self._select_rows(chunk))
+
+    def _add_node(self, node_id, node_type):
+        self.index[node_id] = len(self.ids)
+        self.ids.append(node_id)
+        self.classes.append(self._class_code(node_type))
+        self.alive.append(1)
+
+    def _class_code(self, node_type):
+        mapper = models.Node.__mapper__.polymorphic_map.get(node_type)
+        name = models.Node.__name__ if mapper is None else mapper.class_.__name__
+        if name not in self.class_names:
+            self.class_names.append(name)
+        return self.class_names.index(name)
+
+    def _refresh_nodes(self, session, ids):
+        """
+        Добавляет в снимок новые ноды из ids и убирает удалённые.
+        """
+        nodes = models.Node.__table__
+        found = set()
+        for chunk in _chunks(ids):
+            for node_id, node_type in session.execute(select([nodes.c.id, nodes.c.type]).where(nodes.c.id.in_(chunk))):
+                found.add(node_id)
+                if node_id in self.index:
+                    self.classes[self.index[node_id]] = self._class_code(node_type)
+                else:
+                    self._add_node(node_id, node_type)
+        for node_id in set(ids) - found:
+            number = self.index.pop(node_id, None)
+            if number is not None:
+                self.alive[number] = 0
+                self._set_overlay(DOWN, number, [])
+                self._set_overlay(UP, number, [])
+
+    def _compact(self):
+        """
+        Перестраивает массивы с учётом перечитанных списков, убирая удалённые ноды.
+        """
+        numbers = [number for number in range(len(self.ids)) if self.alive[number]]
+        renumber = {old: new for new, old in enumerate(numbers)}
+        adjacency = []
+        for direction in (DOWN, UP):
+            adjacency.append(CSR.from_lists(
+                [
+                    (renumber[target], mask)
+                    for target, mask in self._items(direction, number)
+                    if target in renumber
+                ]
+                for number in numbers
+            ))
+        self.__init__(
+            array("q", (self.ids[number] for number in numbers)),
+            array("B", (self.classes[number] for number in numbers)),
+            self.class_names,
+            tuple(adjacency))
+
+    def _set_overlay(self, direction, number, items):
+        """
+        Заменяет список соседей ноды в overlay, поддерживая обратный индекс.
+        """
+        holders = self.overlay_holders[direction]
+        for target, _ in self.overlay[direction].get(number, ()):
+            holders[target].discard(number)
+        self.overlay[direction][number] = items
+        for target, _ in items:
+            holders.setdefault(target, set()).add(number)
+
+    def _holders_of(self, direction, numbers):
+        """
+        Номера нод, у которых в текущем списке соседей (с учётом overlay)
+        есть numbers. Для нод из overlay обратный индекс массивов устарел,
+        их берём из обратного индекса overlay.
+        """
+        overlay = self.overlay[direction]
+        holders = {
+            number
+            for number in self.adjacency[direction].holders_of(numbers)
+            if number not in overlay
+        }
+        for number in numbers:
+            holders.update(self.overlay_holders[direction].get(number, ()))
+        return holders
+
+    def _items(self, direction, number):
+        if number in self.overlay[direction]:
+            return self.overlay[direction][number]
+        return self.adjacency[direction].neighbours(number)
+
+    def _attributes(self, direction, node_id):
+        number = self.index.get(node_id)
+        if number is None:
+            return []
+        return [
+            (self.ids[target], models.Edge.attributes_from_mask(None if mask == CONTAIN else mask))
+            for target, mask in self._items(direction, number)
+            if self.alive[target]
+        ]
+    # endregion
+
+
+def _chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
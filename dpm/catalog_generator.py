@@ -0,0 +1,248 @@
+"""
+Генератор искусственных каталогов баз SQL Server.
+
+Генератор пишет файл в формате снимка каталога (см. dpm.catalog_snapshot),
+поэтому с ним работают те же Connector, scan_database и analize_links,
+что и со снимками боевых баз. Нужен для тестов и замеров
+производительности синхронизации на базах произвольного размера без
+боевого сервера.
+
+Объекты ссылаются друг на друга так же, как в настоящих базах:
+процедуры читают и пишут таблицы, вызывают другие процедуры и функции,
+представления и табличные функции читают таблицы, триггеры пишут
+в журнальные таблицы. Часть ссылок может вести в другие сгенерированные
+базы (по полному имени БД.Схема.Название). Все ссылки записываются
+также в sys.sql_expression_dependencies; ссылки по имени без схемы
+записываются, как это делает SQL Server, без object_id и схемы.
+"""
+import os
+import random
+import sqlite3
+import datetime
+from .catalog_snapshot import SNAPSHOT_SCHEMA, CatalogSnapshotException, snapshot_path
+
+
+# дата изменения всех сгенерированных объектов
+GENERATED_AT = datetime.datetime(2019, 1, 1)
+SCHEMA_ID = 1
+SCHEMA_NAME = "dbo"
+TRIGGER_PROPERTIES = ("ExecIsUpdateTrigger", "ExecIsDeleteTrigger", "ExecIsInsertTrigger")
+
+
+class CatalogGenerator:
+    """
+    Генератор одного каталога.
+
+    tables, procedures, views, triggers, table_functions, scalar_functions -
+    количество объектов каждого вида;
+    refs_per_script - среднее количество ссылок из одного скрипта;
+    foreign_databases - имена других сгенерированных баз, на объекты
+    которых могут ссылаться скрипты (считается, что в них не меньше таблиц);
+    foreign_ratio - доля ссылок на таблицы других баз;
+    seed - зерно генератора случайных чисел, при одинаковом зерне
+    каталоги получаются одинаковыми.
+    """
+
+    def __init__(self, db_name, tables=100, procedures=200, views=50, triggers=50,
+                 table_functions=20, scalar_functions=20, refs_per_script=5,
+                 foreign_databases=(), foreign_ratio=0.05, seed=0):
+        if triggers > tables:
+            raise CatalogSnapshotException("Триггеров не может быть больше, чем таблиц")
+        self.db_name = db_name
+        self.counts = {
+            "tables": tables,
+            "procedures": procedures,
+            "views": views,
+            "triggers": triggers,
+            "table_functions": table_functions,
+            "scalar_functions": scalar_functions,
+        }
+        self.refs_per_script = refs_per_script
+        self.foreign_databases = list(foreign_databases)
+        self.foreign_ratio = foreign_ratio
+        self.random = random.Random(seed)
+        self._next_id = 1000
+        self.objects = []
+        self.modules = []
+        self.properties = []
+        self.dependencies = []
+
+    @staticmethod
+    def object_name(kind, number):
+        prefixes = {
+            "tables": "t",
+            "procedures": "p",
+            "views": "v",
+            "triggers": "tr",
+            "table_functions": "tf",
+            "scalar_functions": "fn",
+        }
+        return f"{prefixes[kind]}_{number:06d}"
+
+    # region public methods
+    def generate(self, path):
+        """
+        Генерирует каталог и записывает его в файл path.
+        Возвращает путь к файлу.
+        """
+        tables = self._add_objects("tables", "U")
+        procedures = self._add_objects("procedures", "P")
+        views = self._add_objects("views", "V")
+        table_functions = self._add_objects("table_functions", "TF")
+        scalar_functions = self._add_objects("scalar_functions", "FN")
+
+        for object_id, name in procedures:
+            self._add_module(object_id, name, "procedure", self._procedure_body(object_id, tables, procedures, scalar_functions))
+        for object_id, name in views:
+            self._add_module(object_id, name, "view", self._select_body(object_id, tables, scalar_functions))
+        for object_id, name in table_functions:
+            self._add_module(object_id, name, "function", "returns table as return " + self._select_body(object_id, tables, scalar_functions))
+        for object_id, name in scalar_functions:
+            self._add_module(object_id, name, "function", self._scalar_body(object_id, tables))
+        for number, (table_id, table_name) in enumerate(self.random.sample(tables, self.counts["triggers"]), 1):
+            self._add_trigger(self.object_name("triggers", number), table_id, table_name, tables)
+        self._write(path)
+        return path
+    # endregion
+
+    # region utility methods
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def _add_objects(self, kind, type_code, parent_id=0):
+        added = []
+        for number in range(1, self.counts[kind] + 1):
+            object_id = self._new_id()
+            name = self.object_name(kind, number)
+            self.objects.append((object_id, name, SCHEMA_ID, type_code, GENERATED_AT, parent_id))
+            added.append((object_id, name))
+        return added
+
+    def _add_module(self, object_id, name, kind, body):
+        self.modules.append((object_id, f"create {kind} {SCHEMA_NAME}.{name}\nas\n{body}"))
+
+    def _add_trigger(self, name, table_id, table_name, tables):
+        object_id = self._new_id()
+        self.objects.append((object_id, name, SCHEMA_ID, "TR", GENERATED_AT, table_id))
+        operations = self.random.sample(["insert", "update", "delete"], self.random.randint(1, 3))
+        for prop, operation in zip(TRIGGER_PROPERTIES, ["update", "delete", "insert"]):
+            self.properties.append((object_id, prop, int(operation in operations)))
+        log_id, log_name = self.random.choice(tables)
+        self._reference(object_id, log_id, log_name)
+        body = (
+            f"create trigger {SCHEMA_NAME}.{name} on {SCHEMA_NAME}.{table_name} "
+            f"after {', '.join(operations)}\nas\n"
+            f"insert into {SCHEMA_NAME}.{log_name} (id, value)\n"
+            f"select id, value from inserted")
+        self.modules.append((object_id, body))
+
+    def _reference(self, referencing_id, referenced_id, name, database=None, schema=SCHEMA_NAME):
+        self.dependencies.append((referencing_id, referenced_id, database, schema, name))
+
+    def _table_reference(self, referencing_id, tables):
+        """
+        Выбирает таблицу, на которую сошлётся скрипт, и возвращает
+        её имя в том виде, в каком оно будет записано в коде.
+        """
+        if self.foreign_databases and self.random.random() < self.foreign_ratio:
+            database = self.random.choice(self.foreign_databases)
+            name = self.object_name("tables", self.random.randint(1, self.counts["tables"]))
+            self._reference(referencing_id, None, name, database)
+            return f"{database}.{SCHEMA_NAME}.{name}"
+        table_id, name = self.random.choice(tables)
+        # в коде встречаются все три варианта написания имени
+        written = self.random.choice([name, f"{SCHEMA_NAME}.{name}", f"{self.db_name}.{SCHEMA_NAME}.{name}"])
+        if written == name:
+            # имя без схемы зависит от схемы вызывающего (is_caller_dependent)
+            self._reference(referencing_id, None, name, schema=None)
+        else:
+            self._reference(referencing_id, table_id, name)
+        return written
+
+    def _references_count(self):
+        return max(1, int(self.random.expovariate(1 / self.refs_per_script)))
+
+    def _select_body(self, object_id, tables, scalar_functions):
+        first = self._table_reference(object_id, tables)
+        lines = [f"select a.id, a.value from {first} a"]
+        for alias in range(1, self._references_count()):
+            lines.append(f"join {self._table_reference(object_id, tables)} j{alias} on j{alias}.id = a.id")
+        if scalar_functions and self.random.random() < 0.3:
+            function_id, function_name = self.random.choice(scalar_functions)
+            self._reference(object_id, function_id, function_name)
+            lines.append(f"where a.value = {SCHEMA_NAME}.{function_name}(a.id)")
+        return "\n".join(lines)
+
+    def _scalar_body(self, object_id, tables):
+        table = self._table_reference(object_id, tables)
+        return (
+            "returns int as\nbegin\n"
+            f"    return (select count(*) from {table} where id > 0)\n"
+            "end")
+
+    def _procedure_body(self, object_id, tables, procedures, scalar_functions):
+        lines = []
+        for _ in range(self._references_count()):
+            action = self.random.choice(["select", "insert", "update", "delete", "exec", "calc"])
+            if action == "exec" and len(procedures) > 1:
+                procedure_id, procedure_name = self.random.choice(procedures)
+                if procedure_id != object_id:
+                    self._reference(object_id, procedure_id, procedure_name)
+                    lines.append(f"exec {SCHEMA_NAME}.{procedure_name} @id")
+                continue
+            if action == "calc" and scalar_functions:
+                function_id, function_name = self.random.choice(scalar_functions)
+                self._reference(object_id, function_id, function_name)
+                lines.append(f"set @value = {SCHEMA_NAME}.{function_name}(@id)")
+                continue
+            table = self._table_reference(object_id, tables)
+            if action == "insert":
+                lines.append(f"insert into {table} (id, value) values (@id, @value)")
+            elif action == "update":
+                lines.append(f"update {table} set value = @value where id = @id")
+            elif action == "delete":
+                lines.append(f"delete from {table} where id = @id")
+            else:
+                lines.append(f"select @value = value from {table} where id = @id")
+        return "@id int\nas\nbegin\n    declare @value int\n    " + "\n    ".join(lines) + "\nend"
+
+    def _write(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        catalog = sqlite3.connect(path)
+        try:
+            for statement in SNAPSHOT_SCHEMA:
+                catalog.execute(statement)
+            catalog.execute("insert into meta (db_name) values (?)", (self.db_name,))
+            catalog.execute("insert into schemas (schema_id, name) values (?, ?)", (SCHEMA_ID, SCHEMA_NAME))
+            catalog.executemany(
+                "insert into objects (object_id, name, schema_id, type, modify_date, parent_object_id) values (?, ?, ?, ?, ?, ?)",
+                [row[:4] + (row[4].isoformat(" "),) + row[5:] for row in self.objects])
+            catalog.executemany("insert into sql_modules (object_id, definition) values (?, ?)", self.modules)
+            catalog.executemany("insert into object_properties (object_id, property, value) values (?, ?, ?)", self.properties)
+            catalog.executemany(
+                """insert into sql_expression_dependencies (
+                    referencing_id, referenced_id, referenced_database_name, referenced_schema_name, referenced_entity_name)
+                values (?, ?, ?, ?, ?)""",
+                self.dependencies)
+            catalog.commit()
+        finally:
+            catalog.close()
+    # endregion
+
+
+def generate_catalogs(directory, db_names, seed=0, **sizes):
+    """
+    Генерирует в папке directory каталоги для баз db_names так, чтобы
+    скрипты каждой базы ссылались и на таблицы остальных баз.
+    Размеры задаются именованными параметрами CatalogGenerator.
+    Возвращает список путей к файлам каталогов.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number, db_name in enumerate(db_names):
+        foreign = [name for name in db_names if name != db_name]
+        generator = CatalogGenerator(db_name, foreign_databases=foreign, seed=seed + number, **sizes)
+        paths.append(generator.generate(snapshot_path(directory, db_name)))
+    return paths
@@ -0,0 +1,199 @@
+"""
+Снимки системного каталога баз SQL Server.
+
+Снимок - это файл SQLite, в котором лежат копии нужных синхронизации
+системных представлений (sys.objects, sys.schemas, sys.tables, sys.sql_modules,
+sys.sql_expression_dependencies) и свойств триггеров. При подключении
+файл присоединяется к соединению под именем sys, поэтому запросы из
+sync.original_models и dpm.linking выполняются над снимком без изменений;
+немногие конструкции T-SQL, которых нет в SQLite (DB_NAME, OBJECTPROPERTY,
+табличные функции dm_sql_*_entities), подменяются перед выполнением.
+
+Файл открывается только на чтение и отображается в память (mmap), а при
+снятии снимка строки пишутся пачками по мере чтения с сервера.
+"""
+import os
+import re
+import sqlite3
+from sqlalchemy import create_engine, event
+from sqlalchemy.sql import text
+
+
+SNAPSHOT_EXTENSION = ".catalog"
+# размер отображаемой в память части файла снимка
+MMAP_SIZE = 1024 * 1024 * 1024
+# сколько строк писать в снимок за раз
+BATCH_SIZE = 5000
+
+SNAPSHOT_SCHEMA = [
+    "create table meta (db_name text not null)",
+    "create table schemas (schema_id integer primary key, name text not null)",
+    """create table objects (
+        object_id integer primary key,
+        name text not null,
+        schema_id integer not null,
+        type text not null,
+        modify_date timestamp not null,
+        parent_object_id integer not null default 0)""",
+    "create index ix_objects_type on objects (type)",
+    "create index ix_objects_parent on objects (parent_object_id)",
+    "create table sql_modules (object_id integer primary key, definition text)",
+    """create table object_properties (
+        object_id integer not null,
+        property text not null,
+        value integer,
+        primary key (object_id, property))""",
+    """create table sql_expression_dependencies (
+        referencing_id integer not null,
+        referenced_id integer,
+        referenced_database_name text,
+        referenced_schema_name text,
+        referenced_entity_name text)""",
+    "create index ix_dependencies_referenced on sql_expression_dependencies (referenced_id)",
+    "create index ix_dependencies_referencing on sql_expression_dependencies (referencing_id)",
+    """create view tables as
+        select object_id, name, schema_id, modify_date
+        from objects
+        where type = 'U'""",
+]
+
+# что и как выгружается с сервера: таблица снимка и запрос к каталогу
+DUMP_QUERIES = [
+    ("schemas", "select schema_id, name from sys.schemas"),
+    ("objects", """
+        select object_id, name, schema_id, rtrim(type) as type, modify_date, parent_object_id
+        from sys.objects
+        where type in ('U', 'TR', 'P', 'V', 'TF', 'IF', 'FN')"""),
+    ("sql_modules", """
+        select m.object_id, m.definition
+        from sys.sql_modules m
+        join sys.objects o on o.object_id = m.object_id
+        where o.type in ('TR', 'P', 'V', 'TF', 'IF', 'FN')"""),
+    ("object_properties", """
+        select object_id, p.property, OBJECTPROPERTY(object_id, p.property) as value
+        from sys.objects
+        cross join (
+            select 'ExecIsUpdateTrigger' as property
+            union all select 'ExecIsDeleteTrigger'
+            union all select 'ExecIsInsertTrigger') p
+        where type = 'TR'"""),
+    ("sql_expression_dependencies", """
+        select referencing_id, referenced_id, referenced_database_name, referenced_schema_name, referenced_entity_name
+        from sys.sql_expression_dependencies"""),
+]
+
+# подстановки для конструкций T-SQL, которых нет в SQLite
+REWRITES = [
+    (
+        re.compile(r"OBJECTPROPERTY\(\s*([\w.]+)\s*,\s*'(\w+)'\s*\)", re.IGNORECASE),
+        r"(select p.value from sys.object_properties p where p.object_id = \1 and p.property = '\2')"
+    ),
+    (
+        re.compile(r"sys\.dm_sql_referencing_entities\(\s*\?\s*,\s*'OBJECT'\s*\)", re.IGNORECASE),
+        """(
+            select distinct d.referencing_id
+            from sys.sql_expression_dependencies d
+            join sys.objects o on o.object_id = d.referenced_id
+            join sys.schemas s on s.schema_id = o.schema_id
+            where s.name || '.' || o.name = ?)"""
+    ),
+    (
+        re.compile(r"sys\.dm_sql_referenced_entities\(\s*\?\s*,\s*'OBJECT'\s*\)", re.IGNORECASE),
+        """(
+            select d.referenced_id
+            from sys.sql_expression_dependencies d
+            join sys.objects o on o.object_id = d.referencing_id
+            join sys.schemas s on s.schema_id = o.schema_id
+            where s.name || '.' || o.name = ?)"""
+    ),
+]
+
+
+class CatalogSnapshotException(Exception):
+    pass
+
+
+def snapshot_path(directory, db_name):
+    return os.path.join(directory, f"{db_name}{SNAPSHOT_EXTENSION}")
+
+
+def dump_catalog(conn, path):
+    """
+    Снимает каталог базы, с которой работает соединение conn, в файл path.
+    Строки читаются с сервера потоком и пишутся в снимок пачками;
+    снимок пишется во временный файл и подменяет старый только в конце.
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    snapshot = sqlite3.connect(tmp_path)
+    try:
+        for statement in SNAPSHOT_SCHEMA:
+            snapshot.execute(statement)
+        db_name = conn.execute(text("select DB_NAME()")).scalar()
+        snapshot.execute("insert into meta (db_name) values (?)", (db_name,))
+        for table, query in DUMP_QUERIES:
+            result = conn.execute(text(query))
+            columns = list(result.keys())
+            insert = f"insert into {table} ({', '.join(columns)}) values ({', '.join('?' * len(columns))})"
+            while True:
+                rows = result.fetchmany(BATCH_SIZE)
+                if not rows:
+                    break
+                snapshot.executemany(insert, [tuple(_to_sqlite(value) for value in row) for row in rows])
+        snapshot.commit()
+    finally:
+        snapshot.close()
+    os.replace(tmp_path, path)
+    return path
+
+
+def create_snapshot_engine(path):
+    """
+    Создаёт движок SQLAlchemy, соединения которого работают со снимком
+    каталога так же, как с боевой базой.
+    """
+    if not os.path.exists(path):
+        raise CatalogSnapshotException(f"Не найден снимок каталога {path}")
+    db_name = _read_db_name(path)
+
+    def connect():
+        # основная база соединения пустая, снимок присоединяется к ней;
+        # uri нужен, чтобы открыть снимок только на чтение
+        connection = sqlite3.connect("file::memory:", uri=True, check_same_thread=False)
+        uri = "file:" + os.path.abspath(path).replace("\\", "/") + "?mode=ro"
+        connection.execute("attach database ? as sys", (uri,))
+        connection.execute(f"pragma sys.mmap_size = {MMAP_SIZE}")
+        connection.create_function("DB_NAME", 0, lambda: db_name)
+        return connection
+
+    engine = create_engine("sqlite://", creator=connect)
+
+    @event.listens_for(engine, "before_cursor_execute", retval=True)
+    def rewrite_tsql(conn, cursor, statement, parameters, context, executemany):
+        return rewrite_statement(statement), parameters
+
+    return engine
+
+
+def rewrite_statement(statement):
+    """
+    Подменяет в запросе конструкции T-SQL на эквиваленты для снимка.
+    """
+    for pattern, replacement in REWRITES:
+        statement = pattern.sub(replacement, statement)
+    return statement
+
+
+def _read_db_name(path):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute("select db_name from meta").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def _to_sqlite(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat(" ")
+    return value
@@ -0,0 +1,85 @@
+"""
+Отслеживание изменений ДПМ, сделанных синхронизацией.
+
+GUI держит ноды и снимок связей в памяти (NodeStorage), а синхронизация
+в это время пишет в ДПМ из другого процесса. Чтобы не перечитывать всё,
+трекер помнит для каждой ноды её last_update и last_revision и при опросе
+возвращает id нод, которые появились, исчезли или у которых эти поля
+изменились: синхронизация меняет last_update изменившихся нод, а анализ
+связей ставит last_revision всем нодам, связи которых пересчитал.
+Эти id передаются в NodeStorage.invalidate.
+
+Для файла SQLite опрос сначала проверяет PRAGMA data_version на отдельном
+соединении: значение меняется, только когда в файл закоммитило другое
+соединение, поэтому пока синхронизация ничего не записала, опрос стоит
+одного запроса без чтения таблицы Node.
+
+Использование:
+    tracker = ChangeTracker(session)
+    ...
+    changed = tracker.poll()
+    if changed:
+        storage.invalidate(changed)
+"""
+from sqlalchemy import select
+from . import models
+
+
+class ChangeTracker:
+    """
+    Находит ноды ДПМ, изменившиеся с прошлого опроса.
+
+    stamps - словарь {id ноды: (last_update, last_revision)} на момент
+    последнего опроса.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        bind = session.get_bind()
+        # отдельное соединение для data_version: значение имеет смысл только
+        # при сравнении результатов одного и того же соединения
+        self._probe = bind.raw_connection() if bind.dialect.name == "sqlite" else None
+        self._version = self._data_version()
+        self.stamps = self._read_stamps()
+
+    # region public methods
+    def poll(self):
+        """
+        Возвращает множество id нод, которые с прошлого опроса появились,
+        удалены или изменились; пустое множество, если изменений нет.
+        """
+        version = self._data_version()
+        if version is not None and version == self._version:
+            return set()
+        self._version = version
+        stamps = self._read_stamps()
+        changed = {node_id for node_id, stamp in stamps.items() if self.stamps.get(node_id) != stamp}
+        changed.update(node_id for node_id in self.stamps if node_id not in stamps)
+        self.stamps = stamps
+        return changed
+
+    def close(self):
+        if self._probe is not None:
+            self._probe.close()
+            self._probe = None
+    # endregion
+
+    # region utility methods
+    def _data_version(self):
+        if self._probe is None:
+            return None
+        cursor = self._probe.cursor()
+        try:
+            cursor.execute("PRAGMA data_version")
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    def _read_stamps(self):
+        nodes = models.Node.__table__
+        query = select([nodes.c.id, nodes.c.last_update, nodes.c.last_revision])
+        return {node_id: (last_update, last_revision) for node_id, last_update, last_revision in self.session.execute(query)}
+    # endregion
+
+
+__all__ = ["ChangeTracker"]
@@ -1,7 +1,11 @@
+import os
 from sqlalchemy import create_engine, engine
 from sqlalchemy.orm import sessionmaker
-from .models import BaseDPM, Database
-import pyodbc
+from .models import Database
+from .migrations import prepare_dpm
+from .sqlite_profile import create_dpm_engine, is_sqlite_file, TimedLock
+from .query_counter import QueryCounter
+from .catalog_snapshot import create_snapshot_engine, dump_catalog, snapshot_path, CatalogSnapshotException
 
 
 class DriverNotFoundException(Exception):
@@ -14,6 +18,15 @@ class Connector:
     Для инициализации требует словарь-конфиг с полями:
         username_sql, password_sql, host_sql - для подключения к боевым базам ИС;
         host_dpm, password_dpm, host_dpm - для подключения к базе ДПМ (пока неактивно, используем sqlite).
+    Необязательные поля:
+        catalog_snapshots - папка со снимками каталогов баз (см. dpm.catalog_snapshot);
+        offline - если True, то вместо боевых баз используются их снимки;
+        dpm_pragmas - поправки к прагмам файла ДПМ (см. dpm.sqlite_profile).
+
+    Со статистикой запросов к ДПМ (dpm_summary) можно понять, сколько
+    времени уходит на чтение и запись и были ли конфликты блокировок.
+    dpm_write_lock - блокировка записи в ДПМ; её держит соединение, у которого
+    открыта транзакция записи (см. dpm.sqlite_profile).
     """
 
     def __init__(self, **config):
@@ -26,8 +39,21 @@ class Connector:
         self.__sqlserver_pswd = config.get("password_sql")
         self.__sqlserver_host = config.get("host_sql")
         self.__sessionmaker_dpm = None
-        self.__driver_sql = self.__get_driver()
-        self.__connections = {}
+        self.__sessionmaker_dpm_reader = None
+        self.dpm_pragmas = config.get("dpm_pragmas")
+        self.dpm_write_lock = TimedLock()
+        # статистика запросов движков ДПМ: {"запись"/"чтение": QueryCounter}
+        self.dpm_stats = {}
+        # драйвер ищется при первом соединении с боевым сервером,
+        # на машинах без ODBC-драйвера можно работать со снимками
+        self.__driver_sql = None
+        # движки боевых баз по именам; у каждого свой пул соединений,
+        # поэтому движками можно пользоваться из разных потоков
+        self.__engines = {}
+        self.snapshot_dir = config.get("catalog_snapshots")
+        self.offline = config.get("offline", False)
+        if self.offline and self.snapshot_dir is None:
+            raise CatalogSnapshotException("Для работы без боевого сервера нужно указать папку со снимками (catalog_snapshots)")
 
     def __get_driver(self):
         """
@@ -35,6 +61,8 @@ class Connector:
         и возвращает имя последнего установленного драйвера.
         Кидает исключение, если подходящих драйверов нет.
         """
+        # pyodbc нужен только для боевого сервера, со снимками можно работать без него
+        import pyodbc
         available_drivers = [
             driver for driver in pyodbc.drivers() if driver.find("SQL Server") >= 0
         ]
@@ -42,27 +70,50 @@ class Connector:
             raise DriverNotFoundException("Не найден ODBC драйвер для соединения с SQL Server.")
         return available_drivers[len(available_drivers)-1]
 
-    def connect_to_dpm(self):
+    def connect_to_dpm(self, read_only=False):
         """
-        Возвращает объект sessionmaker для работы с базой ДПМ.
+        Возвращает сессию для работы с базой ДПМ.
+        При первом соединении схема ДПМ приводится к последней версии
+        (см. dpm.migrations).
+        Если read_only, сессия работает через пул соединений только на
+        чтение и не ждёт идущую в это время синхронизацию (для GUI и отчётов).
         """
         if self.__sessionmaker_dpm is None:
-            engine = create_engine(self.url_dpm, echo=False)
-            BaseDPM.metadata.create_all(engine)
+            engine = create_dpm_engine(self.url_dpm, pragmas=self.dpm_pragmas, write_lock=self.dpm_write_lock)
+            prepare_dpm(engine)
+            self.dpm_stats["запись"] = QueryCounter(engine).start()
             self.__sessionmaker_dpm = sessionmaker(bind=engine)
-        return self.__sessionmaker_dpm()
+        if not read_only or not is_sqlite_file(self.url_dpm):
+            return self.__sessionmaker_dpm()
+        if self.__sessionmaker_dpm_reader is None:
+            engine = create_dpm_engine(self.url_dpm, read_only=True, pragmas=self.dpm_pragmas)
+            self.dpm_stats["чтение"] = QueryCounter(engine).start()
+            self.__sessionmaker_dpm_reader = sessionmaker(bind=engine)
+        return self.__sessionmaker_dpm_reader()
+
+    def dpm_summary(self):
+        """
+        Статистика запросов к ДПМ по движкам (запись, чтение).
+        """
+        return "\n".join(f"ДПМ, {name}: {counter.summary}" for name, counter in self.dpm_stats.items())
 
     def connect_to(self, db):
         """
         Метод для соединения с произвольной БД основной информационной системы.
         Принимает либо инстанс модели Database, либо строку с именем базы.
-        Возвращает объект-соединение.
+        Возвращает новое объект-соединение, которое вызывающий должен закрыть
+        (удобнее всего через with), когда закончит работу с базой.
+        В режиме offline соединение работает со снимком каталога базы.
         """
         if isinstance(db, Database):
             db_name = db.name
         else:
             db_name = db
-        if db_name not in self.__connections:
+        if db_name not in self.__engines and self.offline:
+            self.__engines[db_name] = create_snapshot_engine(snapshot_path(self.snapshot_dir, db_name))
+        elif db_name not in self.__engines:
+            if self.__driver_sql is None:
+                self.__driver_sql = self.__get_driver()
             url = engine.url.URL(
                 "mssql+pyodbc",
                 username=self.__sqlserver_user,
@@ -71,9 +122,22 @@ class Connector:
                 database=db_name,
                 query=dict(driver=self.__driver_sql, MARS_Connection="Yes")
             )
-            e = create_engine(url, echo=False)
-            self.__connections[db_name] = e.connect()
-        return self.__connections[db_name]
+            self.__engines[db_name] = create_engine(url, echo=False)
+        return self.__engines[db_name].connect()
+
+    def dump_catalog(self, db):
+        """
+        Снимает каталог боевой базы в папку снимков.
+        Возвращает путь к файлу снимка.
+        """
+        if self.snapshot_dir is None:
+            raise CatalogSnapshotException("Не указана папка со снимками (catalog_snapshots)")
+        if self.offline:
+            raise CatalogSnapshotException("Снимок можно снять только с боевой базы")
+        db_name = db.name if isinstance(db, Database) else db
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        with self.connect_to(db_name) as conn:
+            return dump_catalog(conn, snapshot_path(self.snapshot_dir, db_name))
 
 
 __all__ = ["Connector"]
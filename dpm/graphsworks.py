@@ -29,7 +29,16 @@ import settings
 нужных типов, дозапрашивать данные из базы по id объекта.
 """
 
-# ToDo сделать послойную загрузку зависимостей вместо повершинной
+# начиная с какой глубины загрузки связи читаются одним рекурсивным запросом
+DEEP_LOAD_LEVELS = 4
+# рекомендуемая глубина загрузки (DpmGraph.recommended_loading_depth):
+# не больше LOADING_LEVELS уровней, а у нод, соседей которых больше
+# WIDE_NODE_DEGREE, - один уровень
+LOADING_LEVELS = 3
+WIDE_NODE_DEGREE = 100
+# глубина загрузки, если статистика связей ноды ещё не посчитана
+DEFAULT_LOADING_DEPTH = (1, 1)
+
 # ToDo придумать, что делать со спрятанными вершинами при подгрузке зависимостей
 # ToDo настройки визуализации в config.json
 
@@ -167,6 +176,20 @@ class DpmGraph:
     # endregion
 
     # region public methods
+    def recommended_loading_depth(self):
+        """
+        Возвращает пару (уровней вверх, уровней вниз), которые рекомендуется
+        загружать для точки отсчёта. Считается по статистике связей ноды
+        (NodeStorage.get_stats), без загрузки графа: если все связи
+        помещаются в LOADING_LEVELS уровней, загружаются все.
+        """
+        stats = self._storage.get_stats([self.pov_id]).get(self.pov_id)
+        if stats is None:
+            return DEFAULT_LOADING_DEPTH
+        return (
+            self._recommended_levels(stats.depth_up, stats.parents),
+            self._recommended_levels(stats.depth_down, stats.children))
+
     def load_dependencies(self, levels_up=0, levels_down=0):
         """
         Приводит граф к состоянию, когда у POV-вершины глубина восходящих
@@ -357,115 +380,109 @@ class DpmGraph:
         Подгружает связи в графе на levels_counter уровней вверх.
         """
         # ищем крайние вершины графа
-        upper_periphery = set()
         length = dict(nx.single_target_shortest_path_length(self.nx_graph, self.pov_id))
-        for node_id in length:
-            if length[node_id] == self.levels_up:
-                upper_periphery.add(node_id)
+        upper_periphery = [node_id for node_id in length if length[node_id] == self.levels_up]
         # используем набор крайних вершин как отправную точку для поиска
-        rising_failed = []
-        for node in self._storage.get_group_of_nodes_by_ids(upper_periphery):
-            rising_failed.append(self._explore_upper_nodes(node, levels_counter))
-        return all(rising_failed)
+        return self._load_layers(upper_periphery, levels_counter, upwards=True)
 
     def _load_dependencies_down(self, levels_counter):
         """
         Подгружает связи в графе на levels_counter уровней вниз.
         """
         # ищем вершины графа, максимально удалённые от pov на данный момент
-        bottom_periphery = set()
         length = nx.single_source_shortest_path_length(self.nx_graph, self.pov_id)
-        for node_id in length:
-            if length[node_id] == self.levels_down:
-                bottom_periphery.add(node_id)
+        bottom_periphery = [node_id for node_id in length if length[node_id] == self.levels_down]
         # используем набор крайних вершин как отправную точку для поиска
-        digging_failed = []
-        for node in self._storage.get_group_of_nodes_by_ids(bottom_periphery):
-            digging_failed.append(self._explore_lower_nodes(node, levels_counter))
-        return all(digging_failed)
-
-    def _explore_lower_nodes(self, node, levels_counter):
-        """
-        Закапывается на levels_counter уровней вглубь зависимостей
-        указанной вершины.
-        Возвращает True, если закопаться на нужное количество уровней
-        не удалось и поиск окончился раньше времени.
-        Это значение служит индикатором того, что граф исследован
-        вглубь до конца.
-        """
-        children = node.get_children()
-        if len(children) == 0:
-            # если у вершины нет потомков, то помечаем её как периферийную
-            self._set_node_as_peripheral(node.id)
-            return True
-        digging_failed = []
-        for child, edge_attrs in children:
-            # если новая вершина ещё не добавлена в граф, то добавляем её id в граф и прописываем все атрибуты
-            if child.id not in self.nx_graph:
-                self._add_nx_node_from_model(child)
-                # исследуем дочернюю вершину, если нужно углубиться
-                # ещё на несколько уровней
-                # и сохраняем результат
-                if levels_counter > 1:
-                    digging_failed.append(self._explore_lower_nodes(child, levels_counter-1))
-            else:
-                # если вершина уже в графе, то проверяем является ли
-                # она периферийной
-                digging_failed.append(self._check_node_is_peripheral(child.id))
-            # присоединяем дочернюю вершину к родительской, создавая ребро
-            # графа для каждой операции
-            for attr in edge_attrs:
-                self._add_edge(node, child, attr)
-        return all(digging_failed)
-
-    def _explore_upper_nodes(self, node, levels_counter):
-        """
-        Закапывается на levels_counter уровней вверх по зависимостям
-        указанной вершины.
-        Возвращает True, если подняться на нужное количество уровней не
-        удалось и поиск окончился раньше времени.
-        Это значение служит индикатором того, что граф исследован
-        вверх до конца.
-        """
-        parents = node.get_parents()
-        if len(parents) == 0:
-            # если у вершины нет предков, то помечаем её как периферийную
-            self._set_node_as_peripheral(node.id)
+        return self._load_layers(bottom_periphery, levels_counter, upwards=False)
+
+    def _load_layers(self, periphery, levels_counter, upwards):
+        """
+        Подгружает связи вершин periphery на levels_counter уровней вверх
+        или вниз, обходя граф в ширину.
+
+        На каждом уровне связи всех вершин фронта читаются одним запросом
+        (NodeStorage.get_parents_of/get_children_of), а новые вершины -
+        ещё одним, поэтому количество запросов зависит от глубины,
+        а не от количества вершин. Если уровней DEEP_LOAD_LEVELS и больше
+        (в том числе "до конца"), связи всех уровней читаются сразу одним
+        рекурсивным запросом (NodeStorage.get_closure).
+        Возвращает True, если граф исследован в этом направлении до конца.
+        """
+        # для графа достаточно лёгких описаний нод (NodeStorage.get_headers)
+        frontier = self._storage.get_headers(periphery)
+        if levels_counter >= DEEP_LOAD_LEVELS:
+            # при глубокой загрузке все связи читаются заранее одним
+            # рекурсивным запросом, а слои строятся уже по ним
+            closure = self._storage.get_closure(
+                periphery, upwards, None if levels_counter == float("inf") else levels_counter)
+            layer_neighbours = lambda nodes: {node.id: closure.neighbours.get(node.id, []) for node in nodes}
+        else:
+            layer_neighbours = lambda nodes: self._layer_neighbours(nodes, upwards)
+        level = 0
+        while frontier and level < levels_counter:
+            level += 1
+            neighbours = layer_neighbours(frontier)
+            new_ids = [
+                neighbour_id
+                for node in frontier
+                for neighbour_id, _ in neighbours[node.id]
+                if neighbour_id not in self.nx_graph
+            ]
+            new_nodes = self._storage.get_headers(new_ids)
+            for new_node in new_nodes:
+                self._add_nx_node_from_model(new_node)
+            for node in frontier:
+                if not neighbours[node.id]:
+                    # если у вершины нет связей в этом направлении, то помечаем её как периферийную
+                    self._set_node_as_peripheral(node.id)
+                for neighbour_id, edge_attrs in neighbours[node.id]:
+                    # связи с нодами, которых уже нет в ДПМ, пропускаем
+                    if neighbour_id not in self.nx_graph:
+                        continue
+                    # создаём ребро графа для каждой операции
+                    for attr in edge_attrs:
+                        if upwards:
+                            self._add_edge(neighbour_id, node.id, attr)
+                        else:
+                            self._add_edge(node.id, neighbour_id, attr)
+            frontier = new_nodes
+        if not frontier:
             return True
-        rising_failed = []
-        for parent, edge_attrs in node.get_parents():
-            # если новая вершина ещё не добавлена в граф, то добавляем её id в граф и прописываем все атрибуты
-            if parent.id not in self.nx_graph:
-                self._add_nx_node_from_model(parent)
-                # исследуем дочернюю вершину, если нужно
-                # подняться ещё на несколько уровней
-                # и сохраняем результат
-                if levels_counter > 1:
-                    rising_failed.append(self._explore_upper_nodes(parent, levels_counter-1))
-            else:
-                # если вершина уже в графе, то проверяем является ли она периферийной
-                rising_failed.append(self._check_node_is_peripheral(parent.id))
-            # присоединяем родительскую вершину к дочерней, создавая ребро графа для каждой операции
-            for attr in edge_attrs:
-                self._add_edge(parent, node, attr)
-        return all(rising_failed)
+        # уровни закончились; граф исследован до конца, если у последнего
+        # слоя нет связей с вершинами, которых ещё нет в графе
+        neighbours = layer_neighbours(frontier)
+        return all(
+            neighbour_id in self.nx_graph
+            for node in frontier
+            for neighbour_id, _ in neighbours[node.id]
+        )
+
+    @staticmethod
+    def _recommended_levels(depth, degree):
+        # у широкой ноды уже первый уровень - сотни вершин
+        if degree > WIDE_NODE_DEGREE:
+            return min(depth, 1)
+        return min(depth, LOADING_LEVELS)
+
+    def _layer_neighbours(self, nodes, upwards):
+        if upwards:
+            return self._storage.get_parents_of(nodes)
+        return self._storage.get_children_of(nodes)
 
     def _set_node_as_peripheral(self, node_id):
         self.nx_graph.node[node_id]["peripheral"] = True
 
-    def _check_node_is_peripheral(self, node_id):
-        return self.nx_graph.node[node_id]["peripheral"]
-
     def _add_nx_node_from_model(self, model):
         """
-        Добавляет в граф новую вершину, беря данные из её orm-модели.
+        Добавляет в граф новую вершину, беря данные из её orm-модели
+        или описания NodeHeader.
         Поскольку набор атрибутов вершин может меняться, эта операция вынесена
         в отдельный метод.
         """
         self.nx_graph.add_node(
             model.id,
             label=model.label,
-            node_class=model.__class__.__name__,
+            node_class=model.node_class.__name__,
             id=model.id,
             status=NodeStatus.VISIBLE,
             peripheral=False,
@@ -474,8 +491,8 @@ class DpmGraph:
             in_cycle=False
         )
 
-    def _add_edge(self, source, dest, attr):
-        self.nx_graph.add_edge(source.id, dest.id, **{attr: True})
+    def _add_edge(self, source_id, dest_id, attr):
+        self.nx_graph.add_edge(source_id, dest_id, **{attr: True})
 
     def _recalc(self):
         """
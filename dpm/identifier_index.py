@@ -0,0 +1,155 @@
+"""
+Обратный индекс идентификаторов в sql-коде скриптов и компонентов.
+
+Код каждой ноды с sql (DBScript, ClientQuery) разбивается на
+идентификаторы: для цепочки вида БД.Схема.Название в индекс попадают
+все её части и все составные имена из идущих подряд частей (не больше
+трёх). Индекс хранится в ДПМ (IdentifierToken) и пересобирается для
+ноды только тогда, когда у неё меняется crc32 (IndexedText).
+
+С помощью индекса можно быстро найти ноды, в которых упоминается объект,
+не просматривая код всех нод; анализ связей проверяет регуляркой только
+те компоненты, в которых есть имя объекта.
+"""
+import re
+from sqlalchemy import and_, or_
+from .models import Node, ClientQuery, DBScript, IndexedText, IdentifierToken
+
+
+IDENTIFIER_CHAIN = re.compile(r"[\w@#$]+(?:\.[\w@#$]+)*")
+# имена, поиск которых по индексу гарантированно находит все упоминания
+INDEXABLE_NAME = re.compile(r"^[\w@#$]+$")
+MAX_QUALIFIED_PARTS = 3
+MAX_TOKEN_LENGTH = 400
+# сколько нод обрабатывать одним запросом
+CHUNK_SIZE = 500
+# сколько префиксов имён искать одним запросом (по два параметра на имя)
+PREFIX_CHUNK_SIZE = 200
+# верхняя граница строк, начинающихся с заданного префикса
+PREFIX_UPPER_BOUND = "\U0010ffff"
+
+
+def tokenize(sql):
+    """
+    Возвращает множество идентификаторов, встречающихся в тексте sql.
+    """
+    tokens = set()
+    for match in IDENTIFIER_CHAIN.finditer((sql or "").lower()):
+        parts = match.group(0).split(".")
+        for start in range(len(parts)):
+            for end in range(start + 1, min(start + MAX_QUALIFIED_PARTS, len(parts)) + 1):
+                tokens.add(".".join(parts[start:end])[:MAX_TOKEN_LENGTH])
+    return tokens
+
+
+def refresh_identifier_index(session, nodes=None):
+    """
+    Пересобирает идентификаторы нод, у которых изменилась crc32.
+
+    nodes - ноды с sql-кодом, которые нужно проверить (например, только что
+    синхронизированные); если не передано, проверяются все ноды в ДПМ,
+    а из индекса удаляются удалённые ноды.
+
+    Сначала читается индекс и разбирается код, и только затем пишутся
+    изменения (для nodes - вместе с flush сессии), так что транзакция записи
+    открывается на время самих запросов записи, а не разбора.
+    Возвращает количество пересобранных нод.
+    """
+    if nodes is None:
+        # несохранённых изменений в сессии обычно нет, и flush ничего не пишет
+        session.flush()
+        stale = []
+        for cls in (ClientQuery, DBScript):
+            stale.extend(
+                session.query(cls.id, cls.crc32, cls.sql)
+                .outerjoin(IndexedText, IndexedText.node_id == cls.id)
+                .filter(or_(IndexedText.node_id == None, IndexedText.crc32 != cls.crc32))
+                .all())
+        orphans = [
+            node_id for (node_id,) in
+            session.query(IndexedText.node_id).filter(~IndexedText.node_id.in_(session.query(Node.id)))]
+        parsed = [(node_id, crc32, tokenize(sql)) for node_id, crc32, sql in stale]
+    else:
+        # новые ноды ещё не записаны: у них нет id, и в индексе их нет
+        nodes = list(nodes)
+        indexed = {}
+        with session.no_autoflush:
+            for chunk in _chunks([node.id for node in nodes if node.id is not None]):
+                indexed.update(
+                    session.query(IndexedText.node_id, IndexedText.crc32)
+                    .filter(IndexedText.node_id.in_(chunk)))
+        parsed = [
+            (node, node.crc32, tokenize(node.sql))
+            for node in nodes
+            if node.id is None or indexed.get(node.id) != node.crc32]
+        orphans = []
+        session.flush()
+        parsed = [(node.id, crc32, tokens) for node, crc32, tokens in parsed if node.id is not None]
+    for chunk in _chunks(orphans):
+        _delete_tokens(session, chunk)
+    for chunk in _chunks(parsed):
+        _delete_tokens(session, [node_id for node_id, _, _ in chunk])
+        session.execute(IndexedText.__table__.insert(), [
+            {"node_id": node_id, "crc32": crc32} for node_id, crc32, _ in chunk])
+        rows = [
+            {"token": token, "node_id": node_id}
+            for node_id, _, tokens in chunk
+            for token in tokens]
+        if rows:
+            session.execute(IdentifierToken.__table__.insert(), rows)
+    return len(parsed)
+
+
+def find_mentions(session, identifier):
+    """
+    Возвращает запрос к нодам, в коде которых встречается идентификатор
+    identifier (Название, Схема.Название или БД.Схема.Название).
+    """
+    return session.query(Node).join(IdentifierToken, IdentifierToken.node_id == Node.id)\
+        .filter(IdentifierToken.token == identifier.lower())
+
+
+def candidates_for_names(session, names):
+    """
+    Возвращает словарь {имя: множество id нод}, в коде которых может
+    упоминаться объект с коротким именем из names: ищутся идентификаторы,
+    начинающиеся с имени, так как регулярки связей не требуют границы после
+    имени (insert, execute). Диапазоны всех имён проверяются одним запросом
+    на PREFIX_CHUNK_SIZE имён.
+    Если имя содержит символы, на которых разбивается код, индекс не может
+    ответить на вопрос и для него возвращается None.
+    """
+    result = {}
+    prefixes = {}
+    for name in names:
+        lowered = name.lower()
+        if INDEXABLE_NAME.match(lowered):
+            result[name] = set()
+            prefixes.setdefault(lowered, []).append(name)
+        else:
+            result[name] = None
+    ordered = sorted(prefixes)
+    for start in range(0, len(ordered), PREFIX_CHUNK_SIZE):
+        chunk = ordered[start:start + PREFIX_CHUNK_SIZE]
+        query = session.query(IdentifierToken.token, IdentifierToken.node_id).filter(or_(*(
+            and_(IdentifierToken.token >= prefix, IdentifierToken.token < prefix + PREFIX_UPPER_BOUND)
+            for prefix in chunk)))
+        chunk = set(chunk)
+        for token, node_id in query:
+            # токен подходит всем именам из пачки, которые являются его началом
+            for end in range(1, len(token) + 1):
+                if token[:end] in chunk:
+                    for name in prefixes[token[:end]]:
+                        result[name].add(node_id)
+    return result
+
+
+def _delete_tokens(session, ids):
+    session.query(IdentifierToken).filter(IdentifierToken.node_id.in_(ids)).delete(synchronize_session=False)
+    session.query(IndexedText).filter(IndexedText.node_id.in_(ids)).delete(synchronize_session=False)
+
+
+def _chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
@@ -0,0 +1,239 @@
+"""
+Анализ влияния набора изменений.
+
+Перед выкладкой релиза нужно знать, что затронет изменение сразу многих
+объектов БД (часто сотен процедур): какие АРМы, формы, компоненты и
+другие объекты от них зависят. Объекты задаются полными именами
+БД.Схема.Название (списком или файлом), разрешаются в ноды ДПМ одним
+запросом, после чего зависимые ноды ищутся одним обходом графа по
+предкам сразу от всех объектов (NodeStorage.get_closure) - время не
+зависит от количества объектов в списке. Если у хранилища есть индекс
+достижимости (как в GUI), зависимые ноды берутся из него, и обход идёт
+только по ним.
+
+Для каждой затронутой ноды в отчёте указывается длина кратчайшего пути
+от изменённых объектов и объект, от которого этот путь начинается.
+
+Использование:
+    report = analyze_impact(storage, read_identifiers("release.txt"))
+    print(report.report())
+    report.export_json("impact.json")
+"""
+import json
+from collections import deque, namedtuple
+from sqlalchemy import select, func
+from sqlalchemy.orm import aliased
+from . import models
+from .storage import CHUNK_SIZE
+
+
+# затронутая нода: id, подпись, класс, длина пути, id изменённого объекта, от которого идёт путь
+ImpactEntry = namedtuple("ImpactEntry", ["id", "label", "node_class", "depth", "origin"])
+
+# группы отчёта по классам нод
+GROUPS = [
+    ("АРМы", (models.Application,)),
+    ("Формы", (models.Form,)),
+    ("Компоненты", (models.ClientQuery,)),
+    ("Объекты БД", (models.DatabaseObject,)),
+]
+
+
+class ImpactException(Exception):
+    pass
+
+
+def parse_identifier(text):
+    """
+    Разбирает полное имя объекта БД.Схема.Название (допускаются имена
+    в квадратных скобках) в кортеж в нижнем регистре.
+    """
+    parts = [part.strip().strip("[]").lower() for part in text.strip().split(".")]
+    if len(parts) != 3 or not all(parts):
+        raise ImpactException(f"Ожидается полное имя объекта БД.Схема.Название, получено {text!r}")
+    return tuple(parts)
+
+
+def read_identifiers(path):
+    """
+    Читает полные имена объектов из файла: по одному на строку, пустые
+    строки и строки, начинающиеся с # или --, пропускаются.
+    """
+    with open(path, encoding="utf-8") as f:
+        return [
+            line.strip()
+            for line in f
+            if line.strip() and not line.strip().startswith(("#", "--"))
+        ]
+
+
+def resolve_objects(session, identifiers):
+    """
+    Находит объекты БД по полным именам. Возвращает пару: словарь
+    {полное имя: id ноды} в порядке identifiers и список имён, которые
+    не найдены в ДПМ.
+    Регистр везде приводится в Python (str.lower): имена ищутся по полю
+    Node.search_name, а база и схема сравниваются уже в результате.
+    """
+    keys = {}
+    for identifier in identifiers:
+        keys.setdefault(parse_identifier(identifier), identifier)
+    objects = models.DatabaseObject.__table__
+    nodes = models.Node.__table__
+    databases = aliased(models.Node.__table__)
+    query = select([objects.c.id, databases.c.name, objects.c.schema, nodes.c.name])\
+        .select_from(
+            objects
+            .join(nodes, nodes.c.id == objects.c.id)
+            .join(databases, databases.c.id == objects.c.database_id))
+    found = {}
+    names = sorted({key[2] for key in keys})
+    for start in range(0, len(names), CHUNK_SIZE):
+        chunk = names[start:start + CHUNK_SIZE]
+        for node_id, database, schema, name in session.execute(query.where(nodes.c.search_name.in_(chunk))):
+            key = (database.lower(), schema.lower(), name.lower())
+            if key in keys:
+                found[key] = node_id
+    resolved = {keys[key]: found[key] for key in keys if key in found}
+    missing = [keys[key] for key in keys if key not in found]
+    return resolved, missing
+
+
+def analyze_impact(storage, identifiers):
+    """
+    Строит отчёт о влиянии изменения объектов identifiers (полных имён).
+    storage - NodeStorage; если у него есть снимок связей, обход идёт в памяти,
+    а если есть и индекс достижимости - только по зависимым нодам из индекса.
+    """
+    resolved, missing = resolve_objects(storage.session, identifiers)
+    sources = list(dict.fromkeys(resolved.values()))
+    if storage.reachability is not None:
+        neighbours = storage.snapshot.parents_of(storage.reachability.reachable(sources))
+    else:
+        neighbours = storage.get_closure(sources, upwards=True).neighbours
+    traced = _trace(sources, neighbours)
+    labels = _describe(storage.session, [node_id for node_id in traced if node_id not in resolved.values()])
+    entries = [
+        ImpactEntry(node_id, label, node_class, traced[node_id][0], traced[node_id][1])
+        for node_id, (label, node_class) in labels.items()
+    ]
+    return ImpactReport(resolved, missing, entries)
+
+
+class ImpactReport:
+    """
+    Отчёт о влиянии изменений.
+
+    sources - словарь {полное имя: id ноды} изменённых объектов;
+    missing - имена, не найденные в ДПМ; entries - список ImpactEntry
+    затронутых нод (без самих изменённых объектов).
+    """
+
+    def __init__(self, sources, missing, entries):
+        self.sources = sources
+        self.missing = missing
+        self.entries = sorted(entries, key=lambda entry: (entry.depth, entry.label))
+        self.names = {node_id: name for name, node_id in sources.items()}
+
+    # region public methods
+    def grouped(self):
+        """
+        Затронутые ноды по группам: список пар (название группы, [ImpactEntry]).
+        """
+        groups = [(title, []) for title, _ in GROUPS]
+        for entry in self.entries:
+            groups[_group_of(entry.node_class)][1].append(entry)
+        return groups
+
+    def report(self):
+        """
+        Возвращает текстовый отчёт.
+        """
+        lines = [f"Изменённых объектов: {len(self.sources)}, затронуто нод: {len(self.entries)}"]
+        if self.missing:
+            lines.append(f"Не найдены в ДПМ ({len(self.missing)}): {', '.join(self.missing)}")
+        for title, entries in self.grouped():
+            lines.append("")
+            lines.append(f"{title} ({len(entries)}):")
+            for entry in entries:
+                lines.append(f"    {entry.depth:>3}  {entry.label}  <- {self.names[entry.origin]}")
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            "sources": self.sources,
+            "missing": self.missing,
+            "impact": {
+                title: [
+                    dict(entry._asdict(), origin=self.names[entry.origin])
+                    for entry in entries
+                ]
+                for title, entries in self.grouped()
+            },
+        }
+
+    def export_json(self, path):
+        """
+        Сохраняет отчёт в JSON-файл path.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+    # endregion
+
+
+def _trace(sources, neighbours):
+    """
+    Обход в ширину сразу от всех sources по уже загруженным соседям:
+    возвращает словарь {id ноды: (длина пути, id объекта, от которого путь)}.
+    При равной длине пути побеждает объект, стоящий в списке раньше.
+    """
+    traced = {node_id: (0, node_id) for node_id in sources}
+    queue = deque(sources)
+    while queue:
+        node_id = queue.popleft()
+        depth, origin = traced[node_id]
+        for neighbour_id, _ in neighbours.get(node_id, []):
+            if neighbour_id not in traced:
+                traced[neighbour_id] = (depth + 1, origin)
+                queue.append(neighbour_id)
+    return traced
+
+
+def _describe(session, ids):
+    """
+    Подписи и классы нод одним запросом на пачку id: словарь
+    {id: (подпись, имя класса)}. У объектов БД подпись - полное имя,
+    у компонентов - имя формы и компонента.
+    """
+    nodes = models.Node.__table__
+    objects = models.DatabaseObject.__table__
+    components = models.ClientQuery.__table__
+    owners = aliased(models.Node.__table__)
+    query = select([nodes.c.id, nodes.c.name, nodes.c.type, objects.c.schema, owners.c.name])\
+        .select_from(
+            nodes
+            .outerjoin(objects, objects.c.id == nodes.c.id)
+            .outerjoin(components, components.c.id == nodes.c.id)
+            .outerjoin(owners, owners.c.id == func.coalesce(objects.c.database_id, components.c.form_id)))
+    polymorphic_map = models.Node.__mapper__.polymorphic_map
+    result = {}
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[start:start + CHUNK_SIZE]
+        for node_id, name, node_type, schema, owner in session.execute(query.where(nodes.c.id.in_(chunk))):
+            if schema is not None:
+                label = f"{owner}.{schema}.{name}"
+            elif owner is not None:
+                label = f"{owner}.{name}"
+            else:
+                label = name
+            mapper = polymorphic_map.get(node_type)
+            result[node_id] = (label, models.Node.__name__ if mapper is None else mapper.class_.__name__)
+    return result
+
+
+def _group_of(node_class):
+    for number, (_, classes) in enumerate(GROUPS):
+        for cls in classes:
+            if node_class in {mapper.class_.__name__ for mapper in cls.__mapper__.self_and_descendants}:
+                return number
+    return len(GROUPS) - 1
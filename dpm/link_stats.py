@@ -0,0 +1,174 @@
+"""
+Статистика анализа связей.
+
+Во время анализа (см. dpm.linking.analize_links) можно собрать, сколько
+времени ушло на каждый объект и каждый скрипт, сколько раз в коде
+встретилось имя объекта (кандидаты на совпадение), сколько совпадений
+нашлось и сколько времени заняла компиляция регулярок. По статистике
+строится отчёт о самых дорогих объектах и скриптах: например, таблица
+с именем id или log встречается почти в каждом скрипте.
+"""
+import json
+
+
+class ObjectStats:
+    """
+    Статистика одного объекта, который ищется в коде.
+
+    scripts - в скольких скриптах встретилось имя объекта;
+    candidates - сколько всего было вхождений имени;
+    matches - в скольких скриптах объект действительно упоминается;
+    seconds - время проверки вхождений;
+    compile_seconds - время компиляции регулярки (только для имён
+    со спецсимволами, см. dpm.scanner).
+    """
+
+    def __init__(self):
+        self.scripts = 0
+        self.candidates = 0
+        self.matches = 0
+        self.seconds = 0.0
+        self.compile_seconds = 0.0
+
+    def merge(self, other):
+        for field, value in vars(other).items():
+            setattr(self, field, getattr(self, field) + value)
+
+
+class ScriptStats:
+    """
+    Статистика одного скрипта или компонента.
+
+    length - длина кода; names - сколько разных имён объектов в нём
+    встретилось; candidates - сколько всего было вхождений имён;
+    matches - сколько объектов в нём упоминается; seconds - время разбора.
+    """
+
+    def __init__(self):
+        self.length = 0
+        self.names = 0
+        self.candidates = 0
+        self.matches = 0
+        self.seconds = 0.0
+
+    def merge(self, other):
+        for field, value in vars(other).items():
+            setattr(self, field, getattr(self, field) + value)
+
+
+class LinkStats:
+    """
+    Статистика анализа связей: словари {id ноды: ObjectStats/ScriptStats},
+    общие счётчики и подписи нод для отчёта.
+
+    Использование:
+        stats = LinkStats()
+        analize_links(session, conn, stats=stats, dry_run=True)
+        print(stats.report(top=20))
+        stats.export_json("links.json")
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.scripts = {}
+        self.labels = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.seconds = {}
+
+    # region public methods
+    def object(self, node_id):
+        if node_id not in self.objects:
+            self.objects[node_id] = ObjectStats()
+        return self.objects[node_id]
+
+    def script(self, node_id):
+        if node_id not in self.scripts:
+            self.scripts[node_id] = ScriptStats()
+        return self.scripts[node_id]
+
+    def add_time(self, stage, seconds):
+        """
+        Добавляет время этапа анализа (загрузка, разбор, запись и т.д.).
+        """
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def merge(self, other):
+        """
+        Добавляет статистику other (например, собранную в дочернем процессе).
+        """
+        for node_id, item in other.objects.items():
+            self.object(node_id).merge(item)
+        for node_id, item in other.scripts.items():
+            self.script(node_id).merge(item)
+        self.labels.update(other.labels)
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+        for stage, seconds in other.seconds.items():
+            self.add_time(stage, seconds)
+
+    def top_objects(self, top=20):
+        """
+        Самые дорогие объекты: список пар (id, ObjectStats) по убыванию времени.
+        """
+        return self._top(self.objects, top)
+
+    def top_scripts(self, top=20):
+        """
+        Самые дорогие скрипты: список пар (id, ScriptStats) по убыванию времени.
+        """
+        return self._top(self.scripts, top)
+
+    def report(self, top=20):
+        """
+        Возвращает текстовый отчёт о top самых дорогих объектах и скриптах.
+        """
+        lines = ["Этапы анализа связей:"]
+        for stage, seconds in self.seconds.items():
+            lines.append(f"    {stage:<20} {seconds:>10.3f} с")
+        lines.append(f"Кэш упоминаний: разобрано текстов {self.cache_misses}, взято из кэша {self.cache_hits}")
+        lines.append("")
+        lines.append(f"Самые дорогие объекты (top {top}):")
+        lines.append(f"    {'время, с':>10} {'компиляция, с':>14} {'скриптов':>9} {'вхождений':>10} {'совпадений':>11}  объект")
+        for node_id, item in self.top_objects(top):
+            lines.append(
+                f"    {item.seconds:>10.3f} {item.compile_seconds:>14.3f} {item.scripts:>9} "
+                f"{item.candidates:>10} {item.matches:>11}  {self.label(node_id)}")
+        lines.append("")
+        lines.append(f"Самые дорогие скрипты (top {top}):")
+        lines.append(f"    {'время, с':>10} {'длина':>9} {'имён':>6} {'вхождений':>10} {'совпадений':>11}  скрипт")
+        for node_id, item in self.top_scripts(top):
+            lines.append(
+                f"    {item.seconds:>10.3f} {item.length:>9} {item.names:>6} "
+                f"{item.candidates:>10} {item.matches:>11}  {self.label(node_id)}")
+        return "\n".join(lines)
+
+    def label(self, node_id):
+        return self.labels.get(node_id, f"#{node_id}")
+
+    def to_dict(self):
+        return {
+            "seconds": self.seconds,
+            "cache": {"hits": self.cache_hits, "misses": self.cache_misses},
+            "objects": [
+                dict(id=node_id, label=self.label(node_id), **vars(item))
+                for node_id, item in self._top(self.objects, None)],
+            "scripts": [
+                dict(id=node_id, label=self.label(node_id), **vars(item))
+                for node_id, item in self._top(self.scripts, None)],
+        }
+
+    def export_json(self, path):
+        """
+        Сохраняет статистику в JSON-файл path.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+    # endregion
+
+    # region utility methods
+    @staticmethod
+    def _top(items, top):
+        ordered = sorted(items.items(), key=lambda pair: pair[1].seconds, reverse=True)
+        return ordered if top is None else ordered[:top]
+    # endregion
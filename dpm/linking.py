@@ -1,50 +1,362 @@
-import re
-from .models import Edge, DBScript, ClientQuery, DatabaseObject, DBTrigger
-from sqlalchemy.sql import text
-from sqlalchemy import or_
+from .models import Node, Edge, DBScript, DBTable, ClientQuery, DatabaseObject, DBTrigger
+from .scanner import target_from_object, script_from_node
+from .reference_cache import scan_with_cache
+from .identifier_index import refresh_identifier_index, candidates_for_names
+from sqlalchemy import text
+from sqlalchemy.orm import undefer
 import logging
-import itertools
-from sqlalchemy.exc import ProgrammingError, DBAPIError
-
-
-def analize_links(session, conn):
-    components = session.query(ClientQuery).filter(or_(ClientQuery.last_revision == None, ClientQuery.last_update > ClientQuery.last_revision)).all()
-    all_objects = session.query(DatabaseObject).filter(or_(DBScript.last_revision == None, DBScript.last_update > DBScript.last_revision)).all()
-    script_name = ""
-    obj_name = ""
-    for obj in all_objects:
-        # ToDo отрезать триггеры, у них не должно в принципе метода формирования регулярки
-        if isinstance(obj, DBTrigger):
+import sqlite3
+import time
+
+
+# добавление связи или обновление действий у существующей
+UPSERT_EDGE = text('''
+    INSERT INTO "Edge" (sourse_id, dest_id, operations, is_verified, is_broken, is_dummy)
+    VALUES (:sourse_id, :dest_id, :operations, 0, 0, 0)
+    ON CONFLICT (sourse_id, dest_id) DO UPDATE SET operations = excluded.operations
+    WHERE NOT "Edge".is_verified AND NOT "Edge".is_broken''')
+# сколько нод запрашивать из ДПМ за раз
+CHUNK_SIZE = 500
+
+
+def analize_links(session, conn, database=None, processes=None, stats=None, dry_run=False):
+    """
+    Обновляет связи скриптов и компонентов с объектами БД.
+
+    Анализ инкрементальный: изменившиеся скрипты и компоненты (у которых
+    last_revision пустая или меньше last_update) проверяются на все объекты,
+    а новые и изменившиеся объекты - на все скрипты и компоненты.
+    Если ничего не изменилось, анализ заканчивается, не загружая объекты.
+    Найденные связи сравниваются с сохранёнными: добавляются только новые,
+    у остальных при необходимости правятся действия, пропавшие удаляются;
+    подтверждённые (is_verified) и сломанные (is_broken) связи не трогаются.
+    В конце обработанным нодам ставится last_revision, равная last_update.
+
+    Если передана database, то анализируются только объекты этой базы
+    (conn должно быть соединением именно с ней). Компоненты в этом случае
+    проверяются только на объекты этой базы, поэтому их last_revision
+    ставит stamp_components после анализа всех баз; при database=None
+    это делается сразу.
+
+    Новые объекты проверяются только на скрипты и компоненты, в коде
+    которых есть их имена (см. dpm.identifier_index), и на скрипты, которые
+    зависят от них по системным зависимостям (см. SystemDependencyIndex).
+    Код загружается только у проверяемых скриптов и компонентов, а из
+    сохранённых связей читаются только связи изменившихся нод.
+    Упоминания объектов в одинаковом коде ищутся один раз и запоминаются
+    в ДПМ (см. dpm.reference_cache).
+
+    Изменения связей сохраняются пачками вместе с контрольными точками
+    базы, к объектам которой они ведут. Повторный анализ после падения
+    находит уже сохранённые связи и не создаёт их заново.
+    Всё, что нужно прочитать и разобрать, готовится до записи: индекс
+    идентификаторов обновляется и коммитится в начале короткой отдельной
+    транзакцией, а сохранённые связи читаются до разбора кода, так что
+    транзакция записи связей не ждёт ни разбора, ни чтения.
+    processes - сколько процессов использовать для разбора кода (по
+    умолчанию 1) или общий для нескольких анализов ScanPool (см.
+    dpm.scanner.scan_scripts).
+    stats - LinkStats, в который собирается время этапов и статистика
+    по каждому объекту и скрипту (см. dpm.link_stats).
+    dry_run - если True, связи только вычисляются: ни связи, ни
+    last_revision нод, ни кэш упоминаний, ни индекс идентификаторов
+    не записываются. Код, изменившийся после построения индекса, есть
+    только у изменившихся нод, а они и так проверяются на все объекты.
+
+    Возвращает словарь изменений: added и updated - списки кортежей
+    (id источника, id объекта, множество действий), deleted - список
+    пар (id источника, id объекта).
+    """
+    # импорт здесь, чтобы модель ДПМ не зависела от пакета синхронизации
+    from sync.checkpoints import CheckpointJournal
+    from sync.original_models import SystemDependencyIndex
+    journals = {}
+
+    def journal_for(db):
+        if db.id not in journals:
+            journals[db.id] = CheckpointJournal(session, db, "links", db.last_update, batch_size=100, expire_on_commit=False)
+        return journals[db.id]
+
+    clock = time.perf_counter()
+
+    def lap(stage):
+        nonlocal clock
+        now = time.perf_counter()
+        if stats is not None:
+            stats.add_time(stage, now - clock)
+        clock = now
+
+    if not dry_run:
+        # индекс нужен для поиска кандидатов ниже, поэтому он записывается
+        # сразу, не дожидаясь записи связей
+        refresh_identifier_index(session)
+        remove_orphan_edges(session)
+        session.commit()
+    scripts_query = session.query(DBScript)
+    tables_query = session.query(DBTable)
+    if database is not None:
+        scripts_query = scripts_query.filter(DBScript.database_id == database.id)
+        tables_query = tables_query.filter(DBTable.database_id == database.id)
+    # код загружается только у изменившихся скриптов и компонентов
+    changed_scripts = scripts_query.options(undefer("sql")).filter(stale_condition(DBScript)).all()
+    changed_components = session.query(ClientQuery).options(undefer("sql"))\
+        .filter(stale_condition(ClientQuery)).all()
+    # ToDo отрезать триггеры, у них не должно в принципе метода формирования регулярки
+    new_targets = [script for script in changed_scripts if not isinstance(script, DBTrigger)] + \
+        tables_query.filter(stale_condition(DBTable)).all()
+    logging.info(
+        f"Анализ связей: изменилось скриптов {len(changed_scripts)}, компонентов {len(changed_components)}, "
+        f"новых и изменившихся объектов {len(new_targets)}")
+    changes = {"added": [], "updated": [], "deleted": []}
+    if not (changed_scripts or changed_components or new_targets):
+        if database is not None and not dry_run:
+            database.last_revision = database.last_update
+        lap("загрузка")
+        return changes
+
+    scripts = scripts_query.all()
+    targets = [script for script in scripts if not isinstance(script, DBTrigger)] + tables_query.all()
+    target_ids = {obj.id for obj in targets}
+
+    # allowed - какие объекты искать в каком скрипте; None - все объекты
+    allowed = {}
+    for node in changed_scripts + changed_components:
+        allowed[node] = None
+    if new_targets:
+        dependencies = SystemDependencyIndex.fetch(conn)
+        scripts_by_id = {(script.database_id, script.database_object_id): script for script in scripts}
+        referencing = {}
+        for obj in new_targets:
+            for referencing_id in dependencies.referencing(obj.database_object_id):
+                script = scripts_by_id.get((obj.database_id, referencing_id))
+                if script is not None:
+                    referencing.setdefault(script.id, set()).add(obj)
+        mentioning = _sources_for_objects(
+            session, scripts_query.options(undefer("sql")), DBScript, new_targets, referencing)
+        mentioning.update(_sources_for_objects(
+            session, session.query(ClientQuery).options(undefer("sql")), ClientQuery, new_targets))
+        for node, objects in mentioning.items():
+            if node not in allowed:
+                allowed[node] = set()
+            if allowed[node] is not None:
+                allowed[node].update(objects)
+
+    # найденные связи сравниваются с сохранёнными; пересчитаны только связи
+    # изменившихся скриптов и связи, ведущие к изменившимся объектам;
+    # сохранённые связи читаются до разбора и записи кэша
+    changed_sources = {node.id for node in changed_scripts} | {node.id for node in changed_components}
+    new_target_ids = {obj.id for obj in new_targets}
+
+    def in_scope(source_id, dest_id):
+        return dest_id in target_ids and (source_id in changed_sources or dest_id in new_target_ids)
+
+    # связи читаются без ORM-объектов: изменения пишутся запросами
+    # (upsert_edges), и объекты в сессии остались бы устаревшими
+    stored = {}
+    manual = set()
+    for sourse_id, dest_id, mask, is_verified, is_broken in _scoped_edges(session, changed_sources, new_target_ids, database):
+        pair = (sourse_id, dest_id)
+        if not in_scope(*pair):
+            continue
+        if is_verified or is_broken:
+            manual.add(pair)
+        else:
+            stored[pair] = mask
+
+    if stats is not None:
+        stats.labels.update((obj.id, obj.full_name) for obj in targets)
+        stats.labels.update((node.id, node.full_name) for node in allowed if isinstance(node, DBScript))
+        stats.labels.update(
+            (node.id, f"{node.name} (форма {node.form_id})") for node in allowed if isinstance(node, ClientQuery))
+    lap("загрузка")
+
+    # каждый текст просматривается один раз на все объекты сразу,
+    # уже разобранные тексты берутся из кэша
+    found = {
+        (script_id, target_id): actions
+        for script_id, target_id, actions in scan_with_cache(
+            session,
+            [target_from_object(obj) for obj in targets],
+            [script_from_node(script, objects) for script, objects in allowed.items()],
+            processes, stats, store=not dry_run)
+    }
+    lap("разбор")
+
+    # изменения группируются по объекту, к которому ведут связи
+    operations = {}
+    for pair, actions in found.items():
+        mask = Edge.operations_mask(actions)
+        if pair not in manual and stored.get(pair) != mask:
+            operations.setdefault(pair[1], []).append((pair, mask))
+    for pair in stored:
+        if pair not in found:
+            operations.setdefault(pair[1], []).append((pair, None))
+
+    for obj in targets:
+        if obj.id not in operations:
+            continue
+        if not dry_run:
+            journal = journal_for(obj.database)
+            if journal.is_done("objects", str(obj.id)):
+                continue
+        rows = []
+        removed = []
+        for pair, mask in operations[obj.id]:
+            if mask is None:
+                removed.append(pair[0])
+                changes["deleted"].append(pair)
+                continue
+            rows.append({"sourse_id": pair[0], "dest_id": pair[1], "operations": mask})
+            if pair in stored:
+                changes["updated"].append(pair + (found[pair],))
+            else:
+                changes["added"].append(pair + (found[pair],))
+                logging.debug(f"Связь {found[pair]} {pair[0]} -> {obj.name}")
+        if dry_run:
+            continue
+        upsert_edges(session, rows)
+        if removed:
+            session.query(Edge).filter(
+                Edge.dest_id == obj.id,
+                Edge.sourse_id.in_(removed)
+            ).delete(synchronize_session=False)
+        journal.mark_done("objects", str(obj.id))
+    lap("запись связей")
+    logging.info(
+        f"Анализ связей{' (без записи)' if dry_run else ''}: добавлено {len(changes['added'])}, "
+        f"изменено {len(changes['updated'])}, удалено {len(changes['deleted'])}")
+    if dry_run:
+        return changes
+
+    for node in new_targets + changed_scripts:
+        node.last_revision = node.last_update
+    if database is not None:
+        database.last_revision = database.last_update
+    else:
+        stamp_components(session, changed_components)
+    for journal in journals.values():
+        journal.finish()
+    lap("отметки")
+    return changes
+
+
+def upsert_edges(session, rows):
+    """
+    Записывает автоматически найденные связи: rows - список словарей
+    с ключами sourse_id, dest_id и operations (маска действий).
+    Если связь между нодами уже есть, у неё обновляется маска, но
+    подтверждённые и сломанные связи не меняются.
+    """
+    if not rows:
+        return
+    if session.bind.dialect.name == "sqlite" and sqlite3.sqlite_version_info >= (3, 24):
+        session.execute(UPSERT_EDGE, rows)
+        return
+    # без ON CONFLICT: сначала пробуем обновить, затем добавляем недостающие
+    table = Edge.__table__
+    for row in rows:
+        result = session.execute(
+            table.update()
+            .where(table.c.sourse_id == row["sourse_id"])
+            .where(table.c.dest_id == row["dest_id"])
+            .where(table.c.is_verified == False)
+            .where(table.c.is_broken == False)
+            .values(operations=row["operations"]))
+        if result.rowcount == 0:
+            exists = session.query(Edge.id).filter(
+                Edge.sourse_id == row["sourse_id"], Edge.dest_id == row["dest_id"]).first()
+            if exists is None:
+                session.execute(table.insert().values(
+                    is_verified=False, is_broken=False, is_dummy=False, **row))
+
+
+def remove_orphan_edges(session):
+    """
+    Удаляет связи, ведущие от удалённых нод или к ним. Такие связи
+    остаются, когда нода удаляется при синхронизации: связи у нод
+    не подгружаются (passive_deletes), а SQLite по умолчанию не
+    проверяет внешние ключи.
+    """
+    node_ids = session.query(Node.id)
+    removed = session.query(Edge).filter(
+        ~Edge.sourse_id.in_(node_ids) | ~Edge.dest_id.in_(node_ids)
+    ).delete(synchronize_session=False)
+    if removed:
+        logging.info(f"Удалено связей с удалёнными нодами: {removed}")
+    return removed
+
+
+def stamp_components(session, components=None):
+    """
+    Ставит изменившимся компонентам last_revision, равную last_update,
+    после того как они проверены на объекты всех баз.
+    """
+    if components is None:
+        components = session.query(ClientQuery).filter(stale_condition(ClientQuery)).all()
+    for component in components:
+        component.last_revision = component.last_update
+
+
+def is_stale(node):
+    """
+    Возвращает True, если связи ноды нужно пересчитать.
+    """
+    return node.last_revision is None or (node.last_update is not None and node.last_update > node.last_revision)
+
+
+def stale_condition(cls):
+    """
+    Условие на запрос к нодам класса cls, связи которых нужно пересчитать.
+    """
+    return (cls.last_revision == None) | (cls.last_update > cls.last_revision)
+
+
+def _scoped_edges(session, sources, dests, database=None):
+    """
+    Возвращает строки (sourse_id, dest_id, operations, is_verified, is_broken)
+    связей, которые ведут от нод sources или к нодам dests и заканчиваются
+    на объекте БД (если задана database - на объекте этой базы).
+    """
+    query = session.query(Edge.sourse_id, Edge.dest_id, Edge.operations, Edge.is_verified, Edge.is_broken)\
+        .join(DatabaseObject, Edge.dest_id == DatabaseObject.id)
+    if database is not None:
+        query = query.filter(DatabaseObject.database_id == database.id)
+    rows = {}
+    for column, ids in ((Edge.sourse_id, sources), (Edge.dest_id, dests)):
+        ids = list(ids)
+        for start in range(0, len(ids), CHUNK_SIZE):
+            for row in query.filter(column.in_(ids[start:start + CHUNK_SIZE])):
+                rows[(row[0], row[1])] = row
+    return list(rows.values())
+
+
+def _sources_for_objects(session, query, cls, objects, candidates=None):
+    """
+    Возвращает словарь {нода: множество объектов} для нод из запроса query
+    (скриптов или компонентов класса cls), в коде которых по индексу
+    идентификаторов могут упоминаться объекты. candidates - заранее
+    известные кандидаты {id ноды: множество объектов}, они дополняются.
+    """
+    candidates = {node_id: set(found) for node_id, found in (candidates or {}).items()}
+    if not objects:
+        return {}
+    check_all = []
+    ids_by_name = candidates_for_names(session, {obj.name for obj in objects})
+    for obj in objects:
+        ids = ids_by_name[obj.name]
+        if ids is None:
+            # имя не разбирается индексом, проверяем все ноды запроса
+            check_all.append(obj)
             continue
-        try:
-            obj_name = obj.name
-            query = text("select referencing_id from sys.dm_sql_referencing_entities(:long_name, 'OBJECT')")
-            refs = conn.execute(query, long_name=obj.long_name)
-            ids = [row[0] for row in refs]
-            scripts = [obj for obj in all_objects if obj.database_object_id in ids and isinstance(obj,DBScript)]
-            # ToDo изменить способ работы с компонентами хранимых процедур, у них должно быть поле proc_name или как-то так
-            home_regexp = re.compile(obj.get_regexp_for_home_db())
-            foreign_regexp = re.compile(obj.get_regexp_for_foreign_db())
-            for script in itertools.chain(scripts, components):
-                script_name = script.name
-                if obj.database == script.database:
-                    regexp = home_regexp
-                else:
-                    regexp = foreign_regexp
-                edge_template = {}
-                
-                for match in regexp.finditer(script.sql):
-                    edge_template[match.lastgroup] = True
-                if len(edge_template) > 0:
-                    edge = Edge(sourse=script, dest=obj)
-                    for key in edge_template:
-                        setattr(edge, key, True)
-                    session.add(edge)
-                    logging.info(f"Связь {edge_template} {script.name} -> {obj.name}")
-        except (DBAPIError, ProgrammingError, KeyError) as e:
-            if isinstance(e,KeyError):
-                print(f"KeyError - {script_name}")
-            logging.warning(f"Ошибка: {e}")
-    
-        
- 
\ No newline at end of file
+        for node_id in ids:
+            candidates.setdefault(node_id, set()).add(obj)
+    result = {}
+    if check_all:
+        for node in query:
+            result[node] = set(check_all) | candidates.get(node.id, set())
+        return result
+    ids = list(candidates)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        for node in query.filter(cls.id.in_(ids[start:start + CHUNK_SIZE])):
+            result[node] = candidates[node.id]
+    return result
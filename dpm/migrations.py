@@ -0,0 +1,151 @@
+"""
+Миграции схемы ДПМ.
+
+Версия схемы хранится в PRAGMA user_version файла ДПМ. Новая ДПМ
+создаётся сразу в последней версии (BaseDPM.metadata.create_all), для
+уже существующей по порядку выполняются все миграции, номер которых
+больше её версии. Миграция - функция, получающая соединение; все
+миграции выполняются в одной транзакции.
+
+Миграции описывают схему явным SQL, а не через модели, потому что модели
+со временем меняются, а миграция должна приводить старый файл именно
+к той версии схемы, для которой она написана.
+"""
+import logging
+from sqlalchemy import text
+from .models import BaseDPM
+
+
+class MigrationException(Exception):
+    pass
+
+
+def migrate_edge_operations(connection):
+    """
+    Версия 1: действия связи хранятся битовой маской operations вместо
+    отдельных логических полей, связь между двумя нодами уникальна,
+    добавлены покрывающие индексы для обхода графа в обе стороны.
+    Дубли связей сливаются в одну: действия и признаки объединяются.
+    """
+    connection.execute('ALTER TABLE "Edge" RENAME TO "Edge_v0"')
+    connection.execute('''
+        CREATE TABLE "Edge" (
+            id INTEGER NOT NULL,
+            sourse_id INTEGER NOT NULL,
+            dest_id INTEGER NOT NULL,
+            comment TEXT,
+            is_verified BOOLEAN NOT NULL,
+            is_broken BOOLEAN NOT NULL,
+            is_dummy BOOLEAN NOT NULL,
+            operations INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            CONSTRAINT uq_Edge_sourse_dest UNIQUE (sourse_id, dest_id),
+            FOREIGN KEY(sourse_id) REFERENCES "Node" (id),
+            FOREIGN KEY(dest_id) REFERENCES "Node" (id),
+            CHECK (is_verified IN (0, 1)),
+            CHECK (is_broken IN (0, 1)),
+            CHECK (is_dummy IN (0, 1))
+        )''')
+    connection.execute('''
+        INSERT INTO "Edge" (id, sourse_id, dest_id, comment, is_verified, is_broken, is_dummy, operations)
+        SELECT
+            min(id), sourse_id, dest_id, max(comment),
+            max(is_verified), max(is_broken), max(is_dummy),
+            max(calc) * 1 | max("select") * 2 | max("insert") * 4 | max("update") * 8
+            | max("delete") * 16 | max("exec") * 32 | max("truncate") * 64 | max("drop") * 128
+        FROM "Edge_v0"
+        GROUP BY sourse_id, dest_id''')
+    connection.execute('DROP TABLE "Edge_v0"')
+    connection.execute('CREATE INDEX "ix_Edge_sourse" ON "Edge" (sourse_id, dest_id, operations, is_broken)')
+    connection.execute('CREATE INDEX "ix_Edge_dest" ON "Edge" (dest_id, sourse_id, operations, is_broken)')
+
+
+# индекс поиска нод по имени без учёта регистра (версия 2)
+SEARCH_NAME_INDEX = ("ix_Node_search_name", '"Node" (search_name)')
+
+
+def migrate_search_name(connection):
+    """
+    Версия 2: имя ноды в нижнем регистре хранится в поле search_name
+    с индексом. lower() в SQLite приводит к нижнему регистру только
+    латиницу, а имена из запроса приводятся в Python, поэтому поле
+    заполняется здесь же, через str.lower.
+    """
+    columns = [row[1] for row in connection.execute('PRAGMA table_info("Node")')]
+    if "search_name" not in columns:
+        connection.execute('ALTER TABLE "Node" ADD COLUMN search_name VARCHAR(120)')
+    rows = connection.execute('SELECT id, name FROM "Node"').fetchall()
+    if rows:
+        connection.execute(
+            text('UPDATE "Node" SET search_name = :search_name WHERE id = :id'),
+            [{"id": node_id, "search_name": name.lower()} for node_id, name in rows])
+    name, definition = SEARCH_NAME_INDEX
+    connection.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON {definition}')
+
+
+# индексы для частых поисков при синхронизации и просмотре (версия 3):
+# имя и определение; те же индексы объявлены в моделях
+LOOKUP_INDEXES = [
+    ("ix_Node_type", '"Node" (type)'),
+    ("ix_DatabaseObject_database", '"DatabaseObject" (database_id, database_object_id)'),
+    ("ix_Form_path", '"Form" (path)'),
+    ("ix_ClientQuery_form", '"ClientQuery" (form_id)'),
+    ("ix_DBTrigger_table", '"DBTrigger" (table_id)'),
+    ("ix_AppsAndForms_application", '"AppsAndForms" (application_id, form_id)'),
+    ("ix_AppsAndForms_form", '"AppsAndForms" (form_id, application_id)'),
+    ("ix_SyncCheckpoint_node", '"SyncCheckpoint" (node_id, stage)'),
+]
+
+
+def migrate_lookup_indexes(connection):
+    """
+    Версия 3: индексы для поиска форм по пути, объектов БД по object_id,
+    нод по классу, компонентов формы, триггеров таблицы и т.д.
+    (LOOKUP_INDEXES); без них все эти поиски читают таблицы целиком.
+    """
+    for name, definition in LOOKUP_INDEXES:
+        connection.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON {definition}')
+
+
+# миграции по порядку; версия схемы - количество выполненных миграций
+MIGRATIONS = [
+    migrate_edge_operations,
+    migrate_search_name,
+    migrate_lookup_indexes,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(connection):
+    return connection.execute("PRAGMA user_version").scalar()
+
+
+def set_version(connection, version):
+    # PRAGMA не поддерживает параметры запроса
+    connection.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def prepare_dpm(engine):
+    """
+    Готовит файл ДПМ к работе: создаёт недостающие таблицы и приводит
+    схему к последней версии. Возвращает версию схемы до миграции.
+    """
+    if engine.dialect.name != "sqlite":
+        # версия схемы хранится только в файлах SQLite
+        BaseDPM.metadata.create_all(engine)
+        return SCHEMA_VERSION
+    with engine.begin() as connection:
+        existing = engine.dialect.has_table(connection, "Node")
+        version = get_version(connection) if existing else SCHEMA_VERSION
+        if version > SCHEMA_VERSION:
+            raise MigrationException(
+                f"Версия схемы ДПМ ({version}) новее, чем поддерживает программа ({SCHEMA_VERSION})")
+        BaseDPM.metadata.create_all(connection)
+        for number in range(version, SCHEMA_VERSION):
+            logging.info(f"Миграция ДПМ до версии {number + 1}")
+            MIGRATIONS[number](connection)
+        set_version(connection, SCHEMA_VERSION)
+    return version
+
+
+__all__ = ["prepare_dpm", "MigrationException", "SCHEMA_VERSION", "SEARCH_NAME_INDEX", "LOOKUP_INDEXES"]
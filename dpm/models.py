@@ -1,10 +1,13 @@
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Text, Boolean, SmallInteger
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Text, Boolean, SmallInteger, Index, UniqueConstraint
+from sqlalchemy import select, null, and_, event
 from sqlalchemy.orm import deferred, relationship
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.schema import Table
 import datetime
 import itertools
+import json
 
 BaseDPM = declarative_base()
 
@@ -13,6 +16,44 @@ class ModelException(Exception):
     pass
 
 
+# битовые маски действий, которые объект sourse выполняет с объектом dest
+# (поле Edge.operations); значения хранятся в ДПМ, их нельзя менять
+EDGE_OPERATIONS = {
+    "calc": 1,
+    "select": 2,
+    "insert": 4,
+    "update": 8,
+    "delete": 16,
+    "exec": 32,
+    "truncate": 64,
+    "drop": 128,
+}
+
+
+def operation_property(name):
+    """
+    Логическое свойство связи для одного действия, хранящегося
+    битом в Edge.operations. В запросах Edge.select и т.п. превращается
+    в проверку бита.
+    """
+    bit = EDGE_OPERATIONS[name]
+
+    def getter(self):
+        return bool((self.operations or 0) & bit)
+
+    def setter(self, value):
+        if value:
+            self.operations = (self.operations or 0) | bit
+        else:
+            self.operations = (self.operations or 0) & ~bit
+
+    def expression(cls):
+        return cls.operations.op("&")(bit) != 0
+
+    getter.__name__ = name
+    return hybrid_property(getter, setter, expr=expression)
+
+
 class Node(BaseDPM):
     """
     Компоненты исследуемой информационной системы, которые
@@ -28,6 +69,15 @@ class Node(BaseDPM):
     type = Column(String(50))
     id_broken = Column(Boolean, default=False, nullable=False)
     is_dummy = Column(Boolean, default=False, nullable=False)
+    # имя в нижнем регистре для поиска без учёта регистра (см. dpm.impact);
+    # приводится в Python, потому что lower() в SQLite знает только латиницу
+    search_name = Column(String(120))
+
+    __table_args__ = (
+        # ноды одного класса (выборка связей, загрузка с подклассами)
+        Index("ix_Node_type", "type"),
+        Index("ix_Node_search_name", "search_name"),
+    )
 
     __mapper_args__ = {
         "polymorphic_on": "type",
@@ -69,27 +119,61 @@ class Node(BaseDPM):
         """
         Возвращает подпись, которую будет иметь нода при обработке графа.
         """
-        return self.name
+        return self.make_label(self.id, self.name)
+
+    @classmethod
+    def make_label(cls, node_id, name):
+        """
+        Подпись ноды этого класса по её id и названию; нужна, чтобы
+        подписывать ноды без загрузки моделей (NodeStorage.get_headers).
+        """
+        return name
+
+    @property
+    def node_class(self):
+        """
+        Класс модели; то же поле есть у NodeHeader.
+        """
+        return self.__class__
     
     def get_children(self):
         return []
     
     def get_parents(self):
         return []
-    
-    def get_recommended_loading_depth(self):
+
+    @classmethod
+    def select_children(cls, ids):
         """
-        Возвращает кортеж из количества уровней зависимостей,
-        которое рекомендуется подгружать при просмотре зависимостей
-        объектов данного типа. Первый элемент - восходящие зависимости,
-        второй - нисходящие.
+        Запрос, возвращающий то же, что get_children, сразу для всех нод
+        этого класса с id из ids: строки (id ноды, id потомка, маска
+        действий); маска NULL означает вложенность (contain).
+        None - у нод класса не бывает потомков.
         """
-        return (float("inf"), float("inf"))
+        return None
+
+    @classmethod
+    def select_parents(cls, ids):
+        """
+        То же, что select_children, но для get_parents:
+        строки (id ноды, id предка, маска действий).
+        """
+        return None
+
+
+@event.listens_for(Node.name, "set", propagate=True)
+def _set_search_name(target, value, oldvalue, initiator):
+    target.search_name = None if value is None else value.lower()
 
 
 class Edge(BaseDPM):
     """
     Связи между объектами Node.
+
+    Между двумя нодами может быть только одна связь. Действия, которые
+    объект sourse выполняет с объектом dest, хранятся битовой маской
+    в поле operations (см. EDGE_OPERATIONS); для каждого действия есть
+    логическое свойство с тем же именем (select, insert и т.д.).
     """
     __tablename__ = "Edge"
     id = Column(Integer, primary_key=True)
@@ -111,15 +195,33 @@ class Edge(BaseDPM):
     is_broken = Column(Boolean, default=False, nullable=False)
     # если True, то один из соединяемых объектов является фиктивным
     is_dummy = Column(Boolean, default=False, nullable=False)
-    # поля, описывающие что объект sourse делает с объектом dest
-    calc = Column(Boolean, default=False, nullable=False)
-    select = Column(Boolean, default=False, nullable=False)
-    insert = Column(Boolean, default=False, nullable=False)
-    update = Column(Boolean, default=False, nullable=False)
-    delete = Column(Boolean, default=False, nullable=False)
-    exec = Column(Boolean, default=False, nullable=False)
-    truncate = Column(Boolean, default=False, nullable=False)
-    drop = Column(Boolean, default=False, nullable=False)
+    # что объект sourse делает с объектом dest, маска из EDGE_OPERATIONS
+    operations = Column(Integer, default=0, nullable=False)
+    calc = operation_property("calc")
+    select = operation_property("select")
+    insert = operation_property("insert")
+    update = operation_property("update")
+    delete = operation_property("delete")
+    exec = operation_property("exec")
+    truncate = operation_property("truncate")
+    drop = operation_property("drop")
+
+    __table_args__ = (
+        UniqueConstraint("sourse_id", "dest_id", name="uq_Edge_sourse_dest"),
+        # покрывающие индексы для обхода графа в обе стороны
+        Index("ix_Edge_sourse", "sourse_id", "dest_id", "operations", "is_broken"),
+        Index("ix_Edge_dest", "dest_id", "sourse_id", "operations", "is_broken"),
+    )
+
+    @staticmethod
+    def operations_mask(actions):
+        """
+        Возвращает маску для набора действий actions.
+        """
+        mask = 0
+        for action in actions:
+            mask |= EDGE_OPERATIONS[action]
+        return mask
 
     def __repr__(self):
         if isinstance(self.sourse, DBScript):
@@ -134,8 +236,38 @@ class Edge(BaseDPM):
         return f"{sourse_node_name} -> {dest_node_name}"
     
     def get_attributes_list(self):
+        return self.attributes_from_mask(self.operations)
+
+    @staticmethod
+    def attributes_from_mask(mask):
+        """
+        Список действий по маске в том порядке, в каком их возвращает
+        get_attributes_list; маска None означает вложенность (contain).
+        """
+        if mask is None:
+            return ["contain"]
         template = ["calc", "select", "insert", "update", "delete", "exec", "drop", "truncate"]
-        return [attr for attr in template if getattr(self,attr,False) == True]
+        return [attr for attr in template if mask & EDGE_OPERATIONS[attr]]
+
+    @classmethod
+    def select_outgoing(cls, ids, exclude=None):
+        """
+        Строки (id источника, id объекта, маска) для связей, исходящих
+        из нод ids; exclude - условие на связи, которые нужно пропустить.
+        """
+        table = cls.__table__
+        query = select([table.c.sourse_id, table.c.dest_id, table.c.operations]).where(table.c.sourse_id.in_(ids))
+        return query if exclude is None else query.where(~exclude)
+
+    @classmethod
+    def select_incoming(cls, ids, exclude=None):
+        """
+        Строки (id объекта, id источника, маска) для связей, входящих
+        в ноды ids; exclude - условие на связи, которые нужно пропустить.
+        """
+        table = cls.__table__
+        query = select([table.c.dest_id, table.c.sourse_id, table.c.operations]).where(table.c.dest_id.in_(ids))
+        return query if exclude is None else query.where(~exclude)
 
 """
 добавляем классу Node зависимости от Edge
@@ -185,6 +317,10 @@ class DatabaseObject(Node):
     database_object_id = Column(Integer, nullable=False)
     schema = Column(String(30), nullable=False)
 
+    __table_args__ = (
+        Index("ix_DatabaseObject_database", "database_id", "database_object_id"),
+    )
+
     @property
     def long_name(self):
         return f"{self.schema}.{self.name}"
@@ -311,6 +447,10 @@ class ClientQuery(Node, SQLQueryMixin):
     database_id = Column(ForeignKey("Database.id"))
     database = relationship("Database", foreign_keys=[database_id])
 
+    __table_args__ = (
+        Index("ix_ClientQuery_form", "form_id"),
+    )
+
     __mapper_args__ = {
         "polymorphic_identity": "Клиентский запрос"
     }
@@ -348,19 +488,21 @@ class ClientQuery(Node, SQLQueryMixin):
     
     def get_parents(self):
         return [(self.form, ["contain"])]
-    
-    def get_recommended_loading_depth(self):
-        """
-        Возвращает кортеж из количества уровней зависимостей,
-        которое рекомендуется подгружать при просмотре зависимостей
-        объектов данного типа. Первый элемент - восходящие зависимости,
-        второй - нисходящие.
-        """
-        return (0, 1)
+
+    @classmethod
+    def select_children(cls, ids):
+        return Edge.select_outgoing(ids)
+
+    @classmethod
+    def select_parents(cls, ids):
+        table = cls.__table__
+        return select([table.c.id, table.c.form_id, null()]).where(table.c.id.in_(ids))
 
 AppsAndForms = Table('AppsAndForms', BaseDPM.metadata,
     Column('form_id', Integer, ForeignKey('Form.id')),
-    Column('application_id', Integer, ForeignKey('Application.id'))
+    Column('application_id', Integer, ForeignKey('Application.id')),
+    Index('ix_AppsAndForms_application', 'application_id', 'form_id'),
+    Index('ix_AppsAndForms_form', 'form_id', 'application_id')
 )
 
 
@@ -392,6 +534,10 @@ class Form(Node):
     is_broken = Column(Boolean, nullable=False, default=False)
     parsing_error_message = Column(String(300))
 
+    __table_args__ = (
+        Index("ix_Form_path", "path"),
+    )
+
     __mapper_args__ = {
         "polymorphic_identity": "Форма"
     }
@@ -419,12 +565,9 @@ class Form(Node):
     def is_shared(self):
         return len(self.applications) > 1
     
-    @property
-    def label(self):
-        """
-        Возвращает подпись, которую будет иметь нода при обработке графа.
-        """
-        return str(self.id)
+    @classmethod
+    def make_label(cls, node_id, name):
+        return str(node_id)
     
     @property
     def categories(self):
@@ -446,15 +589,16 @@ class Form(Node):
         for app in self.applications:
             parents.append((app, ["contain"]))
         return parents
-    
-    def get_recommended_loading_depth(self):
-        """
-        Возвращает кортеж из количества уровней зависимостей,
-        которое рекомендуется подгружать при просмотре зависимостей
-        объектов данного типа. Первый элемент - восходящие зависимости,
-        второй - нисходящие.
-        """
-        return (0, 2)
+
+    @classmethod
+    def select_children(cls, ids):
+        table = ClientQuery.__table__
+        return select([table.c.form_id, table.c.id, null()]).where(table.c.form_id.in_(ids))
+
+    @classmethod
+    def select_parents(cls, ids):
+        return select([AppsAndForms.c.form_id, AppsAndForms.c.application_id, null()])\
+            .where(AppsAndForms.c.form_id.in_(ids))
 
 class Application(Node):
     """
@@ -507,18 +651,14 @@ class Application(Node):
         for form in self.forms.values():
             children.append((form, ["contain"]))
         return children
+
+    @classmethod
+    def select_children(cls, ids):
+        return select([AppsAndForms.c.application_id, AppsAndForms.c.form_id, null()])\
+            .where(AppsAndForms.c.application_id.in_(ids))
     
     def get_parents(self):
         return []
-    
-    def get_recommended_loading_depth(self):
-        """
-        Возвращает кортеж из количества уровней зависимостей,
-        которое рекомендуется подгружать при просмотре зависимостей
-        объектов данного типа. Первый элемент - восходящие зависимости,
-        второй - нисходящие.
-        """
-        return (0, 3)
 
 
 class DBScript(DatabaseObject, SQLQueryMixin):
@@ -585,15 +725,14 @@ class DBScript(DatabaseObject, SQLQueryMixin):
                 continue
             parents.append((e.sourse, e.get_attributes_list()))
         return parents
-    
-    def get_recommended_loading_depth(self):
-        """
-        Возвращает кортеж из количества уровней зависимостей,
-        которое рекомендуется подгружать при просмотре зависимостей
-        объектов данного типа. Первый элемент - восходящие зависимости,
-        второй - нисходящие.
-        """
-        return (0, 1)
+
+    @classmethod
+    def select_children(cls, ids):
+        return Edge.select_outgoing(ids, exclude=Edge.__table__.c.sourse_id == Edge.__table__.c.dest_id)
+
+    @classmethod
+    def select_parents(cls, ids):
+        return Edge.select_incoming(ids, exclude=Edge.__table__.c.sourse_id == Edge.__table__.c.dest_id)
 
 
 class DBView(DBScript):
@@ -699,6 +838,10 @@ class DBTrigger(DBScript):
     is_delete = Column(Boolean, nullable=False)
     is_insert = Column(Boolean, nullable=False)
 
+    __table_args__ = (
+        Index("ix_DBTrigger_table", "table_id"),
+    )
+
     __mapper_args__ = {
         "polymorphic_identity": "Триггер"
     }
@@ -716,6 +859,7 @@ class DBTrigger(DBScript):
             is_delete=original.is_delete,
             is_insert=original.is_insert,
             sql=original.sql,
+            crc32=original.crc32,
             last_update=original.last_update,
             table=parent,
             database=parent.database
@@ -740,6 +884,19 @@ class DBTrigger(DBScript):
     def get_parents(self):
         return [(self.table, ["contain"])]
 
+    @classmethod
+    def select_children(cls, ids):
+        edge = Edge.__table__
+        trigger = cls.__table__
+        return select([edge.c.sourse_id, edge.c.dest_id, edge.c.operations])\
+            .select_from(edge.join(trigger, trigger.c.id == edge.c.sourse_id))\
+            .where(and_(edge.c.sourse_id.in_(ids), edge.c.dest_id != trigger.c.table_id))
+
+    @classmethod
+    def select_parents(cls, ids):
+        table = cls.__table__
+        return select([table.c.id, table.c.table_id, null()]).where(table.c.id.in_(ids))
+
 
 class DBTable(DatabaseObject):
     """
@@ -792,15 +949,15 @@ class DBTable(DatabaseObject):
         for e in self.edges_in:
             parents.append((e.sourse, e.get_attributes_list()))
         return parents
-    
-    def get_recommended_loading_depth(self):
-        """
-        Возвращает кортеж из количества уровней зависимостей,
-        которое рекомендуется подгружать при просмотре зависимостей
-        объектов данного типа. Первый элемент - восходящие зависимости,
-        второй - нисходящие.
-        """
-        return (1, 1)
+
+    @classmethod
+    def select_children(cls, ids):
+        table = DBTrigger.__table__
+        return select([table.c.table_id, table.c.id, null()]).where(table.c.table_id.in_(ids))
+
+    @classmethod
+    def select_parents(cls, ids):
+        return Edge.select_incoming(ids)
 
 
 class Database(Node):
@@ -889,14 +1046,144 @@ class Database(Node):
             children.append((item, ["contain"]))
         return children
 
+    @classmethod
+    def select_children(cls, ids):
+        objects = DatabaseObject.__table__
+        nodes = Node.__table__
+        types = [
+            child.__mapper__.polymorphic_identity
+            for child in (DBTable, DBScalarFunction, DBTableFunction, DBStoredProcedure, DBView)
+        ]
+        return select([objects.c.database_id, objects.c.id, null()])\
+            .select_from(objects.join(nodes, nodes.c.id == objects.c.id))\
+            .where(and_(objects.c.database_id.in_(ids), nodes.c.type.in_(types)))
+
     def get_parents(self):
         return []
-    
-    def get_recommended_loading_depth(self):
+
+
+
+class SyncCheckpoint(BaseDPM):
+    """
+    Отметка о завершённом этапе синхронизации ноды.
+
+    Синхронизация большой базы или АРМа разбивается на этапы (stage - вид
+    синхронизации, phase - этап, key - конкретный объект этапа, например
+    путь к форме). После каждого этапа результаты сохраняются в ДПМ вместе
+    с отметкой, поэтому упавшую синхронизацию можно продолжить с места
+    падения.
+
+    revision - дата обновления оригинала, к которой приводится нода;
+    если оригинал с тех пор изменился, отметки считаются устаревшими.
+    После успешного завершения синхронизации отметки удаляются в той же
+    транзакции, в которой ставится last_update/last_revision ноды.
+    SQLite не проверяет внешние ключи (PRAGMA foreign_keys выключена),
+    поэтому отметки удалённой ноды остаются в ДПМ; они никем не читаются.
+    """
+    __tablename__ = "SyncCheckpoint"
+    id = Column(Integer, primary_key=True)
+    node_id = Column(Integer, ForeignKey("Node.id"), nullable=False)
+    stage = Column(String(50), nullable=False)
+    phase = Column(String(50), nullable=False)
+    key = Column(String(1000), nullable=False, default="")
+    revision = Column(DateTime)
+    completed = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+    __table_args__ = (
+        Index("ix_SyncCheckpoint_node", "node_id", "stage"),
+    )
+
+
+class IndexedText(BaseDPM):
+    """
+    Отметка о том, что sql-код ноды (скрипта или компонента) разобран
+    в индекс идентификаторов IdentifierToken.
+
+    crc32 - контрольная сумма кода на момент разбора; если у ноды она
+    изменилась, идентификаторы ноды пересобираются.
+    Отметки и идентификаторы удалённых нод удаляет
+    dpm.identifier_index.refresh_identifier_index.
+    """
+    __tablename__ = "IndexedText"
+    node_id = Column(Integer, ForeignKey("Node.id"), primary_key=True)
+    crc32 = Column(Integer)
+
+
+class IdentifierToken(BaseDPM):
+    """
+    Обратный индекс идентификаторов, встречающихся в sql-коде нод:
+    для каждого идентификатора (Название, Схема.Название, БД.Схема.Название)
+    хранятся ноды, в коде которых он есть. См. dpm.identifier_index.
+    """
+    __tablename__ = "IdentifierToken"
+    token = Column(String(400), primary_key=True)
+    node_id = Column(Integer, ForeignKey("Node.id"), primary_key=True)
+
+    __table_args__ = (
+        Index("ix_IdentifierToken_node_id", "node_id"),
+    )
+
+
+class ReferenceCache(BaseDPM):
+    """
+    Упоминания объектов одной базы, найденные в sql-коде при анализе связей.
+    См. dpm.reference_cache.
+
+    Код определяется контрольной суммой crc32 и длиной, поэтому одинаковые
+    скрипты и компоненты (например, скопированные запросы в АРМах)
+    разбираются один раз. home_database_id - база, с которой связан код
+    (0, если такой нет): от неё зависит, по каким именам ищутся объекты.
+    catalog_database_id - база, объекты которой искались; catalog_hash -
+    отпечаток тех её объектов, которые могут встретиться в коде, на момент
+    разбора: при их изменении запись становится недействительной.
+    refs - JSON-список пар [БД.Схема.Название, [действия]].
+    Записи удалённых баз удаляет dpm.reference_cache.prune.
+    """
+    __tablename__ = "ReferenceCache"
+    crc32 = Column(Integer, primary_key=True, autoincrement=False)
+    length = Column(Integer, primary_key=True, autoincrement=False)
+    home_database_id = Column(Integer, primary_key=True, autoincrement=False)
+    catalog_database_id = Column(Integer, ForeignKey("Database.id"), primary_key=True, autoincrement=False)
+    catalog_hash = Column(String(40), nullable=False)
+    refs = Column(Text, nullable=False)
+
+
+class NodeStats(BaseDPM):
+    """
+    Статистика связей ноды, которая пересчитывается после синхронизации
+    (см. dpm.node_stats), чтобы GUI мог показывать связность объекта и
+    выбирать глубину загрузки графа, ничего не загружая.
+
+    parents, children - количество предков и потомков ноды;
+    operations - JSON-словарь {действие: сколько потомков связано с нодой
+    этим действием} (contain - вложенность);
+    depth_up, depth_down - длина самой длинной цепочки предков и потомков
+    (для нод в циклах - оценка сверху);
+    peripheral_up, peripheral_down - у ноды нет предков или потомков.
+    Статистику удалённых нод удаляет dpm.node_stats.update_node_stats.
+    """
+    __tablename__ = "NodeStats"
+    node_id = Column(Integer, ForeignKey("Node.id"), primary_key=True, autoincrement=False)
+    parents = Column(Integer, nullable=False)
+    children = Column(Integer, nullable=False)
+    operations = Column(Text, nullable=False)
+    depth_up = Column(Integer, nullable=False)
+    depth_down = Column(Integer, nullable=False)
+    peripheral_up = Column(Boolean, nullable=False)
+    peripheral_down = Column(Boolean, nullable=False)
+    updated = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+    @property
+    def children_by_operation(self):
+        return json.loads(self.operations)
+
+    @property
+    def summary(self):
         """
-        Возвращает кортеж из количества уровней зависимостей,
-        которое рекомендуется подгружать при просмотре зависимостей
-        объектов данного типа. Первый элемент - восходящие зависимости,
-        второй - нисходящие.
+        Краткое описание связности ноды для GUI.
         """
-        return (0, float("inf"))
+        operations = ", ".join(f"{name} {count}" for name, count in self.children_by_operation.items())
+        children = f"{self.children} ({operations})" if operations else str(self.children)
+        return (
+            f"Предков: {self.parents}, потомков: {children}; "
+            f"глубина вверх: {self.depth_up}, вниз: {self.depth_down}")
@@ -0,0 +1,249 @@
+"""
+Статистика связей нод.
+
+Чтобы показать, насколько объект связан с остальными, и выбрать глубину
+загрузки графа (DpmGraph.recommended_loading_depth), не нужно строить граф:
+после синхронизации для всех нод один раз считаются количество предков
+и потомков (потомков - ещё и по действиям), длина самой длинной цепочки
+предков и потомков и признаки периферийности, и всё это записывается
+в таблицу NodeStats.
+
+Связи берутся из снимка (dpm.adjacency), поэтому расчёт стоит два запроса
+на чтение. Длины цепочек считаются по графу, сжатому до компонент сильной
+связности (алгоритм Тарьяна): компоненты выдаются после всех достижимых
+из них, поэтому каждая компонента обрабатывается один раз.
+Для нод в циклах длина получается оценкой сверху.
+
+Когда изменилась небольшая часть ДПМ (наблюдатель за исходниками), статистика
+пересчитывается только для изменившихся нод и нод, из которых они достижимы:
+у остальных нод не меняется ни один путь, поэтому на границе этой области
+длины цепочек берутся из уже записанной статистики.
+
+Использование:
+    update_node_stats(session)
+    update_node_stats(session, ids=changed_ids)
+    session.commit()
+"""
+import json
+import datetime
+from collections import Counter
+from sqlalchemy import select
+from . import models
+from .models import NodeStats
+from .adjacency import AdjacencySnapshot
+from .storage import NodeStorage, CHUNK_SIZE
+
+
+def update_node_stats(session, snapshot=None, ids=None):
+    """
+    Пересчитывает статистику всех нод и перезаписывает таблицу NodeStats
+    (без commit). snapshot - уже загруженный снимок связей; если не задан,
+    загружается из ДПМ.
+    ids - id нод, которые изменились или у которых изменились связи (для
+    каждой изменившейся связи - хотя бы источник и приёмник, если они ещё
+    есть в ДПМ; удалённые ноды тоже можно передать). Если задано, снимок
+    не нужен: пересчитывается только статистика этих нод и нод, из которых
+    они достижимы (update_region).
+    Возвращает количество пересчитанных нод.
+    """
+    if ids is not None:
+        return update_region(session, ids)
+    if snapshot is None:
+        snapshot = AdjacencySnapshot.build(session)
+    ids = list(snapshot.index)
+    depth_up = longest_chains(snapshot, ids, upwards=True)
+    depth_down = longest_chains(snapshot, ids, upwards=False)
+    session.query(NodeStats).delete(synchronize_session=False)
+    return _write(session, ids, snapshot.parents_of(ids), snapshot.children_of(ids), depth_up, depth_down)
+
+
+def update_region(session, ids):
+    """
+    Пересчитывает статистику нод ids и нод, из которых они достижимы
+    (без commit); статистика удалённых нод из ids удаляется.
+
+    Длина цепочки потомков меняется только у нод, из которых по потомкам
+    достижима одна из нод ids, длина цепочки предков - у нод, из которых
+    она достижима по предкам (предки и потомки строятся разными правилами,
+    поэтому это два разных множества). Они ищутся рекурсивными запросами,
+    для соседей за их пределами длины цепочек берутся из NodeStats.
+    Возвращает количество пересчитанных нод.
+    """
+    ids = set(ids)
+    nodes = models.Node.__table__
+    existing = []
+    for chunk in _chunks(ids):
+        existing.extend(node_id for node_id, in session.execute(select([nodes.c.id]).where(nodes.c.id.in_(chunk))))
+    region_down = _reaching(session, existing, upwards=False)
+    region_up = _reaching(session, existing, upwards=True)
+    region = sorted(region_down | region_up)
+    parents = _neighbours(session, region, upwards=True)
+    children = _neighbours(session, region, upwards=False)
+
+    # длины цепочек остальных нод не изменились
+    known = set(region)
+    for lists in (parents, children):
+        known.update(neighbour_id for items in lists.values() for neighbour_id, _ in items)
+    stored_up = {}
+    stored_down = {}
+    for chunk in _chunks(known):
+        query = session.query(NodeStats.node_id, NodeStats.depth_up, NodeStats.depth_down)\
+            .filter(NodeStats.node_id.in_(chunk))
+        for node_id, up, down in query:
+            stored_up[node_id] = up
+            stored_down[node_id] = down
+    depth_up = dict(stored_up)
+    depth_up.update(_chains(
+        sorted(region_up), lambda node_id: [item[0] for item in parents[node_id]], stored_up))
+    depth_down = dict(stored_down)
+    depth_down.update(_chains(
+        sorted(region_down), lambda node_id: [item[0] for item in children[node_id]], stored_down))
+
+    for chunk in _chunks(set(region) | ids):
+        session.query(NodeStats).filter(NodeStats.node_id.in_(chunk)).delete(synchronize_session=False)
+    return _write(session, region, parents, children, depth_up, depth_down)
+
+
+def _write(session, ids, parents, children, depth_up, depth_down):
+    """
+    Записывает в NodeStats статистику нод ids по спискам соседей
+    ({id: [(id соседа, список действий)]}) и длинам цепочек.
+    """
+    updated = datetime.datetime.now()
+    rows = []
+    for node_id in ids:
+        operations = Counter(attr for _, attrs in children[node_id] for attr in attrs)
+        rows.append({
+            "node_id": node_id,
+            "parents": len(parents[node_id]),
+            "children": len(children[node_id]),
+            "operations": json.dumps(dict(sorted(operations.items()))),
+            "depth_up": depth_up[node_id],
+            "depth_down": depth_down[node_id],
+            "peripheral_up": not parents[node_id],
+            "peripheral_down": not children[node_id],
+            "updated": updated,
+        })
+    if rows:
+        session.execute(NodeStats.__table__.insert(), rows)
+    return len(rows)
+
+
+def longest_chains(snapshot, ids, upwards=False):
+    """
+    Длина самой длинной цепочки потомков (или предков, если upwards)
+    каждой ноды из ids: словарь {id ноды: длина}. Цикл из k нод
+    считается цепочкой длины k - 1, которую можно пройти от любой его
+    ноды, поэтому длина не меньше количества уровней, на которое
+    загружается граф ноды "до конца".
+    """
+    return _chains(ids, lambda node_id: snapshot.neighbour_ids(node_id, upwards))
+
+
+def _chains(ids, neighbours, outside=None):
+    """
+    Длины самых длинных цепочек нод ids по функции соседей neighbours;
+    outside - уже известные длины для соседей не из ids (неизвестные
+    считаются нулевыми).
+    """
+    outside = outside or {}
+    depths = {}
+    for members in _strong_components(ids, set(ids), neighbours):
+        component = set(members)
+        depth = 0
+        for node_id in members:
+            for neighbour_id in neighbours(node_id):
+                if neighbour_id in component:
+                    continue
+                known = depths[neighbour_id] if neighbour_id in depths else outside.get(neighbour_id, 0)
+                depth = max(depth, known + 1)
+        for node_id in members:
+            depths[node_id] = depth + len(members) - 1
+    return depths
+
+
+def _reaching(session, ids, upwards):
+    """
+    Множество нод, из которых по потомкам (или по предкам, если upwards)
+    достижима хотя бы одна нода из ids, включая сами ids; один рекурсивный
+    запрос на пачку ids.
+    """
+    relation = NodeStorage.select_relation(upwards).cte("relation")
+    node_column, neighbour_column, _ = relation.c
+    nodes = models.Node.__table__
+    result = set()
+    for chunk in _chunks(ids):
+        closure = select([nodes.c.id.label("node_id")])\
+            .where(nodes.c.id.in_(chunk))\
+            .cte("closure", recursive=True)
+        closure = closure.union(
+            select([node_column]).where(neighbour_column == closure.c.node_id))
+        result.update(node_id for node_id, in session.execute(select([closure.c.node_id])))
+    return result
+
+
+def _neighbours(session, ids, upwards):
+    """
+    Предки (или потомки) нод ids одним запросом на пачку:
+    словарь {id: [(id соседа, список действий)]}.
+    """
+    relation = NodeStorage.select_relation(upwards).alias()
+    node_column, neighbour_column, mask_column = relation.c
+    result = {node_id: [] for node_id in ids}
+    for chunk in _chunks(ids):
+        query = select([node_column, neighbour_column, mask_column]).where(node_column.in_(chunk))
+        for node_id, neighbour_id, mask in session.execute(query):
+            result[node_id].append((neighbour_id, models.Edge.attributes_from_mask(mask)))
+    return result
+
+
+def _strong_components(nodes, region, neighbours):
+    """
+    Компоненты сильной связности подграфа на нодах region (алгоритм
+    Тарьяна без рекурсии). Компоненты выдаются так, что все компоненты,
+    достижимые из данной, выдаются раньше неё.
+    """
+    order = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    for root in nodes:
+        if root in order:
+            continue
+        order[root] = low[root] = len(order)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(neighbours(root)))]
+        while work:
+            node_id, successors = work[-1]
+            for successor in successors:
+                if successor not in region:
+                    continue
+                if successor not in order:
+                    order[successor] = low[successor] = len(order)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(neighbours(successor))))
+                    break
+                if successor in on_stack:
+                    low[node_id] = min(low[node_id], order[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node_id])
+                if low[node_id] == order[node_id]:
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        members.append(member)
+                        if member == node_id:
+                            break
+                    yield members
+
+
+def _chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
@@ -0,0 +1,84 @@
+"""
+Счётчик запросов к БД.
+
+Нужен, чтобы замерять, сколько запросов уходит в ДПМ на одно действие
+пользователя (выбор ноды, загрузка уровней графа и т.д.):
+
+    with QueryCounter(session.bind) as counter:
+        graph.load_dependencies(1, 2)
+    print(counter.count, counter.seconds)
+
+или, для статистики за всё время работы движка, start() без with
+(см. Connector.dpm_summary).
+"""
+import time
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """
+    Считает запросы, выполненные через engine внутри блока with
+    (или между start и stop).
+
+    count - количество запросов; seconds - суммарное время их выполнения;
+    slowest - время самого долгого запроса; locked - сколько запросов
+    упало из-за блокировки файла БД ("database is locked");
+    statements - тексты запросов, если keep_statements True.
+    """
+
+    def __init__(self, engine, keep_statements=False):
+        self.engine = engine
+        self.keep_statements = keep_statements
+        self.reset()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def start(self):
+        event.listen(self.engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_execute)
+        event.listen(self.engine, "handle_error", self._handle_error)
+        return self
+
+    def stop(self):
+        event.remove(self.engine, "before_cursor_execute", self._before_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_execute)
+        event.remove(self.engine, "handle_error", self._handle_error)
+
+    def reset(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.locked = 0
+        self.statements = []
+
+    @property
+    def summary(self):
+        return (
+            f"запросов {self.count}, {self.seconds:.2f} с, самый долгий {self.slowest:.2f} с, "
+            f"упало из-за блокировки {self.locked}")
+
+    # region utility methods
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        if self.keep_statements:
+            self.statements.append(statement)
+        # движком могут пользоваться несколько потоков, поэтому время
+        # начала хранится в соединении, а не в счётчике
+        conn.info.setdefault("query_counter_started", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("query_counter_started")
+        if started:
+            elapsed = time.perf_counter() - started.pop()
+            self.seconds += elapsed
+            self.slowest = max(self.slowest, elapsed)
+
+    def _handle_error(self, context):
+        if "locked" in str(context.original_exception):
+            self.locked += 1
+    # endregion
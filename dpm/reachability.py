@@ -0,0 +1,154 @@
+"""
+Индекс достижимости для вопросов о влиянии изменений.
+
+Главный вопрос к карте зависимостей - "что сломается, если изменить
+таблицу X": какие скрипты, компоненты, формы и АРМы от неё зависят.
+Ответ - все ноды, достижимые из X по предкам (get_parents), а обратный
+вопрос "от чего зависит X" - все ноды, достижимые по потомкам.
+
+Достижимость считается обходом в ширину по снимку связей (dpm.adjacency)
+при первом вопросе о ноде: обход стоит столько, сколько нод и связей
+достижимо из неё, а заранее ничего не строится. Ответы для отдельных нод
+хранятся в кэше ограниченного размера (CACHE_SIZE на направление), поэтому
+повторные вопросы о той же ноде, например при возврате к ней в GUI,
+обходятся без обхода. Память индекса не зависит от размера ДПМ сверх
+размера кэша.
+
+После синхронизации (update) из кэша удаляются только ответы, в которых
+есть изменившиеся ноды: ответы остальных нод от изменения не зависят.
+"""
+from collections import OrderedDict, deque
+
+
+# сколько ответов для отдельных нод хранить в кэше каждого направления
+CACHE_SIZE = 256
+
+
+class Direction:
+    """
+    Достижимость в одном направлении с кэшем ответов для отдельных нод.
+
+    cache - словарь {id ноды: frozenset id достижимых нод, включая её саму},
+    упорядоченный от давно запрошенных к недавним.
+    """
+
+    def __init__(self, snapshot, upwards, capacity=CACHE_SIZE):
+        self.snapshot = snapshot
+        self.upwards = upwards
+        self.capacity = capacity
+        self.cache = OrderedDict()
+
+    # region public methods
+    def reachable(self, ids):
+        """
+        Возвращает множество id нод, достижимых из нод ids (включая их самих).
+        """
+        ids = [node_id for node_id in dict.fromkeys(ids) if node_id in self.snapshot]
+        if len(ids) == 1:
+            return set(self._cached(ids[0]))
+        found = set()
+        for node_id in ids:
+            if node_id in self.cache and node_id not in found:
+                found.update(self.cache[node_id])
+        return self._walk([node_id for node_id in ids if node_id not in found], found)
+
+    def update(self, changed):
+        """
+        Удаляет из кэша ответы, в которые входят ноды changed (ноды, списки
+        соседей которых изменились); None - сбросить весь кэш.
+        """
+        if changed is None:
+            self.cache.clear()
+            return
+        changed = set(changed)
+        stale = [node_id for node_id, found in self.cache.items() if not changed.isdisjoint(found)]
+        for node_id in stale:
+            del self.cache[node_id]
+    # endregion
+
+    # region utility methods
+    def _cached(self, node_id):
+        found = self.cache.get(node_id)
+        if found is not None:
+            self.cache.move_to_end(node_id)
+            return found
+        found = frozenset(self._walk([node_id], set()))
+        self.cache[node_id] = found
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+        return found
+
+    def _walk(self, ids, found):
+        """
+        Обход в ширину от нод ids; found - уже найденные ноды, дальше
+        которых обход не идёт (их достижимые ноды уже в found).
+        """
+        queue = deque(node_id for node_id in ids if node_id not in found)
+        found.update(queue)
+        while queue:
+            for neighbour_id in self.snapshot.neighbour_ids(queue.popleft(), self.upwards):
+                if neighbour_id not in found:
+                    found.add(neighbour_id)
+                    queue.append(neighbour_id)
+        return found
+    # endregion
+
+
+class ReachabilityIndex:
+    """
+    Индекс достижимости по снимку связей ДПМ.
+
+    Использование:
+        index = ReachabilityIndex(AdjacencySnapshot.build(session))
+        index.affected_by([table_id])   # {"Form": [...], "Application": [...], ...}
+        ...
+        changed = index.snapshot.refresh(session, synced_ids)
+        index.update(changed)
+    """
+
+    def __init__(self, snapshot, capacity=CACHE_SIZE):
+        self.snapshot = snapshot
+        self.up = Direction(snapshot, upwards=True, capacity=capacity)
+        self.down = Direction(snapshot, upwards=False, capacity=capacity)
+
+    # region public methods
+    def reachable(self, ids, upwards=True):
+        """
+        Множество id нод, достижимых из нод ids по предкам (или по
+        потомкам, если не upwards), включая сами ids из снимка.
+        """
+        return (self.up if upwards else self.down).reachable(ids)
+
+    def affected_by(self, ids):
+        """
+        Ноды, которые зависят от нод ids (достижимые по предкам), -
+        словарь {имя класса: [id нод]}; сами ids в результат не входят.
+        """
+        return self._grouped(self.reachable(ids), ids)
+
+    def depends_on(self, ids):
+        """
+        Ноды, от которых зависят ноды ids (достижимые по потомкам), -
+        словарь {имя класса: [id нод]}; сами ids в результат не входят.
+        """
+        return self._grouped(self.reachable(ids, upwards=False), ids)
+
+    def update(self, changed):
+        """
+        Обновляет индекс после обновления снимка; changed - результат
+        AdjacencySnapshot.refresh (None - снимок загружен заново).
+        """
+        if changed is not None and not changed:
+            return
+        self.up.update(changed)
+        self.down.update(changed)
+    # endregion
+
+    # region utility methods
+    def _grouped(self, found, ids):
+        found.difference_update(ids)
+        result = {}
+        for node_id in sorted(found):
+            result.setdefault(self.snapshot.class_of(node_id), []).append(node_id)
+        return result
+    # endregion
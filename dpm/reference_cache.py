@@ -0,0 +1,248 @@
+"""
+Кэш упоминаний объектов БД в sql-коде.
+
+Одинаковый код часто встречается много раз: компоненты АРМов копируются
+с формы на форму, процедуры переносятся между базами. Анализ связей
+разбирает каждый такой текст один раз: найденные упоминания сохраняются
+в ДПМ (ReferenceCache) с ключом (crc32 кода, длина кода, база кода, база
+объектов) и при следующих анализах берутся оттуда.
+
+Результат разбора кода зависит только от объектов, которые могут в нём
+встретиться (relevant_targets): простое имя объекта должно быть началом
+одного из идентификаторов кода, а объекты с другими именами (со спецсимволами)
+могут встретиться где угодно. Упоминания хранятся по полным именам объектов
+(БД.Схема.Название) вместе с отпечатком именно этих объектов, поэтому
+добавление, удаление и переименование остальных объектов базы запись не
+трогает. При промахе код разбирается только на эти объекты, а устаревшая
+запись заменяется новой.
+
+Анализ трогает только записи разобранного им кода. Записи кода, которого
+больше нет ни у одного скрипта или компонента, удаляет prune: это полный
+просмотр ДПМ, поэтому он запускается отдельной командой обслуживания
+(main.py prune), а не при каждом анализе.
+"""
+import re
+import json
+import hashlib
+import logging
+import binascii
+from .models import ReferenceCache, DBScript, ClientQuery, Database
+from .scanner import scan_scripts
+from .identifier_index import INDEXABLE_NAME
+
+
+# сколько ключей запрашивать из ДПМ за раз
+CHUNK_SIZE = 500
+# часть идентификатора, с которой может начинаться простое имя объекта
+IDENTIFIER_PART = re.compile(r"[\w@#$]+")
+
+
+def catalog_fingerprint(targets):
+    """
+    Возвращает отпечаток набора объектов (список ScanTarget).
+    Отпечаток меняется при добавлении, удалении и переименовании объектов
+    набора и при изменении их набора действий.
+    """
+    digest = hashlib.sha1()
+    for description in sorted((target.foreign_forms[0], target.actions) for target in targets):
+        digest.update(repr(description).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def script_key(script):
+    """
+    Ключ кода скрипта (ScanScript) в кэше без базы объектов: crc32 текста
+    (совпадает с crc32 ноды), длина текста и база скрипта.
+    """
+    return (binascii.crc32(script.sql.encode("utf-8")), len(script.sql), script.database_id or 0)
+
+
+def relevant_targets(sql, by_name, unindexable):
+    """
+    Возвращает объекты, которые сканер может найти в коде sql.
+
+    by_name - словарь {короткое имя: список ScanTarget} для объектов
+    с простыми именами (dpm.identifier_index.INDEXABLE_NAME), unindexable -
+    объекты с остальными именами, они возвращаются всегда. Сканер находит имя
+    только после пробела, точки или символа выражения, поэтому простое имя
+    найденного объекта всегда является началом одного из идентификаторов кода.
+    """
+    found = {target.id: target for target in unindexable}
+    for part in set(IDENTIFIER_PART.findall(sql.lower())):
+        for end in range(1, len(part) + 1):
+            for target in by_name.get(part[:end], ()):
+                found[target.id] = target
+    return list(found.values())
+
+
+def scan_with_cache(session, targets, scripts, processes=None, stats=None, store=True):
+    """
+    То же, что dpm.scanner.scan_scripts, но с использованием кэша.
+
+    Код, упоминания в котором для всех баз объектов есть в кэше с
+    актуальным отпечатком, не разбирается; остальной код разбирается
+    один раз на каждый ключ, на все объекты, которые могут в нём
+    встретиться (без учёта ScanScript.allowed), и сохраняется в кэш.
+    Ограничение allowed применяется уже к результату.
+    stats - LinkStats для статистики разбора; если store False, кэш
+    только читается.
+    Возвращает список кортежей (id скрипта, id объекта, множество действий).
+    """
+    by_name = {}
+    unindexable = []
+    for target in targets:
+        if INDEXABLE_NAME.match(target.name):
+            by_name.setdefault(target.name, []).append(target)
+        else:
+            unindexable.append(target)
+    database_ids = sorted({target.database_id for target in targets})
+
+    keys = {}
+    for script in scripts:
+        keys.setdefault(script_key(script), []).append(script)
+    # объекты, которые могут встретиться в коде, и их отпечатки по базам
+    relevant = {}
+    fingerprints = {}
+    for key, group in keys.items():
+        relevant[key] = relevant_targets(group[0].sql, by_name, unindexable)
+        fingerprints[key] = {
+            database_id: catalog_fingerprint([target for target in relevant[key] if target.database_id == database_id])
+            for database_id in database_ids}
+    cached, stale = _load(session, keys, fingerprints)
+    missing = [key for key in keys if len(cached.get(key, {})) < len(database_ids)]
+    logging.info(f"Кэш упоминаний: разобрано текстов {len(missing)}, взято из кэша {len(keys) - len(missing)}")
+    if stats is not None:
+        stats.cache_misses += len(missing)
+        stats.cache_hits += len(keys) - len(missing)
+
+    targets_by_id = {target.id: target for target in targets}
+    scan_targets = {target.id: target for key in missing for target in relevant[key]}
+    scan_requests = [
+        keys[key][0]._replace(allowed=frozenset(target.id for target in relevant[key]))
+        for key in missing]
+    fresh = {}
+    for script_id, target_id, actions in scan_scripts(list(scan_targets.values()), scan_requests, processes, stats):
+        target = targets_by_id[target_id]
+        fresh.setdefault(script_id, {}).setdefault(target.database_id, []).append(
+            [target.foreign_forms[0], sorted(actions)])
+    rows = []
+    for key in missing:
+        script = keys[key][0]
+        entries = cached.setdefault(key, {})
+        for database_id in database_ids:
+            if database_id in entries:
+                continue
+            entries[database_id] = sorted(fresh.get(script.id, {}).get(database_id, []))
+            rows.append({
+                "crc32": key[0],
+                "length": key[1],
+                "home_database_id": key[2],
+                "catalog_database_id": database_id,
+                "catalog_hash": fingerprints[key][database_id],
+                "refs": json.dumps(entries[database_id]),
+            })
+    if store and rows:
+        _delete(session, stale)
+        _delete_removed_catalogs(session, {key[0] for key in missing})
+        for chunk in _chunks(rows):
+            session.execute(ReferenceCache.__table__.insert(), chunk)
+
+    ids = {target.foreign_forms[0]: target.id for target in targets}
+    result = []
+    for key, group in keys.items():
+        references = [
+            (ids[name], set(actions))
+            for refs in cached[key].values()
+            for name, actions in refs
+            if name in ids
+        ]
+        for script in group:
+            for target_id, actions in references:
+                if script.allowed is None or target_id in script.allowed:
+                    result.append((script.id, target_id, actions))
+    return result
+
+
+def prune(session):
+    """
+    Удаляет из кэша записи, crc32 которых нет ни у одного скрипта
+    или компонента (код изменился или нода удалена), и записи удалённых баз.
+    Просматривает весь код в ДПМ, поэтому вызывается командой обслуживания,
+    а не при анализе связей.
+    У нод, синхронизированных без crc32 (триггеры в старых ДПМ), она
+    считается по коду, иначе их записи удалялись бы при каждой очистке.
+    """
+    live = set()
+    for cls in (DBScript, ClientQuery):
+        live.update(crc32 for crc32, in session.query(cls.crc32).filter(cls.crc32 != None).distinct())
+        live.update(
+            binascii.crc32(sql.encode("utf-8"))
+            for sql, in session.query(cls.sql).filter(cls.crc32 == None, cls.sql != None))
+    gone = [
+        crc32 for crc32, in session.query(ReferenceCache.crc32).distinct()
+        if crc32 not in live]
+    removed = 0
+    for chunk in _chunks(gone):
+        removed += session.query(ReferenceCache).filter(
+            ReferenceCache.crc32.in_(chunk)).delete(synchronize_session=False)
+    removed += session.query(ReferenceCache).filter(
+        ~ReferenceCache.catalog_database_id.in_(session.query(Database.id))).delete(synchronize_session=False)
+    if removed:
+        logging.info(f"Кэш упоминаний: удалено записей для исчезнувшего кода {removed}")
+    return removed
+
+
+def _load(session, keys, fingerprints):
+    """
+    Возвращает словарь {ключ скрипта: {id базы объектов: упоминания}}
+    для ключей keys, которые есть в кэше с актуальными отпечатками,
+    и список пар (ключ, id базы объектов) для записей с устаревшими.
+    """
+    cached = {}
+    stale = []
+    database_ids = sorted({database_id for by_database in fingerprints.values() for database_id in by_database})
+    crcs = sorted({key[0] for key in keys})
+    for chunk in _chunks(crcs):
+        query = session.query(ReferenceCache).filter(
+            ReferenceCache.crc32.in_(chunk),
+            ReferenceCache.catalog_database_id.in_(database_ids))
+        for entry in query:
+            key = (entry.crc32, entry.length, entry.home_database_id)
+            if key not in keys:
+                continue
+            if entry.catalog_hash == fingerprints[key][entry.catalog_database_id]:
+                cached.setdefault(key, {})[entry.catalog_database_id] = json.loads(entry.refs)
+            else:
+                stale.append((key, entry.catalog_database_id))
+    return cached, stale
+
+
+def _delete(session, entries):
+    """
+    Удаляет записи кэша по списку пар (ключ скрипта, id базы объектов).
+    """
+    for (crc32, length, home_database_id), database_id in entries:
+        session.query(ReferenceCache).filter(
+            ReferenceCache.crc32 == crc32,
+            ReferenceCache.length == length,
+            ReferenceCache.home_database_id == home_database_id,
+            ReferenceCache.catalog_database_id == database_id
+        ).delete(synchronize_session=False)
+
+
+def _delete_removed_catalogs(session, crcs):
+    """
+    Удаляет записи кода с контрольными суммами crcs, которые относятся
+    к удалённым из ДПМ базам объектов.
+    """
+    for chunk in _chunks(sorted(crcs)):
+        session.query(ReferenceCache).filter(
+            ReferenceCache.crc32.in_(chunk),
+            ~ReferenceCache.catalog_database_id.in_(session.query(Database.id))
+        ).delete(synchronize_session=False)
+
+
+def _chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
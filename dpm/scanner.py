@@ -0,0 +1,470 @@
+"""
+Поиск упоминаний объектов БД в sql-коде за один проход по тексту.
+
+Раньше для каждого объекта строилась регулярка из всех вариантов
+написания его имени (DatabaseObject.get_regexp_for_home_db и
+get_regexp_for_foreign_db), которая прогонялась по всему коду каждого
+скрипта-кандидата. ReferenceScanner собирает короткие имена всех объектов
+в одно выражение и находит все их вхождения в скрипт за один проход;
+варианты записи действий с объектом проверяются только в окрестностях
+найденных вхождений, простым сравнением строк (регулярка объекта
+компилируется, только если в его имени есть спецсимволы).
+
+Результат совпадает с прежним: любое совпадение регулярки объекта
+содержит его короткое имя (длинное и полное имя оканчиваются коротким),
+перед которым стоит пробел, точка или символ выражения, поэтому
+вне окрестностей вхождений совпадений быть не может. Внутри окрестностей
+совпадения ищутся слева направо без перекрытий, с тем же порядком
+альтернатив, что и у re.finditer.
+
+Сканер работает не с ORM-объектами, а с их простыми описаниями
+(ScanTarget, ScanScript), поэтому его можно передавать в дочерние
+процессы: scan_scripts распределяет скрипты по пулу процессов.
+Процессы запускаются через spawn, так как анализ связей идёт в потоках
+планировщика синхронизации, а fork многопоточного процесса копирует
+захваченные другими потоками блокировки. Запуск процессов через spawn
+дорог, поэтому пул (ScanPool) создаётся один раз на синхронизацию и
+общий для всех её анализов связей.
+"""
+import os
+import re
+import time
+import pickle
+import string
+import tempfile
+import threading
+import multiprocessing
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from .link_stats import LinkStats
+
+
+# символы, после которых может начинаться имя объекта в sql-коде
+NAME_PREFIX_CHARS = " .+-*/=("
+# символы, которыми может начинаться вызов функции (действие calc)
+CALC_PREFIX_CHARS = " +-*/=("
+# самый длинный префикс действия перед именем: "delete from "
+MAX_ACTION_PREFIX = 13
+# суммарный объём кода, начиная с которого скрипты разбираются в пуле процессов
+PARALLEL_THRESHOLD = 2 * 1024 * 1024
+# сколько символов кода отправлять процессу за раз
+CHUNK_CHARS = 256 * 1024
+# сколько наборов объектов (сканеров) держит в памяти процесс пула
+WORKER_SCANNERS = 4
+
+
+# варианты записи действий с объектом, в том же порядке, что и в
+# DatabaseObject.get_regexp_universal: текст перед именем, текст после
+# имени и символы, один из которых должен идти следом (None - любой);
+# у calc перед именем стоит сколько угодно символов CALC_PREFIX_CHARS
+ACTION_PATTERNS = {
+    "select": [(" join ", " ", None), (" ", ",", None), ("from ", "", " ,"), (", ", " ", string.ascii_lowercase)],
+    "update": [("update ", " ", None)],
+    "insert": [("into ", " ", None), ("insert ", "", None)],
+    "delete": [("delete from ", " ", None), ("delete ", " ", None)],
+    "truncate": [("truncate ", " ", None)],
+    "drop": [("drop table ", " ", None)],
+    "exec": [("exec ", " ", None), ("execute ", "", None)],
+    "calc": [(None, "(", None)],
+}
+
+
+# объект, упоминания которого ищутся: id ноды, короткое имя, id базы,
+# действия, варианты написания имени для скриптов своей и чужих баз и
+# исходники регулярок (нужны, только если имя нельзя искать как текст)
+ScanTarget = namedtuple("ScanTarget", [
+    "id", "name", "database_id", "actions", "home_forms", "foreign_forms", "home_regexp", "foreign_regexp"])
+# скрипт, в котором ищутся упоминания: id ноды, id базы (у компонентов
+# может быть None), код и множество id объектов, которые нужно искать
+# (None - все объекты)
+ScanScript = namedtuple("ScanScript", ["id", "database_id", "sql", "allowed"])
+
+
+def trie_pattern(names):
+    """
+    Собирает из списка строк регулярку, совпадающую с самой длинной из них.
+
+    Строки складываются в префиксное дерево, поэтому в каждой позиции
+    текста регулярка проверяет по одному символу, а не перебирает все
+    строки по очереди: t1, t10 и t2 превращаются в t(?:1(?:0)?|2).
+    """
+    trie = {}
+    for name in names:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        # пустой ключ отмечает конец строки
+        node[""] = {}
+
+    def build(node):
+        terminal = "" in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not terminal:
+            return branches[0]
+        pattern = "(?:" + "|".join(branches) + ")"
+        # жадный ? сначала пробует более длинные строки
+        return pattern + "?" if terminal else pattern
+
+    return build(trie)
+
+
+def target_from_object(obj):
+    name = obj.name.lower()
+    schema = obj.schema.lower()
+    database = obj.database.name.lower()
+    literal = all(
+        re.escape(part) == part and part[:1] not in CALC_PREFIX_CHARS
+        for part in (name, schema, database))
+    return ScanTarget(
+        id=obj.id,
+        name=name,
+        database_id=obj.database_id,
+        actions=tuple(obj.sql_actions),
+        home_forms=(name, f"{schema}.{name}", f"{database}.{schema}.{name}"),
+        foreign_forms=(f"{database}.{schema}.{name}",),
+        home_regexp=None if literal else obj.get_regexp_for_home_db(),
+        foreign_regexp=None if literal else obj.get_regexp_for_foreign_db())
+
+
+def script_from_node(node, allowed=None):
+    return ScanScript(
+        id=node.id,
+        database_id=node.database_id,
+        sql=node.sql or "",
+        allowed=None if allowed is None else frozenset(obj.id for obj in allowed))
+
+
+class ReferenceScanner:
+    """
+    Ищет в скриптах упоминания объектов targets (список ScanTarget).
+    Если передан stats (LinkStats), в него пишется статистика по каждому
+    объекту и скрипту.
+
+    Использование:
+        scanner = ReferenceScanner(targets)
+        for target_id, actions in scanner.scan(script).items():
+            ...
+    """
+
+    def __init__(self, targets, stats=None):
+        self.stats = stats
+        self.targets = {}
+        for target in targets:
+            self.targets.setdefault(target.name, []).append(target)
+        # более длинные имена идут первыми, чтобы из имён, начинающихся
+        # в одной позиции, находилось самое длинное; более короткие
+        # достаются из self._prefixes
+        names = sorted(self.targets, key=len, reverse=True)
+        self._prefixes = {
+            name: [other for other in names if len(other) < len(name) and name.startswith(other)]
+            for name in names
+        }
+        if names:
+            prefix = re.escape(NAME_PREFIX_CHARS)
+            self._detector = re.compile(f"(?<=[{prefix}])(?=({trie_pattern(names)}))")
+        else:
+            self._detector = None
+        self._regexps = {}
+        self._alternatives = {}
+
+    # region public methods
+    def scan(self, script):
+        """
+        Возвращает словарь {id объекта: множество действий} для всех
+        объектов, упомянутых в коде скрипта script (ScanScript).
+        """
+        stats = self.stats
+        if stats is not None:
+            started = time.perf_counter()
+        result = {}
+        names = self.find_names(script.sql)
+        for name, positions in names.items():
+            for target in self.targets[name]:
+                if script.allowed is not None and target.id not in script.allowed:
+                    continue
+                if stats is not None:
+                    target_started = time.perf_counter()
+                home = target.database_id == script.database_id
+                if (target.home_regexp if home else target.foreign_regexp) is None:
+                    actions = self._match_literal(target, home, script.sql, positions)
+                else:
+                    actions = self._match_regexp(target, home, script.sql, positions)
+                if actions:
+                    result[target.id] = actions
+                if stats is not None:
+                    item = stats.object(target.id)
+                    item.scripts += 1
+                    item.candidates += len(positions)
+                    item.matches += bool(actions)
+                    item.seconds += time.perf_counter() - target_started
+        if stats is not None:
+            item = stats.script(script.id)
+            item.length += len(script.sql)
+            item.names += len(names)
+            item.candidates += sum(len(positions) for positions in names.values())
+            item.matches += len(result)
+            item.seconds += time.perf_counter() - started
+        return result
+
+    def find_names(self, sql):
+        """
+        Возвращает словарь {короткое имя: список позиций} для всех
+        вхождений имён объектов в текст sql.
+        """
+        found = {}
+        if self._detector is None:
+            return found
+        for match in self._detector.finditer(sql):
+            name = match.group(1)
+            position = match.start()
+            found.setdefault(name, []).append(position)
+            for shorter in self._prefixes[name]:
+                found.setdefault(shorter, []).append(position)
+        return found
+    # endregion
+
+    # region utility methods
+    def _regexp_for(self, target, home):
+        key = (target.id, home)
+        if key not in self._regexps:
+            started = time.perf_counter()
+            self._regexps[key] = re.compile(target.home_regexp if home else target.foreign_regexp)
+            if self.stats is not None:
+                self.stats.object(target.id).compile_seconds += time.perf_counter() - started
+        return self._regexps[key]
+
+    def _alternatives_for(self, target, home):
+        """
+        Все варианты совпадения для объекта в порядке приоритета:
+        (действие, написание имени, текст перед, текст после, символы).
+        """
+        key = (target.id, home)
+        if key not in self._alternatives:
+            forms = target.home_forms if home else target.foreign_forms
+            self._alternatives[key] = [
+                (action, form) + pattern
+                for action in target.actions
+                for form in forms
+                for pattern in ACTION_PATTERNS[action]
+            ]
+        return self._alternatives[key]
+
+    def _match_literal(self, target, home, sql, positions):
+        """
+        Повторяет re.finditer регулярки объекта без самой регулярки:
+        для каждого вхождения имени проверяются все варианты записи
+        действий, после чего из найденных совпадений, как и в finditer,
+        выбираются самые левые неперекрывающиеся (при равенстве - по
+        порядку вариантов в регулярке).
+        """
+        alternatives = self._alternatives_for(target, home)
+        # кандидаты: (самое левое начало, самое правое начало, приоритет, конец, действие)
+        candidates = []
+        for position in positions:
+            for order, (action, form, before, after, follow) in enumerate(alternatives):
+                form_start = position - len(form) + len(target.name)
+                if form_start < 0 or not sql.startswith(form, form_start):
+                    continue
+                end = form_start + len(form)
+                if not sql.startswith(after, end):
+                    continue
+                end += len(after)
+                if follow is not None:
+                    if end >= len(sql) or sql[end] not in follow:
+                        continue
+                    end += 1
+                if before is None:
+                    start = form_start
+                    while start > 0 and sql[start - 1] in CALC_PREFIX_CHARS:
+                        start -= 1
+                    if start < form_start:
+                        candidates.append((start, form_start - 1, order, end, action))
+                else:
+                    start = form_start - len(before)
+                    if start >= 0 and sql.startswith(before, start):
+                        candidates.append((start, start, order, end, action))
+        actions = set()
+        pos = 0
+        while candidates:
+            best = None
+            for lowest, highest, order, end, action in candidates:
+                if highest < pos:
+                    continue
+                start = max(lowest, pos)
+                if best is None or (start, order) < best[:2]:
+                    best = (start, order, end, action)
+            if best is None:
+                break
+            actions.add(best[3])
+            pos = best[2]
+        return actions
+
+    def _match_regexp(self, target, home, sql, positions):
+        """
+        Повторяет re.finditer регулярки объекта, но пробует совпадения
+        только в окрестностях вхождений его имени. Нужен для имён со
+        спецсимволами регулярок, которые нельзя искать как текст.
+        """
+        regexp = self._regexp_for(target, home)
+        qualifier = len(target.foreign_forms[0]) - len(target.name)
+        actions = set()
+        # pos - позиция, с которой finditer продолжил бы поиск
+        pos = 0
+        for position in sorted(positions):
+            if position < pos:
+                continue
+            start = max(pos, self._window_start(sql, position, qualifier))
+            while start <= position:
+                match = regexp.match(sql, start)
+                if match:
+                    actions.add(match.lastgroup)
+                    pos = match.end()
+                    break
+                start += 1
+            else:
+                # окна соседних вхождений перекрываются, уже проверенные
+                # позиции второй раз не проверяем
+                pos = position + 1
+        return actions
+
+    @staticmethod
+    def _window_start(sql, position, qualifier):
+        """
+        Самая левая позиция, с которой может начинаться совпадение,
+        содержащее вхождение имени в позиции position.
+        """
+        start = max(0, position - qualifier - MAX_ACTION_PREFIX)
+        # перед вызовом функции может стоять сколько угодно символов выражения
+        while start > 0 and sql[start - 1] in CALC_PREFIX_CHARS:
+            start -= 1
+        return start
+    # endregion
+
+
+class ScanPool:
+    """
+    Пул процессов для разбора кода, общий для анализов связей одной
+    синхронизации (например, для потоков SyncScheduler). Процессы
+    запускаются при первом разборе, которому они нужны, и работают до
+    close(), поэтому анализы разных баз не запускают их заново; вместе
+    анализы никогда не используют больше processes процессов.
+    processes - количество процессов, по умолчанию 1: разбор идёт
+    в вызывающем потоке и процессы не запускаются.
+
+    Использование:
+        with ScanPool(4) as pool:
+            scan_scripts(targets, scripts, pool)
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or 1
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # region public methods
+    def map(self, targets, chunks, collect_stats=False):
+        """
+        Разбирает пачки скриптов chunks на объекты targets в процессах пула,
+        возвращает пары (результат пачки, LinkStats пачки или None) в том же
+        порядке. Описания объектов передаются процессам через временный файл:
+        каждый процесс читает его один раз и держит сканер в памяти (не больше
+        WORKER_SCANNERS).
+        """
+        handle, path = tempfile.mkstemp(prefix="dpm_scan_", suffix=".pickle")
+        try:
+            with os.fdopen(handle, "wb") as file:
+                pickle.dump(targets, file, pickle.HIGHEST_PROTOCOL)
+            return list(self._get_executor().map(_scan_in_worker, [(path, chunk, collect_stats) for chunk in chunks]))
+        finally:
+            os.remove(path)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+    # endregion
+
+    # region utility methods
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context("spawn")
+                self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+            return self._executor
+    # endregion
+
+
+def scan_scripts(targets, scripts, processes=None, stats=None):
+    """
+    Ищет упоминания объектов targets во всех скриптах scripts (ScanScript).
+    Возвращает список кортежей (id скрипта, id объекта, множество действий).
+
+    Если кода много, скрипты разбиваются на пачки и разбираются в пуле
+    процессов. processes - общий для нескольких разборов ScanPool или
+    количество процессов (по умолчанию 1, без пула); пул, созданный по
+    количеству, закрывается после разбора.
+    stats - LinkStats, в который собирается статистика разбора.
+    """
+    pool = processes if isinstance(processes, ScanPool) else ScanPool(processes)
+    try:
+        total = sum(len(script.sql) for script in scripts)
+        chunks = list(_chunks(scripts))
+        if pool.processes <= 1 or total < PARALLEL_THRESHOLD or len(chunks) <= 1:
+            return _scan_chunk(scripts, ReferenceScanner(targets, stats))
+        result = []
+        for chunk_result, chunk_stats in pool.map(targets, chunks, stats is not None):
+            result.extend(chunk_result)
+            if stats is not None:
+                stats.merge(chunk_stats)
+        return result
+    finally:
+        if pool is not processes:
+            pool.close()
+
+
+# сканеры процесса пула по путям файлов с описаниями объектов
+_worker_scanners = OrderedDict()
+
+
+def _scan_in_worker(task):
+    path, scripts, collect_stats = task
+    if path not in _worker_scanners:
+        with open(path, "rb") as file:
+            _worker_scanners[path] = ReferenceScanner(pickle.load(file))
+        while len(_worker_scanners) > WORKER_SCANNERS:
+            _worker_scanners.popitem(last=False)
+    scanner = _worker_scanners[path]
+    # статистика возвращается по каждой пачке отдельно
+    scanner.stats = LinkStats() if collect_stats else None
+    return _scan_chunk(scripts, scanner), scanner.stats
+
+
+def _scan_chunk(scripts, scanner):
+    return [
+        (script.id, target_id, actions)
+        for script in scripts
+        for target_id, actions in scanner.scan(script).items()
+    ]
+
+
+def _chunks(scripts):
+    chunk = []
+    size = 0
+    for script in scripts:
+        chunk.append(script)
+        size += len(script.sql)
+        if size >= CHUNK_CHARS:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
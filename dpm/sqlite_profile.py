@@ -0,0 +1,216 @@
+"""
+Профиль работы с файлом ДПМ в SQLite.
+
+Синхронизация пишет в ДПМ долго и большими транзакциями, а GUI в это
+время должен читать связи. Поэтому файл ДПМ работает в режиме WAL:
+читатели видят последнее закоммиченное состояние и не ждут писателя,
+писатель не ждёт читателей.
+
+Движков два:
+    писатель - один на процесс, через него идёт синхронизация; соединение
+    писателя захватывает общую блокировку записи (TimedLock) перед первым
+    изменяющим запросом транзакции и отпускает её после commit или
+    rollback (WriterConnection), поэтому в каждый момент транзакция записи
+    открыта только у одного соединения, а остальные ждут блокировку,
+    а не упираются в busy_timeout. Блокировку держит соединение, а не
+    поток: второе соединение того же потока тоже ждёт её, а если не
+    дождалось за busy_timeout, падает с "database is locked", как упал бы
+    сам SQLite. Поэтому код синхронизации готовит изменения заранее и
+    пишет их непосредственно перед commit'ом;
+    читатель - пул соединений только на чтение (mode=ro, query_only) для
+    GUI и отчётов.
+
+Каждому соединению ставятся прагмы: synchronous=NORMAL (в режиме WAL
+не теряет целостность, а commit не ждёт fsync), увеличенный кэш страниц,
+отображение файла в память и busy_timeout, чтобы при редких конфликтах
+соединение ждало, а не падало с "database is locked".
+"""
+import os
+import time
+import sqlite3
+import threading
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+# прагмы по умолчанию; значения можно переопределить в конфиге (dpm_pragmas)
+PRAGMAS = {
+    "synchronous": "NORMAL",
+    # отрицательное значение - размер в килобайтах (64 МБ)
+    "cache_size": -65536,
+    "mmap_size": 256 * 1024 * 1024,
+    "busy_timeout": 30000,
+    "temp_store": "MEMORY",
+}
+# сколько соединений держать в пулах
+WRITER_POOL_SIZE = 5
+READER_POOL_SIZE = 4
+# запросы, с которых начинается транзакция записи
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER")
+
+
+def is_sqlite_file(url):
+    url = make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def create_dpm_engine(url, read_only=False, pragmas=None, write_lock=None):
+    """
+    Создаёт движок ДПМ. Для файла SQLite включается режим WAL, ставятся
+    прагмы PRAGMAS (с поправками из pragmas), соединения берутся из пула;
+    если read_only, файл открывается только на чтение. Для других СУБД
+    и базы в памяти возвращается обычный движок.
+    write_lock - блокировка записи (TimedLock), которую соединения писателя
+    держат на время транзакции записи; если не задана, у движка своя.
+    """
+    if not is_sqlite_file(url):
+        return create_engine(url, echo=False)
+    path = os.path.abspath(make_url(url).database)
+    settings = dict(PRAGMAS, **(pragmas or {}))
+    if read_only:
+        settings["query_only"] = 1
+    elif write_lock is None:
+        write_lock = TimedLock()
+
+    def connect():
+        if read_only:
+            uri = "file:" + path.replace("\\", "/") + "?mode=ro"
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(path, check_same_thread=False, factory=WriterConnection)
+            connection.write_lock = write_lock
+            connection.lock_timeout = settings["busy_timeout"] / 1000
+            # режим журнала хранится в самом файле, ставить его может только писатель
+            connection.execute("PRAGMA journal_mode = WAL")
+        for name, value in settings.items():
+            # PRAGMA не поддерживает параметры запроса
+            connection.execute(f"PRAGMA {name} = {value}")
+        return connection
+
+    return create_engine(
+        "sqlite://",
+        creator=connect,
+        poolclass=QueuePool,
+        pool_size=READER_POOL_SIZE if read_only else WRITER_POOL_SIZE,
+        max_overflow=READER_POOL_SIZE if read_only else WRITER_POOL_SIZE,
+        echo=False)
+
+
+class WriterCursor(sqlite3.Cursor):
+    """
+    Курсор соединения писателя: перед изменяющим запросом захватывает
+    блокировку записи соединения (WriterConnection.begin_write).
+    """
+
+    def execute(self, sql, *args):
+        if is_write_statement(sql):
+            self.connection.begin_write()
+        return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        if is_write_statement(sql):
+            self.connection.begin_write()
+        return super().executemany(sql, *args)
+
+
+class WriterConnection(sqlite3.Connection):
+    """
+    Соединение писателя ДПМ. Держит блокировку записи write_lock от первого
+    изменяющего запроса транзакции до commit или rollback (пул делает
+    rollback при возврате соединения, так что блокировка не теряется).
+    Если блокировку не удалось захватить за lock_timeout секунд, запрос
+    падает с sqlite3.OperationalError "database is locked".
+    """
+    write_lock = None
+    lock_timeout = -1
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or WriterCursor)
+
+    def begin_write(self):
+        if self.write_lock is not None and not getattr(self, "_writing", False):
+            if not self.write_lock.acquire(timeout=self.lock_timeout):
+                raise sqlite3.OperationalError("database is locked (блокировка записи в ДПМ занята)")
+            self._writing = True
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self._end_write()
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._end_write()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._end_write()
+
+    def _end_write(self):
+        if getattr(self, "_writing", False):
+            self._writing = False
+            self.write_lock.release()
+
+
+def is_write_statement(sql):
+    words = sql.lstrip().split(None, 1)
+    return bool(words) and words[0].upper() in WRITE_STATEMENTS
+
+
+class TimedLock:
+    """
+    Блокировка записи в ДПМ со статистикой ожидания.
+
+    Блокировка не повторно входимая: её держит соединение (WriterConnection),
+    а не поток, поэтому отпустить её может и другой поток (соединение,
+    возвращённое в пул сборщиком мусора).
+
+    waits - сколько раз блокировку пришлось ждать (в том числе безуспешно,
+    до таймаута); wait_seconds - общее время ожидания; longest_wait - самое
+    долгое ожидание; held_seconds - сколько времени блокировка была захвачена.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.longest_wait = 0.0
+        self.held_seconds = 0.0
+        self._acquired_at = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self._lock.acquire(blocking=False):
+            if not blocking:
+                return False
+            started = time.perf_counter()
+            acquired = self._lock.acquire(timeout=timeout)
+            waited = time.perf_counter() - started
+            self.waits += 1
+            self.wait_seconds += waited
+            self.longest_wait = max(self.longest_wait, waited)
+            if not acquired:
+                return False
+        self.acquisitions += 1
+        self._acquired_at = time.perf_counter()
+        return True
+
+    def release(self):
+        self.held_seconds += time.perf_counter() - self._acquired_at
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    @property
+    def summary(self):
+        return (
+            f"Блокировка записи в ДПМ: захватов {self.acquisitions}, ожиданий {self.waits}, "
+            f"ждали {self.wait_seconds:.2f} с (максимум {self.longest_wait:.2f} с), "
+            f"удерживали {self.held_seconds:.2f} с")
@@ -1,43 +1,361 @@
+from collections import OrderedDict, deque, namedtuple
+from sqlalchemy import union_all, select, literal, and_
+from sqlalchemy.orm import with_polymorphic, selectin_polymorphic
 from . import models
+from .reachability import ReachabilityIndex
+
+
+# сколько нод по умолчанию держать в кэше хранилища
+DEFAULT_CAPACITY = 5000
+# сколько id запрашивать из ДПМ за раз
+CHUNK_SIZE = 500
+# во сколько раз больше, чем нод, хранилище держит в кэше описаний нод
+HEADERS_RATIO = 10
+
+# результат NodeStorage.get_closure:
+# depths - словарь {id ноды: глубина}, у начальных нод глубина 0;
+# neighbours - словарь {id ноды: [(id соседа, список действий)]}
+Closure = namedtuple("Closure", ["depths", "neighbours"])
+
+# лёгкое описание ноды без загрузки orm-модели (см. NodeStorage.get_headers);
+# node_class - класс модели
+NodeHeader = namedtuple("NodeHeader", ["id", "name", "type", "label", "node_class"])
+
+# как загружать поля подклассов Node:
+# joined - одним запросом со всеми таблицами наследников (with_polymorphic);
+# selectin - запрос к Node и по одному запросу на каждый встретившийся
+# подкласс (selectin_polymorphic);
+# lazy - поля подкласса дочитываются отдельным запросом на каждую ноду
+LOADING_STRATEGIES = ("joined", "selectin", "lazy")
+DEFAULT_LOADING = "joined"
+
+
+class StorageException(Exception):
+    pass
+
 
 class NodeStorage:
+    """
+    Доступ GUI к нодам ДПМ с кэшем последних запрошенных нод.
 
-    nodes = {}
-    session = None
+    Кэш ограничен capacity нодами; при переполнении вытесняются ноды,
+    которые дольше всего не запрашивались. Сессия SQLAlchemy хранит
+    загруженные объекты по слабым ссылкам, поэтому держит их в памяти
+    именно кэш хранилища; у вытесненной ноды сбрасываются загруженные
+    атрибуты и связи (session.expire), после чего сборщик мусора может
+    её удалить. Если нода понадобится снова, она перечитается из ДПМ.
+    Ноды с несохранёнными изменениями не сбрасываются.
 
-    def __init__(self, session):
-        if self.session is None:
-            self.session = session
+    hits, misses, evictions - счётчики попаданий, промахов и вытеснений.
 
+    snapshot - необязательный снимок связей всей ДПМ (dpm.adjacency);
+    если он задан, потомки и предки нод берутся из него без запросов к ДПМ.
+    reachability - индекс достижимости (dpm.reachability) по тому же
+    снимку; если он не передан, создаётся при первом обращении к нему.
+    Обновляется вместе со снимком.
+    loading - способ загрузки полей подклассов (см. LOADING_STRATEGIES).
+    """
+
+    def __init__(self, session, capacity=DEFAULT_CAPACITY, snapshot=None, reachability=None, loading=DEFAULT_LOADING):
+        if loading not in LOADING_STRATEGIES:
+            raise StorageException(f"Неизвестный способ загрузки нод {loading}, допустимы: {', '.join(LOADING_STRATEGIES)}")
+        self.session = session
+        self.capacity = capacity
+        self.loading = loading
+        self.snapshot = snapshot
+        self._reachability = reachability
+        self.nodes = OrderedDict()
+        self.headers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # region properties
+    @property
+    def reachability(self):
+        """
+        Индекс достижимости по снимку связей или None, если снимка нет.
+        """
+        if self._reachability is None and self.snapshot is not None:
+            self._reachability = ReachabilityIndex(self.snapshot)
+        return self._reachability
+    # endregion
+
+    # region public methods
     def get_node_by_id(self, node_id):
+        """
+        Возвращает ноду с id node_id или None, если такой ноды нет.
+        """
+        if self.session is None:
+            return None
+        if node_id in self.nodes:
+            self.hits += 1
+            self.nodes.move_to_end(node_id)
+            return self.nodes[node_id]
+        self.misses += 1
+        node = self._query_nodes().filter(models.Node.id == node_id).first()
+        if node is not None:
+            self._remember(node)
+        return node
+
+    def get_many(self, ids):
+        """
+        Возвращает список нод с id из ids в том же порядке; недостающие
+        в кэше ноды читаются из ДПМ пачками, несуществующие id пропускаются.
+        """
         if self.session is None:
             return []
-        if not id in self.nodes:
-            new_node = self.session.query(models.Node).filter_by(id=node_id).one()
-            self.nodes[id] = new_node
-        return self.nodes[id]
-    
+        ids = list(dict.fromkeys(ids))
+        found = {}
+        missing = []
+        for node_id in ids:
+            if node_id in self.nodes:
+                self.hits += 1
+                self.nodes.move_to_end(node_id)
+                found[node_id] = self.nodes[node_id]
+            else:
+                self.misses += 1
+                missing.append(node_id)
+        for start in range(0, len(missing), CHUNK_SIZE):
+            chunk = missing[start:start + CHUNK_SIZE]
+            for node in self._query_nodes().filter(models.Node.id.in_(chunk)):
+                found[node.id] = node
+        for node_id in missing:
+            if node_id in found:
+                self._remember(found[node_id])
+        return [found[node_id] for node_id in ids if node_id in found]
+
     def get_group_of_nodes_by_ids(self, ids):
-        nodes_to_get = set()
-        result = []
-        for id in ids:
-            if not id in self.nodes:
-                nodes_to_get.add(id)
+        return self.get_many(ids)
+
+    def get_headers(self, ids):
+        """
+        Возвращает список NodeHeader для нод с id из ids в том же порядке -
+        только id, название, тип и подпись, одним запросом к таблице Node
+        на пачку id, без загрузки моделей. Подходит там, где не нужны
+        поля подклассов, например при построении графа.
+        Описания кэшируются отдельно от нод (до capacity * HEADERS_RATIO),
+        для нод из кэша описания строятся без запроса.
+        """
+        if self.session is None:
+            return []
+        ids = list(dict.fromkeys(ids))
+        found = {}
+        missing = []
+        for node_id in ids:
+            if node_id in self.headers:
+                self.headers.move_to_end(node_id)
+                found[node_id] = self.headers[node_id]
+            elif node_id in self.nodes:
+                node = self.nodes[node_id]
+                found[node_id] = NodeHeader(node.id, node.name, node.type, node.label, node.node_class)
             else:
-                result.append(self.nodes[id])
-        new_nodes = self.session.query(models.Node).filter(models.Node.id.in_(list(nodes_to_get))).all()
-        for node in new_nodes:
-            self.nodes[node.id] = node
-        result.extend(new_nodes)
+                missing.append(node_id)
+        nodes = models.Node.__table__
+        polymorphic_map = models.Node.__mapper__.polymorphic_map
+        for start in range(0, len(missing), CHUNK_SIZE):
+            chunk = missing[start:start + CHUNK_SIZE]
+            query = select([nodes.c.id, nodes.c.name, nodes.c.type]).where(nodes.c.id.in_(chunk))
+            for node_id, name, node_type in self.session.execute(query):
+                mapper = polymorphic_map.get(node_type)
+                node_class = models.Node if mapper is None else mapper.class_
+                found[node_id] = NodeHeader(node_id, name, node_type, node_class.make_label(node_id, name), node_class)
+                self.headers[node_id] = found[node_id]
+        while len(self.headers) > self.capacity * HEADERS_RATIO:
+            self.headers.popitem(last=False)
+        return [found[node_id] for node_id in ids if node_id in found]
+
+    def get_children_of(self, nodes):
+        """
+        Возвращает словарь {id ноды: [(id потомка, список действий)]} -
+        то же, что get_children каждой из нод nodes, но одним запросом
+        на все ноды (см. Node.select_children).
+        """
+        if self.snapshot is not None:
+            return self.snapshot.children_of(node.id for node in nodes)
+        return self._get_neighbours(nodes, "select_children")
+
+    def get_parents_of(self, nodes):
+        """
+        То же, что get_children_of, но для предков (get_parents).
+        """
+        if self.snapshot is not None:
+            return self.snapshot.parents_of(node.id for node in nodes)
+        return self._get_neighbours(nodes, "select_parents")
+
+    def get_closure(self, ids, upwards=False, max_depth=None):
+        """
+        Возвращает все ноды, достижимые из нод ids вниз (или вверх, если
+        upwards), вместе со связями - одним рекурсивным запросом к ДПМ
+        (WITH RECURSIVE по select_relation).
+
+        max_depth ограничивает глубину обхода: соседи читаются для нод
+        на глубине не больше max_depth, поэтому связи нод последнего
+        уровня ведут за пределы max_depth. Без max_depth обход идёт,
+        пока не закончатся связи.
+        Возвращает Closure; глубина ноды - длина кратчайшего пути до неё.
+        """
+        if self.snapshot is not None:
+            return self.snapshot.closure(ids, upwards, max_depth)
+        ids = list(dict.fromkeys(ids))
+        if self.session is None or not ids:
+            return Closure({node_id: 0 for node_id in ids}, {node_id: [] for node_id in ids})
+        relation = self.select_relation(upwards).cte("relation")
+        node_column, neighbour_column, mask_column = relation.c
+        nodes = models.Node.__table__
+        if max_depth is None:
+            # без глубины UNION отбрасывает уже найденные ноды,
+            # поэтому обход завершается и на графе с циклами
+            closure = select([nodes.c.id.label("node_id")])\
+                .where(nodes.c.id.in_(ids))\
+                .cte("closure", recursive=True)
+            closure = closure.union(
+                select([neighbour_column]).where(node_column == closure.c.node_id))
+        else:
+            closure = select([nodes.c.id.label("node_id"), literal(0).label("depth")])\
+                .where(nodes.c.id.in_(ids))\
+                .cte("closure", recursive=True)
+            closure = closure.union(
+                select([neighbour_column, closure.c.depth + 1])
+                .where(and_(node_column == closure.c.node_id, closure.c.depth < max_depth)))
+        query = select([node_column, neighbour_column, mask_column])\
+            .where(node_column.in_(select([closure.c.node_id])))
+        neighbours = {node_id: [] for node_id in ids}
+        for node_id, neighbour_id, mask in self.session.execute(query):
+            neighbours.setdefault(node_id, []).append((neighbour_id, models.Edge.attributes_from_mask(mask)))
+        return Closure(self._depths(ids, neighbours), neighbours)
+
+    @staticmethod
+    def select_relation(upwards=False):
+        """
+        Запрос, возвращающий все связи ДПМ в одном направлении: строки
+        (id ноды, id потомка или предка, маска действий) по select_children
+        или select_parents всех классов нод, включая вложенность
+        (АРМ - форма, форма - компонент, база - объект, таблица - триггер).
+        """
+        method = "select_parents" if upwards else "select_children"
+        nodes = models.Node.__table__
+        queries = []
+        for mapper in models.Node.__mapper__.self_and_descendants:
+            # у каждого класса свои правила, поэтому берутся ноды ровно этого класса
+            ids = select([nodes.c.id]).where(nodes.c.type == mapper.polymorphic_identity)
+            query = getattr(mapper.class_, method)(ids)
+            if query is not None:
+                queries.append(query)
+        return union_all(*queries)
+
+    def invalidate(self, ids=None):
+        """
+        Убирает ноды из кэша и сбрасывает их загруженные атрибуты, чтобы
+        при следующем обращении они перечитались из ДПМ. Вызывается после
+        синхронизации (в GUI - по опросу dpm.change_tracker.ChangeTracker);
+        без ids сбрасывается весь кэш. Снимок связей
+        и индекс достижимости обновляются для тех же нод (без ids -
+        снимок загружается заново, а кэш индекса сбрасывается).
+        """
+        if self.snapshot is not None and self.session is not None:
+            changed = self.snapshot.refresh(self.session, ids)
+            if self._reachability is not None:
+                self._reachability.update(changed)
+        if ids is None:
+            self.nodes.clear()
+            self.headers.clear()
+            if self.session is not None:
+                self.session.expire_all()
+            return
+        for node_id in ids:
+            self.headers.pop(node_id, None)
+            node = self.nodes.pop(node_id, None)
+            if node is not None:
+                self._release(node)
+
+    def cache_info(self):
+        """
+        Возвращает словарь со статистикой кэша.
+        """
+        return {
+            "size": len(self.nodes),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def get_stats(self, ids):
+        """
+        Статистика связей нод ids (см. dpm.node_stats): словарь {id: NodeStats};
+        нод, для которых статистика ещё не посчитана, в нём нет.
+        """
+        ids = list(ids)
+        result = {}
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start:start + CHUNK_SIZE]
+            for stats in self.session.query(models.NodeStats).filter(models.NodeStats.node_id.in_(chunk)):
+                result[stats.node_id] = stats
         return result
 
-    
     def get_databases_list(self):
         if self.session is None:
             return []
         return self.session.query(models.Database).all()
-    
+
     def get_applications_list(self):
         if self.session is None:
             return []
         return self.session.query(models.Application).all()
+    # endregion
+
+    # region utility methods
+    def _query_nodes(self):
+        if self.loading == "joined":
+            return self.session.query(with_polymorphic(models.Node, "*"))
+        if self.loading == "selectin":
+            subclasses = [mapper.class_ for mapper in models.Node.__mapper__.self_and_descendants][1:]
+            return self.session.query(models.Node).options(selectin_polymorphic(models.Node, subclasses))
+        return self.session.query(models.Node)
+
+    def _get_neighbours(self, nodes, method):
+        nodes = list(nodes)
+        result = {node.id: [] for node in nodes}
+        if self.session is None:
+            return result
+        # в одном запросе не больше CHUNK_SIZE id, независимо от классов нод
+        for start in range(0, len(nodes), CHUNK_SIZE):
+            by_class = {}
+            for node in nodes[start:start + CHUNK_SIZE]:
+                by_class.setdefault(node.node_class, []).append(node.id)
+            queries = [
+                query
+                for query in (getattr(cls, method)(ids) for cls, ids in by_class.items())
+                if query is not None
+            ]
+            if not queries:
+                continue
+            for node_id, neighbour_id, mask in self.session.execute(union_all(*queries)):
+                result[node_id].append((neighbour_id, models.Edge.attributes_from_mask(mask)))
+        return result
+
+    @staticmethod
+    def _depths(ids, neighbours):
+        depths = {node_id: 0 for node_id in ids}
+        queue = deque(ids)
+        while queue:
+            node_id = queue.popleft()
+            for neighbour_id, _ in neighbours.get(node_id, []):
+                if neighbour_id not in depths:
+                    depths[neighbour_id] = depths[node_id] + 1
+                    queue.append(neighbour_id)
+        return depths
+
+    def _remember(self, node):
+        self.nodes[node.id] = node
+        self.nodes.move_to_end(node.id)
+        while len(self.nodes) > self.capacity:
+            _, evicted = self.nodes.popitem(last=False)
+            self.evictions += 1
+            self._release(evicted)
+
+    def _release(self, node):
+        if node in self.session and not self.session.is_modified(node):
+            self.session.expire(node)
+    # endregion
@@ -0,0 +1,67 @@
+"""
+Небольшая ДПМ для тестов: база с таблицами и процедурами (в том числе
+с циклом вызовов), триггер и АРМ с формой и компонентом.
+
+    App -> Form1 -> q_clients -exec-> p_report <-exec-> p_load -exec-> p_read -select-> Clients
+    p_write -insert-> Accounts, Clients -> tr_clients -update-> Accounts
+"""
+from dpm.models import (
+    Application, Database, DBStoredProcedure, DBTable, DBTrigger, ClientQuery, Edge, EDGE_OPERATIONS, Form)
+from dpm.migrations import prepare_dpm
+from dpm.sqlite_profile import create_dpm_engine
+from sqlalchemy.orm import sessionmaker
+
+
+# связи между процедурами, компонентом и таблицами: (источник, приёмник, действие)
+EDGES = [
+    ("p_read", "Clients", "select"),
+    ("p_load", "p_read", "exec"),
+    ("p_report", "p_load", "exec"),
+    ("p_load", "p_report", "exec"),
+    ("p_write", "Accounts", "insert"),
+    ("tr_clients", "Accounts", "update"),
+    ("q_clients", "p_report", "exec"),
+]
+
+
+def open_dpm(path):
+    """
+    Создаёт (или открывает) файл ДПМ path и возвращает сессию.
+    """
+    engine = create_dpm_engine(f"sqlite:///{path}")
+    prepare_dpm(engine)
+    return sessionmaker(bind=engine)()
+
+
+def procedure(name, database, number):
+    return DBStoredProcedure(
+        name=name, schema="dbo", sql=f"create procedure {name}", crc32=number,
+        database_object_id=number, database=database)
+
+
+def build_sample(session):
+    """
+    Заполняет ДПМ нодами и связями из описания модуля (с commit);
+    возвращает словарь {имя ноды: id}.
+    """
+    bank = Database(name="Bank")
+    clients = DBTable(name="Clients", schema="dbo", database_object_id=1, database=bank)
+    accounts = DBTable(name="Accounts", schema="dbo", database_object_id=2, database=bank)
+    trigger = DBTrigger(
+        name="tr_clients", schema="dbo", sql="create trigger tr_clients", crc32=3, database_object_id=3,
+        is_update=True, is_delete=False, is_insert=False, table=clients, database=bank)
+    procedures = [
+        procedure(name, bank, number)
+        for number, name in enumerate(["p_read", "p_load", "p_report", "p_write"], start=4)]
+    app = Application(name="App", path="app.dproj", default_database=bank)
+    form = Form(name="Form1.dfm", path="form1.dfm")
+    form.applications.append(app)
+    query = ClientQuery(
+        name="q_clients", sql="exec p_report", crc32=8, component_type="TADOQuery", form=form, database=bank)
+    session.add_all([bank, clients, accounts, trigger, app, form, query] + procedures)
+    session.flush()
+    ids = {node.name: node.id for node in [bank, clients, accounts, trigger, app, form, query] + procedures}
+    for sourse, dest, action in EDGES:
+        session.add(Edge(sourse_id=ids[sourse], dest_id=ids[dest], operations=EDGE_OPERATIONS[action]))
+    session.commit()
+    return ids
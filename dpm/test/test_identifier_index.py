@@ -0,0 +1,59 @@
+from dpm.identifier_index import candidates_for_names, refresh_identifier_index, tokenize
+from dpm.models import Application, BaseDPM, ClientQuery, Form
+from dpm.scanner import ReferenceScanner, script_from_node, target_from_object
+from dpm.test.test_scanner import make_objects, random_sql
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import unittest
+import random
+
+
+class TestCandidatesForNames(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        BaseDPM.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.objects = make_objects()
+        for number, obj in enumerate(self.objects, start=1):
+            obj.database_object_id = number
+        bank = self.objects[0].database
+        form = Form(name="Form1.dfm", path="form1.dfm")
+        form.applications.append(Application(name="App", path="app.dproj", default_database=bank))
+        rnd = random.Random(35)
+        self.components = [
+            ClientQuery(
+                name=f"q{number}", sql=random_sql(rnd, self.objects), crc32=number,
+                component_type="TADOQuery", form=form, database=bank)
+            for number in range(300)]
+        self.session.add_all(self.objects + self.components)
+        refresh_identifier_index(self.session)
+
+    def test_prefix_semantics(self):
+        # кандидаты - ровно компоненты, в коде которых есть идентификатор,
+        # начинающийся с имени объекта (в том числе Clients_log для Clients)
+        names = {obj.name for obj in self.objects}
+        found = candidates_for_names(self.session, names)
+        for name in names:
+            expected = {
+                component.id for component in self.components
+                if any(token.startswith(name.lower()) for token in tokenize(component.sql))}
+            self.assertEqual(found[name], expected, name)
+
+    def test_candidates_cover_scanner(self):
+        # всё, что находят регулярки связей, есть среди кандидатов индекса
+        found = candidates_for_names(self.session, {obj.name for obj in self.objects})
+        scanner = ReferenceScanner([target_from_object(obj) for obj in self.objects])
+        names = {obj.id: obj.name for obj in self.objects}
+        for component in self.components:
+            for target_id in scanner.scan(script_from_node(component)):
+                self.assertIn(component.id, found[names[target_id]], (names[target_id], component.sql))
+
+    def test_not_indexable_name(self):
+        found = candidates_for_names(self.session, {"Pay$Tab", "odd name"})
+        self.assertIsNone(found["odd name"])
+        self.assertIsNotNone(found["Pay$Tab"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+from dpm.impact import analyze_impact, resolve_objects, parse_identifier, read_identifiers, ImpactException
+from dpm.storage import NodeStorage
+from dpm.adjacency import AdjacencySnapshot
+from dpm.reachability import ReachabilityIndex
+from dpm.models import Database, DBTable
+from dpm.test.sample_dpm import open_dpm, build_sample
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+
+class TestResolveObjects(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.session = open_dpm(os.path.join(self.directory, "dpm.sqlite"))
+        self.ids = build_sample(self.session)
+        base = Database(name="Банк")
+        table = DBTable(name="Клиенты", schema="dbo", database_object_id=1, database=base)
+        self.session.add_all([base, table])
+        self.session.commit()
+        self.ids["Клиенты"] = table.id
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.directory)
+
+    def test_parse_identifier(self):
+        self.assertEqual(parse_identifier(" [Bank].[DBO].Clients "), ("bank", "dbo", "clients"))
+        for text in ["Clients", "dbo.Clients", "Bank..Clients", "a.b.c.d"]:
+            with self.assertRaises(ImpactException):
+                parse_identifier(text)
+
+    def test_resolve(self):
+        resolved, missing = resolve_objects(self.session, [
+            "bank.dbo.CLIENTS", "[Bank].[dbo].[p_read]", "БАНК.dbo.КЛИЕНТЫ", "Bank.dbo.Missing", "Other.dbo.Clients",
+            "Bank.dbo.Clients"])
+        self.assertEqual(resolved, {
+            "bank.dbo.CLIENTS": self.ids["Clients"],
+            "[Bank].[dbo].[p_read]": self.ids["p_read"],
+            "БАНК.dbo.КЛИЕНТЫ": self.ids["Клиенты"],
+        })
+        self.assertEqual(missing, ["Bank.dbo.Missing", "Other.dbo.Clients"])
+
+    def test_read_identifiers(self):
+        path = os.path.join(self.directory, "release.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("# релиз\nBank.dbo.Clients\n\n-- процедуры\n  Bank.dbo.p_read  \n")
+        self.assertEqual(read_identifiers(path), ["Bank.dbo.Clients", "Bank.dbo.p_read"])
+
+
+class TestImpactReport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.session = open_dpm(os.path.join(self.directory, "dpm.sqlite"))
+        self.ids = build_sample(self.session)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.directory)
+
+    def analyze(self, storage):
+        return analyze_impact(storage, ["Bank.dbo.Accounts", "Bank.dbo.Clients", "Bank.dbo.Nothing"])
+
+    def test_report(self):
+        report = self.analyze(NodeStorage(self.session))
+        self.assertEqual(report.missing, ["Bank.dbo.Nothing"])
+        entries = {entry.label: (entry.depth, entry.origin) for entry in report.entries}
+        accounts, clients = self.ids["Accounts"], self.ids["Clients"]
+        self.assertEqual(entries, {
+            "Bank.dbo.p_write": (1, accounts),
+            # при равной длине пути побеждает объект, стоящий в списке раньше
+            "Bank.dbo.tr_clients": (1, accounts),
+            "Bank.dbo.p_read": (1, clients),
+            "Bank.dbo.p_load": (2, clients),
+            "Bank.dbo.p_report": (3, clients),
+            "Form1.dfm.q_clients": (4, clients),
+            "Form1.dfm": (5, clients),
+            "App": (6, clients),
+        })
+        grouped = {title: [entry.label for entry in entries] for title, entries in report.grouped()}
+        self.assertEqual(grouped, {
+            "АРМы": ["App"],
+            "Формы": ["Form1.dfm"],
+            "Компоненты": ["Form1.dfm.q_clients"],
+            "Объекты БД": ["Bank.dbo.p_read", "Bank.dbo.p_write", "Bank.dbo.tr_clients", "Bank.dbo.p_load", "Bank.dbo.p_report"],
+        })
+        self.assertIn("Не найдены в ДПМ (1): Bank.dbo.Nothing", report.report())
+
+    def test_same_with_reachability_index(self):
+        expected = self.analyze(NodeStorage(self.session)).to_dict()
+        snapshot = AdjacencySnapshot.build(self.session)
+        self.assertEqual(self.analyze(NodeStorage(self.session, snapshot=snapshot)).to_dict(), expected)
+        storage = NodeStorage(self.session, snapshot=snapshot, reachability=ReachabilityIndex(snapshot))
+        self.assertEqual(self.analyze(storage).to_dict(), expected)
+
+    def test_export_json(self):
+        report = self.analyze(NodeStorage(self.session))
+        path = os.path.join(self.directory, "impact.json")
+        report.export_json(path)
+        with open(path, encoding="utf-8") as f:
+            exported = json.load(f)
+        self.assertEqual(exported["sources"], {"Bank.dbo.Accounts": self.ids["Accounts"], "Bank.dbo.Clients": self.ids["Clients"]})
+        self.assertEqual(exported["impact"]["АРМы"][0]["origin"], "Bank.dbo.Clients")
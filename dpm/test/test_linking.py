@@ -0,0 +1,91 @@
+from dpm.linking import analize_links
+from dpm.models import Application, BaseDPM, ClientQuery, Database, DBStoredProcedure, DBTable, Edge, Form, Node
+from dpm.test.test_scanner import random_sql
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import datetime
+import random
+import unittest
+
+
+START = datetime.datetime(2024, 1, 1)
+
+
+class NoDependencies:
+    """
+    Соединение с базой без системных зависимостей.
+    """
+
+    def execute(self, query):
+        return []
+
+
+class TestIncrementalLinking(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        BaseDPM.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.rnd = random.Random(36)
+        self.bank = Database(name="Bank", last_update=START)
+        self.tables = [
+            DBTable(name=name, schema="dbo", database_object_id=number, database=self.bank, last_update=START)
+            for number, name in enumerate(["Clients", "Clients_log", "Client", "Accounts"], start=1)]
+        self.procedures = [
+            DBStoredProcedure(
+                name=f"p_{name}", schema="dbo", database_object_id=number, database=self.bank,
+                last_update=START, sql="")
+            for number, name in enumerate(["read", "load", "load_all", "write"], start=10)]
+        objects = self.tables + self.procedures
+        for procedure in self.procedures:
+            procedure.sql = random_sql(self.rnd, objects)
+        form = Form(name="Form1.dfm", path="form1.dfm")
+        form.applications.append(Application(name="App", path="app.dproj", default_database=self.bank))
+        self.components = [
+            ClientQuery(
+                name=f"q{number}", sql=random_sql(self.rnd, objects), crc32=number, component_type="TADOQuery",
+                form=form, database=self.bank, last_update=START)
+            for number in range(40)]
+        self.session.add_all(objects + self.components)
+        self.session.commit()
+
+    def link(self):
+        analize_links(self.session, NoDependencies())
+        self.session.commit()
+        return {
+            (edge.sourse_id, edge.dest_id, frozenset(edge.get_attributes_list()))
+            for edge in self.session.query(Edge)}
+
+    def relink_from_scratch(self):
+        self.session.query(Edge).delete()
+        for node in self.session.query(Node):
+            node.last_revision = None
+        self.session.commit()
+        return self.link()
+
+    def test_incremental_equals_full(self):
+        self.link()
+        changed = START + datetime.timedelta(days=1)
+        objects = self.tables + self.procedures
+        for procedure in self.procedures[:2]:
+            procedure.sql = random_sql(self.rnd, objects)
+            procedure.last_update = changed
+        self.tables[3].name = "Account"
+        self.tables[3].last_update = changed
+        for component in self.components[:5]:
+            component.sql = random_sql(self.rnd, objects)
+            component.crc32 += 1000
+            component.last_update = changed
+        self.bank.last_update = changed
+        self.session.commit()
+        incremental = self.link()
+        self.assertTrue(incremental)
+        self.assertEqual(incremental, self.relink_from_scratch())
+
+    def test_no_changes(self):
+        linked = self.link()
+        self.assertEqual(self.link(), linked)
+
+
+if __name__ == "__main__":
+    unittest.main()
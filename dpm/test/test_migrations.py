@@ -0,0 +1,168 @@
+from dpm.migrations import prepare_dpm, set_version, MigrationException, SCHEMA_VERSION, SEARCH_NAME_INDEX, LOOKUP_INDEXES
+from dpm.linking import upsert_edges
+from dpm.models import Edge, EDGE_OPERATIONS, Node
+from dpm.sqlite_profile import create_dpm_engine
+from dpm.test.sample_dpm import open_dpm, build_sample
+from sqlalchemy.orm import sessionmaker
+from unittest import mock
+import unittest
+import tempfile
+import shutil
+import os
+
+
+# схема Node и Edge до первой миграции: действия связи - отдельные поля,
+# у ноды нет search_name
+NODE_V0 = '''
+    CREATE TABLE "Node" (
+        id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(120) NOT NULL, last_revision DATETIME,
+        last_update DATETIME, type VARCHAR(50), id_broken BOOLEAN NOT NULL, is_dummy BOOLEAN NOT NULL)'''
+EDGE_V0 = '''
+    CREATE TABLE "Edge" (
+        id INTEGER NOT NULL PRIMARY KEY, sourse_id INTEGER NOT NULL, dest_id INTEGER NOT NULL, comment TEXT,
+        is_verified BOOLEAN NOT NULL, is_broken BOOLEAN NOT NULL, is_dummy BOOLEAN NOT NULL,
+        calc BOOLEAN NOT NULL, "select" BOOLEAN NOT NULL, "insert" BOOLEAN NOT NULL, "update" BOOLEAN NOT NULL,
+        "delete" BOOLEAN NOT NULL, "exec" BOOLEAN NOT NULL, "truncate" BOOLEAN NOT NULL, "drop" BOOLEAN NOT NULL)'''
+EDGE_V0_ROW = '''
+    INSERT INTO "Edge" VALUES (
+        {id}, {sourse}, {dest}, NULL, {verified}, 0, 0, 0, {select}, {insert}, 0, 0, 0, 0, 0)'''
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_dpm_engine(f"sqlite:///{os.path.join(self.directory, 'dpm.sqlite')}")
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def create_v0(self):
+        with self.engine.begin() as connection:
+            connection.execute(NODE_V0)
+            connection.execute(EDGE_V0)
+            connection.execute('''INSERT INTO "Node" VALUES (1, 'Клиенты', NULL, NULL, 'Таблица', 0, 0)''')
+            connection.execute('''INSERT INTO "Node" VALUES (2, 'P_Load', NULL, NULL, 'Процедура', 0, 0)''')
+            # дубли одной связи с разными действиями
+            connection.execute(EDGE_V0_ROW.format(id=1, sourse=2, dest=1, verified=0, select=1, insert=0))
+            connection.execute(EDGE_V0_ROW.format(id=2, sourse=2, dest=1, verified=1, select=0, insert=1))
+
+    def test_new_dpm(self):
+        self.assertEqual(prepare_dpm(self.engine), SCHEMA_VERSION)
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA user_version").scalar(), SCHEMA_VERSION)
+
+    def test_migrate_from_v0(self):
+        self.create_v0()
+        self.assertEqual(prepare_dpm(self.engine), 0)
+        session = sessionmaker(bind=self.engine)()
+        try:
+            edges = session.query(Edge).all()
+            self.assertEqual(len(edges), 1)
+            self.assertEqual(edges[0].operations, EDGE_OPERATIONS["select"] | EDGE_OPERATIONS["insert"])
+            self.assertTrue(edges[0].is_verified)
+            names = dict(session.query(Node.id, Node.search_name))
+            self.assertEqual(names, {1: "клиенты", 2: "p_load"})
+        finally:
+            session.close()
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA user_version").scalar(), SCHEMA_VERSION)
+            indexes = {row[1] for row in connection.execute('PRAGMA index_list("Node")')}
+            self.assertIn(SEARCH_NAME_INDEX[0], indexes)
+        # повторно миграции не выполняются
+        self.assertEqual(prepare_dpm(self.engine), SCHEMA_VERSION)
+
+    def test_lookup_indexes(self):
+        # миграция создаёт те же индексы, что объявлены в моделях
+        prepare_dpm(self.engine)
+        with self.engine.begin() as connection:
+            declared = self.index_names(connection)
+            for name, _ in LOOKUP_INDEXES:
+                connection.execute(f'DROP INDEX "{name}"')
+            set_version(connection, 2)
+        self.assertEqual(prepare_dpm(self.engine), 2)
+        with self.engine.connect() as connection:
+            self.assertEqual(self.index_names(connection), declared)
+        self.assertLessEqual({name for name, _ in LOOKUP_INDEXES}, declared)
+
+    @staticmethod
+    def index_names(connection):
+        return {name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+    def test_no_cascades(self):
+        # внешние ключи SQLite не проверяет, каскадное удаление не сработало бы
+        prepare_dpm(self.engine)
+        with self.engine.connect() as connection:
+            schema = " ".join(sql for sql, in connection.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL"))
+            self.assertEqual(connection.execute("PRAGMA foreign_keys").scalar(), 0)
+        self.assertNotIn("CASCADE", schema.upper())
+
+    def test_newer_version(self):
+        prepare_dpm(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION + 1}")
+        with self.assertRaises(MigrationException):
+            prepare_dpm(self.engine)
+
+    def test_search_name_follows_name(self):
+        prepare_dpm(self.engine)
+        session = sessionmaker(bind=self.engine)()
+        try:
+            node = Node(name="Счета")
+            session.add(node)
+            session.flush()
+            self.assertEqual(node.search_name, "счета")
+            node.name = "ACCOUNTS"
+            self.assertEqual(node.search_name, "accounts")
+        finally:
+            session.close()
+
+
+class TestUpsertEdges(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.session = open_dpm(os.path.join(self.directory, "dpm.sqlite"))
+        self.ids = build_sample(self.session)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.directory)
+
+    def edge(self, sourse, dest):
+        return self.session.query(Edge).filter(
+            Edge.sourse_id == self.ids[sourse], Edge.dest_id == self.ids[dest]).one_or_none()
+
+    def upsert(self):
+        rows = [
+            # новая связь
+            {"sourse_id": self.ids["p_write"], "dest_id": self.ids["Clients"], "operations": EDGE_OPERATIONS["select"]},
+            # изменились действия
+            {"sourse_id": self.ids["p_read"], "dest_id": self.ids["Clients"], "operations": EDGE_OPERATIONS["update"]},
+            # подтверждённая и сломанная связи не меняются
+            {"sourse_id": self.ids["p_write"], "dest_id": self.ids["Accounts"], "operations": EDGE_OPERATIONS["delete"]},
+            {"sourse_id": self.ids["p_load"], "dest_id": self.ids["p_read"], "operations": EDGE_OPERATIONS["select"]},
+        ]
+        self.edge("p_write", "Accounts").is_verified = True
+        self.edge("p_load", "p_read").is_broken = True
+        self.session.flush()
+        upsert_edges(self.session, rows)
+        self.session.expire_all()
+        self.assertEqual(self.edge("p_write", "Clients").operations, EDGE_OPERATIONS["select"])
+        self.assertFalse(self.edge("p_write", "Clients").is_verified)
+        self.assertEqual(self.edge("p_read", "Clients").operations, EDGE_OPERATIONS["update"])
+        self.assertEqual(self.edge("p_write", "Accounts").operations, EDGE_OPERATIONS["insert"])
+        self.assertEqual(self.edge("p_load", "p_read").operations, EDGE_OPERATIONS["exec"])
+        self.assertEqual(self.session.query(Edge).count(), 8)
+
+    def test_upsert(self):
+        self.upsert()
+
+    def test_without_on_conflict(self):
+        with mock.patch("dpm.linking.sqlite3.sqlite_version_info", (3, 23, 0)):
+            self.upsert()
+
+    def test_empty(self):
+        upsert_edges(self.session, [])
+        self.assertEqual(self.session.query(Edge).count(), 7)
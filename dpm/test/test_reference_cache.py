@@ -0,0 +1,59 @@
+from dpm.models import BaseDPM, Database, DBStoredProcedure, DBTable, ReferenceCache
+from dpm.reference_cache import prune, scan_with_cache
+from dpm.scanner import script_from_node, target_from_object
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import binascii
+import unittest
+
+
+class TestReferenceCache(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        BaseDPM.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.bank = Database(name="Bank")
+        self.clients = DBTable(name="Clients", schema="dbo", database_object_id=1, database=self.bank)
+        self.procedure = self.add_procedure("p_read", "select * from clients ", 2)
+        self.session.commit()
+
+    def add_procedure(self, name, sql, number):
+        procedure = DBStoredProcedure(
+            name=name, schema="dbo", sql=sql, crc32=binascii.crc32(sql.encode("utf-8")),
+            database_object_id=number, database=self.bank)
+        self.session.add(procedure)
+        return procedure
+
+    def scan(self):
+        return scan_with_cache(
+            self.session, [target_from_object(self.clients)], [script_from_node(self.procedure)], processes=1)
+
+    def test_prune_is_explicit(self):
+        self.assertEqual(self.scan(), [(self.procedure.id, self.clients.id, {"select"})])
+        old_crc32 = self.procedure.crc32
+        self.procedure.sql = "update clients set a = 1"
+        self.procedure.crc32 = binascii.crc32(self.procedure.sql.encode("utf-8"))
+        self.session.flush()
+        self.assertEqual(self.scan(), [(self.procedure.id, self.clients.id, {"update"})])
+        # анализ не просматривает всю ДПМ: запись прежнего кода остаётся до prune
+        crcs = {crc32 for crc32, in self.session.query(ReferenceCache.crc32)}
+        self.assertEqual(crcs, {old_crc32, self.procedure.crc32})
+        self.assertEqual(prune(self.session), 1)
+        crcs = {crc32 for crc32, in self.session.query(ReferenceCache.crc32)}
+        self.assertEqual(crcs, {self.procedure.crc32})
+
+    def test_removed_catalog(self):
+        self.scan()
+        other = Database(name="Other")
+        self.session.add(other)
+        self.session.flush()
+        self.session.execute(ReferenceCache.__table__.insert(), [{
+            "crc32": self.procedure.crc32, "length": 1, "home_database_id": 0,
+            "catalog_database_id": other.id + 1, "catalog_hash": "", "refs": "[]"}])
+        self.assertEqual(prune(self.session), 1)
+        self.assertEqual(self.session.query(ReferenceCache).count(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
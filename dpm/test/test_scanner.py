@@ -0,0 +1,139 @@
+from dpm.scanner import ReferenceScanner, ScanPool, ScanScript, scan_scripts, target_from_object
+from dpm.models import Database, DBScalarFunction, DBStoredProcedure, DBTable, DBView
+from unittest import mock
+import unittest
+import random
+import re
+
+
+# куски, из которых собирается случайный код: действия, разделители и
+# окончания, которые регулярки объектов различают
+PREFIXES = [
+    "select * from ", " join ", "update ", "insert ", "insert into ", "into ", "delete from ", "delete ",
+    "truncate ", "drop table ", "exec ", "execute ", "set @x = ", "(", ", ", " ", ".", "+", "where a=", "x", "",
+]
+SUFFIXES = [" ", ",", "(", "", " a", " 1", ")", "x", ".", "\n"]
+
+
+def make_objects():
+    """
+    Объекты двух баз; имена начинаются одно с другого, одно - со спецсимволом.
+    """
+    bank = Database(id=1, name="Bank")
+    other = Database(id=2, name="Other")
+    objects = [
+        DBTable(id=10, name="Clients", schema="dbo", database=bank),
+        DBTable(id=11, name="Clients_log", schema="dbo", database=bank),
+        DBTable(id=12, name="Client", schema="arc", database=bank),
+        DBTable(id=13, name="Pay$Tab", schema="dbo", database=bank),
+        DBStoredProcedure(id=14, name="Client_add", schema="dbo", database=bank),
+        DBScalarFunction(id=15, name="fn_rate", schema="dbo", database=bank),
+        DBView(id=16, name="v_clients", schema="dbo", database=bank),
+        DBTable(id=20, name="Clients", schema="dbo", database=other),
+        DBStoredProcedure(id=21, name="sync", schema="dbo", database=other),
+    ]
+    for obj in objects:
+        obj.database_id = obj.database.id
+    return objects
+
+
+def old_references(objects, script):
+    """
+    Прежний поиск: регулярка каждого объекта по всему коду скрипта.
+    """
+    result = {}
+    for obj in objects:
+        if script.allowed is not None and obj.id not in script.allowed:
+            continue
+        home = obj.database_id == script.database_id
+        regexp = obj.get_regexp_for_home_db() if home else obj.get_regexp_for_foreign_db()
+        actions = {match.lastgroup for match in re.compile(regexp).finditer(script.sql)}
+        if actions:
+            result[obj.id] = actions
+    return result
+
+
+def random_sql(rnd, objects):
+    names = []
+    for obj in objects:
+        names.extend([
+            obj.name.lower(),
+            f"{obj.schema}.{obj.name}".lower(),
+            f"{obj.database.name}.{obj.schema}.{obj.name}".lower()])
+    return "".join(
+        rnd.choice(PREFIXES) + rnd.choice(names) + rnd.choice(SUFFIXES)
+        for _ in range(rnd.randint(1, 12)))
+
+
+class TestReferenceScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.objects = make_objects()
+        self.targets = [target_from_object(obj) for obj in self.objects]
+        self.scanner = ReferenceScanner(self.targets)
+
+    def test_same_as_regexps(self):
+        rnd = random.Random(34)
+        for number in range(1000):
+            script = ScanScript(number, rnd.choice([1, 2, None]), random_sql(rnd, self.objects), None)
+            self.assertEqual(self.scanner.scan(script), old_references(self.objects, script), script.sql)
+
+    def test_actions(self):
+        sql = "\n".join([
+            "select * from clients c join dbo.clients_log l on 1=1",
+            "update arc.client set a = 1",
+            "insert into bank.dbo.clients values (1)",
+            "exec client_add 1",
+            "set @x = fn_rate(1)",
+            "truncate other.dbo.clients ",
+            "execute other.dbo.sync",
+        ])
+        found = self.scanner.scan(ScanScript(1, 1, sql, None))
+        self.assertEqual(found, {
+            10: {"select", "insert"},
+            11: {"select"},
+            12: {"update"},
+            14: {"exec"},
+            15: {"calc"},
+            20: {"truncate"},
+            21: {"exec"},
+        })
+
+    def test_foreign_database_needs_full_name(self):
+        found = self.scanner.scan(ScanScript(1, 2, "select * from clients ", None))
+        self.assertEqual(found, {20: {"select"}})
+        # короткое имя после "from" - только отдельным словом
+        found = self.scanner.scan(ScanScript(1, 2, "select * from bank.dbo.clients ", None))
+        self.assertEqual(found, {10: {"select"}})
+
+    def test_allowed(self):
+        sql = "select * from clients join clients_log on 1=1 "
+        found = self.scanner.scan(ScanScript(1, 1, sql, frozenset({11})))
+        self.assertEqual(found, {11: {"select"}})
+
+    def test_scan_scripts(self):
+        rnd = random.Random(35)
+        scripts = [ScanScript(number, rnd.choice([1, 2]), random_sql(rnd, self.objects), None) for number in range(200)]
+        expected = sorted(
+            (script.id, target_id, sorted(actions))
+            for script in scripts
+            for target_id, actions in old_references(self.objects, script).items())
+        result = sorted(
+            (script_id, target_id, sorted(actions))
+            for script_id, target_id, actions in scan_scripts(self.targets, scripts, processes=1))
+        self.assertEqual(result, expected)
+
+    def test_scan_pool(self):
+        # один пул на несколько разборов с разными наборами объектов
+        rnd = random.Random(37)
+        scripts = [ScanScript(number, rnd.choice([1, 2]), random_sql(rnd, self.objects), None) for number in range(200)]
+        with mock.patch("dpm.scanner.PARALLEL_THRESHOLD", 0), mock.patch("dpm.scanner.CHUNK_CHARS", 2000):
+            with ScanPool(2) as pool:
+                for targets in (self.targets, self.targets[:4], self.targets):
+                    self.assertEqual(
+                        sorted(scan_scripts(targets, scripts, pool)),
+                        sorted(scan_scripts(targets, scripts, processes=1)))
+
+    def test_without_objects(self):
+        scanner = ReferenceScanner([])
+        self.assertEqual(scanner.scan(ScanScript(1, 1, "select * from clients ", None)), {})
@@ -0,0 +1,100 @@
+from dpm.sqlite_profile import create_dpm_engine, TimedLock
+from dpm.migrations import prepare_dpm
+from dpm.models import Database
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import OperationalError
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+import tempfile
+import shutil
+import os
+
+
+class TestSqliteProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = f"sqlite:///{os.path.join(self.directory, 'dpm.sqlite')}"
+        self.lock = TimedLock()
+        self.writer = create_dpm_engine(self.url, write_lock=self.lock, pragmas={"busy_timeout": 100})
+        prepare_dpm(self.writer)
+        self.reader = create_dpm_engine(self.url, read_only=True)
+
+    def tearDown(self):
+        self.writer.dispose()
+        self.reader.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_wal_and_read_only(self):
+        with self.writer.connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), "wal")
+        writer = sessionmaker(bind=self.writer)()
+        writer.add(Database(name="Bank"))
+        writer.flush()
+        # читатель не ждёт открытую транзакцию записи и видит закоммиченное
+        reader = sessionmaker(bind=self.reader)()
+        self.assertEqual(reader.query(Database).count(), 0)
+        writer.commit()
+        reader.rollback()
+        self.assertEqual(reader.query(Database).count(), 1)
+        reader.add(Database(name="Other"))
+        with self.assertRaises(OperationalError):
+            reader.commit()
+        reader.close()
+        writer.close()
+
+    def test_writers_take_turns(self):
+        # транзакции пишут задолго до commit; без блокировки записи
+        # остальные писатели упали бы с "database is locked"
+        def write(number):
+            session = sessionmaker(bind=self.writer)()
+            try:
+                for index in range(20):
+                    session.add(Database(name=f"db{number}_{index}"))
+                    session.flush()
+                session.commit()
+            finally:
+                session.close()
+
+        before = self.lock.acquisitions
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(write, range(4)))
+        session = sessionmaker(bind=self.writer)()
+        self.assertEqual(session.query(Database).count(), 80)
+        session.close()
+        self.assertEqual(self.lock.acquisitions - before, 4)
+
+    def test_lock_per_connection(self):
+        # второе соединение того же потока не пишет, пока первое держит блокировку
+        first = sessionmaker(bind=self.writer)()
+        second = sessionmaker(bind=self.writer)()
+        first.add(Database(name="Bank"))
+        first.flush()
+        waits = self.lock.waits
+        second.add(Database(name="Other"))
+        with self.assertRaises(OperationalError):
+            second.flush()
+        self.assertEqual(self.lock.waits, waits + 1)
+        second.rollback()
+        first.commit()
+        self.assertFalse(self.lock.locked())
+        second.add(Database(name="Other"))
+        second.commit()
+        self.assertEqual(second.query(Database).count(), 2)
+        first.close()
+        second.close()
+
+    def test_lock_released(self):
+        session = sessionmaker(bind=self.writer)()
+        session.add(Database(name="Bank"))
+        session.flush()
+        self.assertTrue(self.lock.locked())
+        session.rollback()
+        self.assertFalse(self.lock.locked())
+        session.add(Database(name="Bank"))
+        session.flush()
+        session.close()
+        self.assertFalse(self.lock.locked())
+        session = sessionmaker(bind=self.writer)()
+        self.assertEqual(session.query(Database).count(), 0)
+        session.close()
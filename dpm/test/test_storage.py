@@ -0,0 +1,360 @@
+from dpm.storage import NodeStorage, StorageException, LOADING_STRATEGIES
+from dpm.adjacency import AdjacencySnapshot, DOWN, UP
+from dpm.reachability import ReachabilityIndex
+from dpm.change_tracker import ChangeTracker
+from dpm.node_stats import update_node_stats, longest_chains
+from dpm.linking import remove_orphan_edges
+from dpm.models import Edge, EDGE_OPERATIONS, Node, NodeStats
+from dpm.test.sample_dpm import open_dpm, build_sample, procedure
+from sqlalchemy import inspect
+from unittest import mock
+from collections import deque
+import unittest
+import tempfile
+import shutil
+import os
+
+
+def normalized(neighbours):
+    """
+    Списки соседей без учёта порядка; нода без соседей и отсутствующая
+    нода не различаются (так их читает DpmGraph).
+    """
+    return {
+        node_id: sorted((neighbour_id, tuple(attrs)) for neighbour_id, attrs in items)
+        for node_id, items in neighbours.items()
+        if items
+    }
+
+
+def load_layers(storage, ids, levels, upwards):
+    """
+    Обход в ширину по слоям, как в DpmGraph: соседи всего слоя одним
+    вызовом get_parents_of/get_children_of. Возвращает глубины нод и
+    соседей нод на глубине меньше levels.
+    """
+    depths = {node_id: 0 for node_id in ids}
+    neighbours = {}
+    frontier = storage.get_headers(ids)
+    for level in range(levels):
+        if not frontier:
+            break
+        layer = storage.get_parents_of(frontier) if upwards else storage.get_children_of(frontier)
+        neighbours.update(layer)
+        new_ids = []
+        for items in layer.values():
+            for neighbour_id, _ in items:
+                if neighbour_id not in depths:
+                    depths[neighbour_id] = level + 1
+                    new_ids.append(neighbour_id)
+        frontier = storage.get_headers(new_ids)
+    return depths, neighbours
+
+
+class DpmTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.session = open_dpm(os.path.join(self.directory, "dpm.sqlite"))
+        self.ids = build_sample(self.session)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.directory)
+
+
+class TestNodeStorage(DpmTestCase):
+
+    def test_lru_eviction(self):
+        storage = NodeStorage(self.session, capacity=2)
+        first = storage.get_node_by_id(self.ids["Clients"])
+        storage.get_node_by_id(self.ids["Accounts"])
+        storage.get_node_by_id(self.ids["Clients"])
+        storage.get_node_by_id(self.ids["p_read"])
+        # вытеснена нода, которая дольше всего не запрашивалась
+        self.assertEqual(list(storage.nodes), [self.ids["Clients"], self.ids["p_read"]])
+        self.assertEqual(storage.cache_info(), {"size": 2, "capacity": 2, "hits": 1, "misses": 3, "evictions": 1})
+        storage.get_many([self.ids["Accounts"], self.ids["p_load"], self.ids["p_read"]])
+        self.assertEqual(list(storage.nodes), [self.ids["Accounts"], self.ids["p_load"]])
+        self.assertEqual(storage.evictions, 3)
+        # у вытесненной ноды сброшены загруженные атрибуты
+        self.assertIn("name", inspect(first).unloaded)
+
+    def test_dirty_nodes_are_not_released(self):
+        storage = NodeStorage(self.session, capacity=1)
+        node = storage.get_node_by_id(self.ids["Clients"])
+        node.name = "Clients2"
+        storage.get_node_by_id(self.ids["Accounts"])
+        self.assertEqual(node.name, "Clients2")
+
+    def test_invalidate(self):
+        storage = NodeStorage(self.session)
+        node = storage.get_node_by_id(self.ids["Clients"])
+        storage.get_headers([self.ids["Clients"]])
+        self.session.execute(Node.__table__.update().where(Node.__table__.c.id == self.ids["Clients"]).values(name="Clients_new"))
+        self.assertEqual(storage.get_node_by_id(self.ids["Clients"]).name, "Clients")
+        storage.invalidate([self.ids["Clients"]])
+        self.assertNotIn(self.ids["Clients"], storage.headers)
+        self.assertEqual(storage.get_node_by_id(self.ids["Clients"]).name, "Clients_new")
+        self.assertEqual(storage.get_headers([self.ids["Clients"]])[0].name, "Clients_new")
+        self.assertIs(storage.get_node_by_id(self.ids["Clients"]), node)
+        storage.invalidate()
+        self.assertEqual(storage.cache_info()["size"], 0)
+
+    def test_loading_strategies(self):
+        ids = sorted(self.ids.values())
+        expected = None
+        for loading in LOADING_STRATEGIES:
+            self.session.expunge_all()
+            storage = NodeStorage(self.session, loading=loading)
+            nodes = storage.get_many(ids)
+            loaded = [(node.id, node.node_class, node.label, getattr(node, "sql", None)) for node in nodes]
+            expected = expected or loaded
+            self.assertEqual(loaded, expected, loading)
+            headers = NodeStorage(self.session).get_headers(ids)
+            self.assertEqual([(header.id, header.node_class, header.label) for header in headers], [item[:3] for item in loaded])
+        with self.assertRaises(StorageException):
+            NodeStorage(self.session, loading="eager")
+
+    def test_missing_nodes(self):
+        storage = NodeStorage(self.session)
+        self.assertIsNone(storage.get_node_by_id(-1))
+        self.assertEqual([node.id for node in storage.get_many([-1, self.ids["App"]])], [self.ids["App"]])
+
+
+class TestNeighbours(DpmTestCase):
+
+    def test_same_as_model_methods(self):
+        storage = NodeStorage(self.session)
+        nodes = storage.get_many(sorted(self.ids.values()))
+        children = {node.id: [(child.id, attrs) for child, attrs in node.get_children()] for node in nodes}
+        parents = {node.id: [(parent.id, attrs) for parent, attrs in node.get_parents()] for node in nodes}
+        self.assertEqual(normalized(storage.get_children_of(nodes)), normalized(children))
+        self.assertEqual(normalized(storage.get_parents_of(nodes)), normalized(parents))
+
+
+class TestClosure(DpmTestCase):
+
+    def storages(self):
+        snapshot = AdjacencySnapshot.build(self.session)
+        return [NodeStorage(self.session), NodeStorage(self.session, snapshot=snapshot)]
+
+    def test_layers_match_closure(self):
+        for storage in self.storages():
+            for upwards in (False, True):
+                for node_id in self.ids.values():
+                    for levels in range(1, 5):
+                        depths, neighbours = load_layers(storage, [node_id], levels, upwards)
+                        closure = storage.get_closure([node_id], upwards, levels - 1)
+                        self.assertEqual(closure.depths, depths)
+                        self.assertEqual(normalized(closure.neighbours), normalized(neighbours))
+                    depths, neighbours = load_layers(storage, [node_id], len(self.ids), upwards)
+                    closure = storage.get_closure([node_id], upwards)
+                    self.assertEqual(closure.depths, depths)
+                    self.assertEqual(normalized(closure.neighbours), normalized(neighbours))
+
+    def test_snapshot_matches_dpm(self):
+        plain, cached = self.storages()
+        for upwards in (False, True):
+            for max_depth in (None, 0, 2):
+                closure = plain.get_closure([self.ids["Clients"], self.ids["Bank"]], upwards, max_depth)
+                expected = cached.get_closure([self.ids["Clients"], self.ids["Bank"]], upwards, max_depth)
+                self.assertEqual(closure.depths, expected.depths)
+                self.assertEqual(normalized(closure.neighbours), normalized(expected.neighbours))
+        closure = plain.get_closure([self.ids["Clients"]], upwards=True)
+        self.assertEqual(closure.depths[self.ids["App"]], 6)
+
+
+class TestSnapshotRefresh(DpmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.snapshot = AdjacencySnapshot.build(self.session)
+        self.reachability = ReachabilityIndex(self.snapshot)
+        self.storage = NodeStorage(self.session, snapshot=self.snapshot, reachability=self.reachability)
+
+    def change(self):
+        """
+        Изменяет связи и ноды ДПМ, как синхронизация; возвращает id изменившихся нод.
+        """
+        ids = self.ids
+        # ответы индекса для всех нод в кэше: update должен сбросить устаревшие
+        for node_id in ids.values():
+            for upwards in (False, True):
+                self.reachability.reachable([node_id], upwards)
+        bank = self.storage.get_node_by_id(ids["Bank"])
+        added = procedure("p_new", bank, 100)
+        self.session.add(added)
+        self.session.flush()
+        self.session.add_all([
+            Edge(sourse_id=added.id, dest_id=ids["p_write"], operations=EDGE_OPERATIONS["exec"]),
+            Edge(sourse_id=ids["p_read"], dest_id=added.id, operations=EDGE_OPERATIONS["exec"]),
+            Edge(sourse_id=ids["p_read"], dest_id=ids["Accounts"], operations=EDGE_OPERATIONS["select"]),
+        ])
+        self.session.query(Edge).filter(Edge.sourse_id == ids["p_load"], Edge.dest_id == ids["p_report"]).delete()
+        self.session.delete(self.storage.get_node_by_id(ids["tr_clients"]))
+        self.session.flush()
+        remove_orphan_edges(self.session)
+        self.session.commit()
+        return {added.id, ids["p_write"], ids["p_read"], ids["Accounts"], ids["p_load"], ids["p_report"], ids["tr_clients"]}
+
+    def assert_same_as_rebuilt(self):
+        fresh = AdjacencySnapshot.build(self.session)
+        index = ReachabilityIndex(fresh)
+        ids = sorted(fresh.index)
+        self.assertEqual(normalized(self.snapshot.children_of(ids)), normalized(fresh.children_of(ids)))
+        self.assertEqual(normalized(self.snapshot.parents_of(ids)), normalized(fresh.parents_of(ids)))
+        for node_id in ids:
+            for upwards in (False, True):
+                self.assertEqual(self.reachability.reachable([node_id], upwards), index.reachable([node_id], upwards))
+            self.assertEqual(self.reachability.affected_by([node_id]), index.affected_by([node_id]))
+
+    def test_refresh(self):
+        self.storage.invalidate(self.change())
+        self.assert_same_as_rebuilt()
+        self.assertNotIn(self.ids["tr_clients"], self.snapshot)
+        self.assertEqual(self.snapshot.neighbour_ids(self.ids["tr_clients"]), [])
+
+    def test_refresh_twice(self):
+        self.storage.invalidate(self.change())
+        self.session.query(Edge).filter(Edge.sourse_id == self.ids["q_clients"]).delete()
+        self.session.commit()
+        self.storage.invalidate({self.ids["q_clients"], self.ids["p_report"]})
+        self.assert_same_as_rebuilt()
+
+    def assert_holders(self):
+        # обратный индекс совпадает с полным просмотром списков соседей
+        numbers = range(len(self.snapshot.ids))
+        for direction in (DOWN, UP):
+            for number in numbers:
+                expected = {
+                    holder for holder in numbers
+                    if any(target == number for target, _ in self.snapshot._items(direction, holder))}
+                self.assertEqual(self.snapshot._holders_of(direction, {number}), expected)
+
+    def test_holders(self):
+        self.assert_holders()
+        # списки перечитанных нод остаются в overlay, массивы не перестраиваются
+        with mock.patch("dpm.adjacency.COMPACT_RATIO", 1):
+            self.storage.invalidate(self.change())
+        self.assertTrue(self.snapshot.overlay[DOWN])
+        self.assert_holders()
+        self.storage.invalidate({self.ids["q_clients"], self.ids["p_report"]})
+        self.assertFalse(self.snapshot.overlay[DOWN])
+        self.assert_holders()
+        self.assert_same_as_rebuilt()
+
+    def test_rebuild(self):
+        self.change()
+        self.storage.invalidate()
+        self.assert_same_as_rebuilt()
+
+    def test_change_tracker(self):
+        tracker = ChangeTracker(self.session)
+        self.assertEqual(tracker.poll(), set())
+        added = self.change() - set(self.ids.values())
+        # прочие ноды трекер видит по last_update и last_revision, которые
+        # ставят синхронизация и анализ связей; здесь меняются только связи
+        self.assertEqual(tracker.poll(), added | {self.ids["tr_clients"]})
+        self.assertEqual(tracker.poll(), set())
+        tracker.close()
+
+    def test_node_stats_for_changed_region(self):
+        update_node_stats(self.session)
+        changed = self.change()
+        # у удалённого триггера связей уже нет, поэтому таблица передаётся явно
+        update_node_stats(self.session, ids=changed | {self.ids["Clients"]})
+        columns = [NodeStats.node_id, NodeStats.parents, NodeStats.children, NodeStats.operations, NodeStats.depth_up, NodeStats.depth_down]
+        incremental = sorted(self.session.query(*columns))
+        update_node_stats(self.session)
+        self.assertEqual(incremental, sorted(self.session.query(*columns)))
+
+
+class TestReachability(DpmTestCase):
+
+    def test_lazy_and_bounded(self):
+        storage = NodeStorage(self.session, snapshot=AdjacencySnapshot.build(self.session))
+        self.assertIsNone(storage._reachability)
+        index = storage.reachability
+        self.assertIs(storage.reachability, index)
+        self.assertIsNone(NodeStorage(self.session).reachability)
+        index = ReachabilityIndex(storage.snapshot, capacity=2)
+        for node_id in self.ids.values():
+            index.affected_by([node_id])
+        self.assertEqual(len(index.up.cache), 2)
+        self.assertEqual(len(index.down.cache), 0)
+        # несколько нод: обход от всех сразу, с учётом ответов из кэша
+        ids = [self.ids["Clients"], self.ids["Accounts"], self.ids["App"]]
+        expected = set().union(*(ReachabilityIndex(storage.snapshot).reachable([node_id]) for node_id in ids))
+        self.assertEqual(index.reachable(ids), expected)
+
+    def test_affected_by(self):
+        index = ReachabilityIndex(AdjacencySnapshot.build(self.session))
+        ids = self.ids
+        self.assertEqual(index.affected_by([ids["Clients"]]), {
+            "Application": [ids["App"]],
+            "Form": [ids["Form1.dfm"]],
+            "ClientQuery": [ids["q_clients"]],
+            "DBStoredProcedure": sorted([ids["p_read"], ids["p_load"], ids["p_report"]]),
+        })
+        # цикл p_load <-> p_report: процедуры зависят друг от друга
+        self.assertEqual(
+            index.depends_on([ids["p_report"]])["DBStoredProcedure"], sorted([ids["p_read"], ids["p_load"]]))
+
+
+class Graph:
+    """
+    Снимок связей для longest_chains: словарь {id: [id потомков]}.
+    """
+
+    def __init__(self, children):
+        self.children = children
+        self.parents = {node_id: [] for node_id in children}
+        for node_id, items in children.items():
+            for child_id in items:
+                self.parents[child_id].append(node_id)
+
+    def neighbour_ids(self, node_id, upwards=False):
+        return (self.parents if upwards else self.children)[node_id]
+
+    def eccentricity(self, node_id, upwards=False):
+        """
+        Длина самого длинного из кратчайших путей от ноды.
+        """
+        depths = {node_id: 0}
+        queue = deque([node_id])
+        while queue:
+            current = queue.popleft()
+            for neighbour_id in self.neighbour_ids(current, upwards):
+                if neighbour_id not in depths:
+                    depths[neighbour_id] = depths[current] + 1
+                    queue.append(neighbour_id)
+        return max(depths.values())
+
+
+class TestLongestChains(unittest.TestCase):
+
+    def test_chain(self):
+        graph = Graph({1: [2], 2: [3], 3: []})
+        self.assertEqual(longest_chains(graph, [1, 2, 3]), {1: 2, 2: 1, 3: 0})
+        self.assertEqual(longest_chains(graph, [1, 2, 3], upwards=True), {1: 0, 2: 1, 3: 2})
+
+    def test_cycle(self):
+        graph = Graph({1: [2], 2: [3], 3: [1]})
+        self.assertEqual(longest_chains(graph, [1, 2, 3]), {1: 2, 2: 2, 3: 2})
+
+    def test_cycle_with_tails(self):
+        # 0 -> (1 -> 2 -> 3 -> 1) -> 4 -> (5 <-> 6)
+        graph = Graph({0: [1], 1: [2], 2: [3], 3: [1, 4], 4: [5], 5: [6], 6: [5]})
+        ids = list(graph.children)
+        depths = longest_chains(graph, ids)
+        self.assertEqual(depths, {0: 6, 1: 5, 2: 5, 3: 5, 4: 2, 5: 1, 6: 1})
+        for upwards in (False, True):
+            depths = longest_chains(graph, ids, upwards)
+            for node_id in ids:
+                # граф ноды загружается "до конца" за depth уровней
+                self.assertGreaterEqual(depths[node_id], graph.eccentricity(node_id, upwards))
+
+    def test_self_loop(self):
+        graph = Graph({1: [1, 2], 2: []})
+        self.assertEqual(longest_chains(graph, [1, 2]), {1: 1, 2: 0})
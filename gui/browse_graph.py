@@ -97,6 +97,9 @@ class BrowseGraphWidget(BrowseWidget):
         self.pov_last = QtWidgets.QPushButton()
         self.pov_last.setIcon(IconCollection.pixmaps["end"])
         grid.addWidget(self.pov_last, 0, 5)
+        # связность точки отсчёта во всей ДПМ, а не только в загруженном графе
+        self.pov_stats = QtWidgets.QLabel()
+        grid.addWidget(self.pov_stats, 1, 1, 1, 5)
 
         self.pov_first.clicked.connect(lambda: self._change_pov(self.pov_first))
         self.pov_back.clicked.connect(lambda: self._change_pov(self.pov_back))
@@ -341,6 +344,7 @@ class BrowseGraphWidget(BrowseWidget):
             IconCollection.get_pixmap_for_node_class(self.state.pov_node_class)
         )
         self.pov_label.setText(self.state.pov_node_label)
+        self.pov_stats.setText(self.state.pov_stats_summary)
         self._draw_current_graph()
 
     def _reload_dependencies(self):
@@ -482,21 +486,13 @@ class BrowseGraphWidget(BrowseWidget):
 
     def _set_dependencies_loading_levels(self):
         """
-        По типу ноды определяем рекомендуемое количество уровней
-        зависимостей для загрузки, выставляем виджеты управления
+        По статистике связей ноды определяем рекомендуемое количество
+        уровней зависимостей для загрузки, выставляем виджеты управления
         в соответствующее положение.
         """
-        up, down = self.observed_node.get_recommended_loading_depth()
-
-        if up == float("inf"):
-            self.chb_up.setChecked(True)
-        else:
-            self.spb_up.setValue(up)
-
-        if down == float("inf"):
-            self.chb_down.setChecked(True)
-        else:
-            self.spb_down.setValue(down)
+        up, down = self.state.graph.recommended_loading_depth()
+        self.spb_up.setValue(up)
+        self.spb_down.setValue(down)
     # endregion
 
     # region properties
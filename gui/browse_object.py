@@ -14,12 +14,16 @@ class ListObjectsWidget(QtWidgets.QWidget):
             {"field": "id", "header": "Node_ID", "width": 150, "hidden": True},
             {"field": "name", "header": "Название", "width": 500, "hidden": False},
             {"field": "last_update", "header": "Последнее обновление", "width": 350, "hidden": False},
-            {"field": "last_revision", "header": "Анализ связей", "width": 250, "hidden": False}
+            {"field": "last_revision", "header": "Анализ связей", "width": 250, "hidden": False},
+            # поля статистики связей (NodeStats), а не самой ноды
+            {"field": "parents", "header": "Предков", "width": 100, "hidden": False, "stats": True},
+            {"field": "children", "header": "Потомков", "width": 100, "hidden": False, "stats": True}
         ]
         self.setLayout(QtWidgets.QVBoxLayout())
         self.model = None
         self.view = None
         self.selected_id = None
+        self.stats = {}
 
     def _process_row_selection(self):
         """
@@ -35,8 +39,16 @@ class ListObjectsWidget(QtWidgets.QWidget):
         self.model.setHorizontalHeaderLabels([c["header"] for c in self._columns])
         for row in range(row_count):
             for column in range(len(self._columns)):
-                # ToDo надо конвертировать дату в нормальный формат
-                item = QtGui.QStandardItem(str(getattr(dataset[row], self._columns[column]["field"])))
+                field = self._columns[column]["field"]
+                if self._columns[column].get("stats"):
+                    # число, а не строка, чтобы колонка сортировалась по значению
+                    item = QtGui.QStandardItem()
+                    stats = self.stats.get(dataset[row].id)
+                    if stats is not None:
+                        item.setData(getattr(stats, field), QtCore.Qt.DisplayRole)
+                else:
+                    # ToDo надо конвертировать дату в нормальный формат
+                    item = QtGui.QStandardItem(str(getattr(dataset[row], field)))
                 self.model.setItem(row, column, item)
 
         self.view = QtWidgets.QTableView()
@@ -55,8 +67,13 @@ class ListObjectsWidget(QtWidgets.QWidget):
 
         self.layout().addWidget(self.view)
 
-    def load_data(self, dataset):
+    def load_data(self, dataset, stats=None):
+        """
+        dataset - список orm-моделей; stats - статистика их связей
+        (словарь {id: NodeStats}, см. NodeStorage.get_stats).
+        """
         self.empty = (dataset is None or len(dataset) == 0)
+        self.stats = stats or {}
         if not self.empty:
             self._fill_table(dataset)
 
@@ -99,9 +116,11 @@ class BrowseObjectWidget(BrowseWidget):
 
     def load_data(self, dataset):
         self._categories = dataset
+        # количество связей берётся из статистики, без загрузки графов
+        stats = self._storage.get_stats(item.id for category in dataset for item in category["dataset"])
         for category in self._categories:
             list_pane = ListObjectsWidget()
-            list_pane.load_data(category["dataset"])
+            list_pane.load_data(category["dataset"], stats)
             # присоединяем сигнал для реакции на выбор строки в таблице
             list_pane.row_selected.connect(self._process_node_selection)
             # ToDo при переключении вкладок надо сбрасывать выбранную вершину
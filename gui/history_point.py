@@ -15,6 +15,12 @@ class HistoryPoint:
     def __init__(self, storage, initial_node, grouping=False):
         self.graph = DpmGraph(storage, initial_node)
         self.pov_id = initial_node.id
+        # статистика связей точки отсчёта, посчитанная после синхронизации
+        self.pov_stats = storage.get_stats([self.pov_id]).get(self.pov_id)
+        # зависимые ноды на любой глубине, если у хранилища есть снимок связей
+        self.pov_affected = None
+        if storage.reachability is not None:
+            self.pov_affected = storage.reachability.affected_by([self.pov_id])
         self.table_model = None
         self.tree_model = None
         self._refresh_table_model()
@@ -84,6 +90,19 @@ class HistoryPoint:
     def pov_node_label(self):
         return self.graph[self.pov_id]["label"]
 
+    @property
+    def pov_stats_summary(self):
+        if self.pov_stats is None:
+            summary = "Статистика связей ещё не посчитана"
+        else:
+            summary = self.pov_stats.summary
+        if self.pov_affected is not None:
+            summary += (
+                f"; зависят АРМов: {len(self.pov_affected.get('Application', []))}, "
+                f"форм: {len(self.pov_affected.get('Form', []))}, "
+                f"всего нод: {sum(len(ids) for ids in self.pov_affected.values())}")
+        return summary
+
     @property
     def has_iterable_search_result(self):
         return (self.search_result is not None and len(self.search_result) > 0)
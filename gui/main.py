@@ -1,4 +1,4 @@
-from PySide2 import QtWidgets, QtGui
+from PySide2 import QtWidgets, QtGui, QtCore
 import sys
 from .browse_object import BrowseObjectWidget
 from .browse_graph import BrowseGraphWidget
@@ -7,6 +7,10 @@ import os
 from .collection import IconCollection
 
 
+# как часто проверять, не изменила ли синхронизация ДПМ, мс
+CHANGES_POLL_INTERVAL = 5000
+
+
 class DpmMainWindow(QtWidgets.QMainWindow):
 
     def __init__(self, *args, **kwargs):
@@ -138,6 +142,30 @@ class DpmMainWindow(QtWidgets.QMainWindow):
         for widget in self._browse_widgets():
             widget.set_storage(self._storage)
 
+    def watch_changes(self, tracker, interval=CHANGES_POLL_INTERVAL):
+        """
+        Периодически опрашивает tracker (dpm.change_tracker.ChangeTracker)
+        и сбрасывает в хранилище изменившиеся после синхронизации ноды.
+        """
+        self._tracker = tracker
+        self._changes_timer = QtCore.QTimer(self)
+        self._changes_timer.timeout.connect(self._apply_changes)
+        self._changes_timer.start(interval)
+
+    def _apply_changes(self):
+        """
+        Обработчик таймера опроса изменений ДПМ.
+        """
+        changed = self._tracker.poll()
+        if not changed:
+            return
+        self._storage.invalidate(changed)
+        # обзор системы показывает списки АРМов и баз, их перечитываем сразу;
+        # остальные виджеты получат новые данные при следующем запросе
+        if self._container.currentIndex() == self._container.indexOf(self._browse_system_widget):
+            self._browse_system_widget.clear()
+            self.query_system_data()
+
     def load_data(self, dataset):
         self.centralWidget().load_data(dataset)
 
@@ -154,7 +182,7 @@ class DpmMainWindow(QtWidgets.QMainWindow):
         self._browse_system_widget.query_system_data()
 
 
-def init_gui(storage):
+def init_gui(storage, tracker=None):
     # ToDo это временная функция для тестирования формирования интерфейса
     app = QtWidgets.QApplication([])
     # сюда надо передавать категории из обзора системы: армы и базы
@@ -163,6 +191,8 @@ def init_gui(storage):
     # функциональность по работе с бд должна быть вытащена вовне
     main_window = DpmMainWindow()
     main_window.set_storage(storage)
+    if tracker is not None:
+        main_window.watch_changes(tracker)
     main_window.query_system_data()
     main_window.showMaximized()
     sys.exit(app.exec_())
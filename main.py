@@ -2,19 +2,27 @@ import logging
 import os
 import datetime
 import calendar
+import argparse
 from dpm.connector import Connector
 import dpm.models as models
-from dpm.linking import analize_links
+from dpm.linking import analize_links, stamp_components
+from dpm.link_stats import LinkStats
+from dpm.impact import analyze_impact, read_identifiers
 from sync.scan_db import scan_database
 from sync.scan_source import scan_application
+from sync.scheduler import sync_all
+from sync.watcher import watch
 import settings
-from dpm.storage import NodeStorage
+from dpm.storage import NodeStorage, DEFAULT_LOADING
+from dpm.reference_cache import prune
+from dpm.adjacency import AdjacencySnapshot
+from dpm.change_tracker import ChangeTracker
 from gui import init_gui
 
 
-def create_new_session(config):
+def create_new_session(config, read_only=False):
     connector = Connector(**config["connector"])
-    session = connector.connect_to_dpm()
+    session = connector.connect_to_dpm(read_only=read_only)
     return session
 
 
@@ -68,10 +76,119 @@ def prepare_test_sqlite_db(connector, config):
     session.commit()
 
 
+def full_sync(config):
+    """
+    Синхронизирует все базы и АРМы из конфига.
+    """
+    logging.info("Начинаем полную синхронизацию")
+    connector = Connector(**config["connector"])
+    progress = sync_all(connector, config)
+    print(progress.final_report())
+
+
+def dump_catalogs(config):
+    """
+    Снимает каталоги всех баз из конфига для работы без боевого сервера.
+    """
+    connector = Connector(**config["connector"])
+    for db_name in config["databases"]:
+        logging.info(f"Снимаем каталог базы {db_name}")
+        print(connector.dump_catalog(db_name))
+
+
+def prune_cache(config):
+    """
+    Удаляет из кэша упоминаний записи кода, которого больше нет в ДПМ.
+    """
+    session = create_new_session(config)
+    removed = prune(session)
+    session.commit()
+    print(f"Удалено записей кэша упоминаний: {removed}")
+
+
+def link_report(config, dry_run=False, top=20, json_path=None):
+    """
+    Строит связи для всех баз из конфига, собирая статистику, и печатает
+    отчёт о самых дорогих объектах и скриптах. В режиме dry_run связи
+    только вычисляются, ДПМ не меняется.
+    """
+    connector = Connector(**config["connector"])
+    session = connector.connect_to_dpm()
+    stats = LinkStats()
+    databases = session.query(models.Database).filter(models.Database.name.in_(config["databases"])).all()
+    for base in databases:
+        with connector.connect_to(base.name) as conn:
+            changes = analize_links(session, conn, database=base, stats=stats, dry_run=dry_run)
+        print(
+            f"{base.name}: добавлено {len(changes['added'])}, изменено {len(changes['updated'])}, "
+            f"удалено {len(changes['deleted'])}")
+    if dry_run:
+        session.rollback()
+    else:
+        stamp_components(session)
+        session.commit()
+    print(stats.report(top))
+    if json_path:
+        stats.export_json(json_path)
+
+
+def impact_report(config, names, path=None, json_path=None):
+    """
+    Печатает отчёт о влиянии изменения объектов БД: полные имена берутся
+    из names и из файла path (по одному на строку).
+    Отчёт строится один раз, поэтому зависимые ноды ищутся одним рекурсивным
+    запросом: снимок связей и индекс достижимости окупаются только в GUI.
+    """
+    identifiers = list(names)
+    if path:
+        identifiers.extend(read_identifiers(path))
+    session = create_new_session(config, read_only=True)
+    report = analyze_impact(NodeStorage(session), identifiers)
+    print(report.report())
+    if json_path:
+        report.export_json(json_path)
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Карта зависимостей")
+    parser.add_argument("command", nargs="?", choices=["gui", "sync", "watch", "snapshot", "links", "impact", "prune"], default="gui")
+    parser.add_argument("objects", nargs="*", help="impact: полные имена изменённых объектов (БД.Схема.Название)")
+    parser.add_argument("--dry-run", action="store_true", help="links: вычислить связи без записи в ДПМ")
+    parser.add_argument("--top", type=int, default=20, help="links: сколько самых дорогих объектов и скриптов показать")
+    parser.add_argument("--json", help="links, impact: сохранить статистику или отчёт в JSON-файл")
+    parser.add_argument("--file", help="impact: файл с полными именами изменённых объектов, по одному на строку")
+    args = parser.parse_args()
     config = settings.config
-    storage = NodeStorage(create_new_session(config))
-    init_gui(storage)
+    if args.command == "sync":
+        full_sync(config)
+        return
+    if args.command == "snapshot":
+        dump_catalogs(config)
+        return
+    if args.command == "links":
+        link_report(config, dry_run=args.dry_run, top=args.top, json_path=args.json)
+        return
+    if args.command == "impact":
+        impact_report(config, args.objects, path=args.file, json_path=args.json)
+        return
+    if args.command == "prune":
+        prune_cache(config)
+        return
+    if args.command == "watch":
+        watch(Connector(**config["connector"]), config)
+        return
+    # GUI только читает ДПМ, поэтому работает через соединения на чтение
+    # и не ждёт идущую в это время синхронизацию
+    session = create_new_session(config, read_only=True)
+    # связи всей ДПМ держим в памяти, чтобы не читать их из ДПМ при каждом клике;
+    # индекс достижимости хранилище создаёт по снимку при первом вопросе;
+    # способ загрузки нод можно задать в config["storage"]["loading"]
+    storage = NodeStorage(
+        session,
+        snapshot=AdjacencySnapshot.build(session),
+        loading=config.get("storage", {}).get("loading", DEFAULT_LOADING))
+    # изменения, которые синхронизация пишет в ДПМ, пока открыт GUI
+    init_gui(storage, ChangeTracker(session))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+"""
+Журнал контрольных точек синхронизации.
+
+Позволяет продолжить упавшую синхронизацию с последнего завершённого
+этапа, не переделывая то, что уже записано в ДПМ.
+"""
+import logging
+from dpm.models import SyncCheckpoint
+
+
+class CheckpointJournal:
+    """
+    Контрольные точки одного вида синхронизации (stage) для одной ноды.
+
+    session - сессия ДПМ, в которой идёт синхронизация;
+    node - синхронизируемая нода (база или АРМ);
+    stage - вид синхронизации: "scan", "links";
+    revision - дата обновления оригинала, к которой приводится нода;
+    отметки, поставленные для другой ревизии, удаляются как устаревшие;
+    batch_size - через сколько отметок делать commit;
+    before_commit - функция, которая вызывается перед каждым commit'ом
+    журнала; в ней можно записать накопленные изменения (например, индекс
+    идентификаторов), чтобы транзакция записи открывалась только перед
+    commit'ом;
+    expire_on_commit - сбрасывать ли загруженные объекты после промежуточных
+    commit'ов; можно отключить, если в ходе этапов объекты не удаляются.
+    """
+
+    def __init__(self, session, node, stage, revision, batch_size=1, before_commit=None, expire_on_commit=True):
+        self.session = session
+        self.node_id = node.id
+        self.node_name = node.name
+        self.stage = stage
+        self.revision = revision
+        self.batch_size = batch_size
+        self.before_commit = before_commit
+        self.expire_on_commit = expire_on_commit
+        self._pending = 0
+        self._done = set()
+        stale = 0
+        for checkpoint in self._query():
+            if checkpoint.revision == revision:
+                self._done.add((checkpoint.phase, checkpoint.key))
+            else:
+                session.delete(checkpoint)
+                stale += 1
+        if self._done:
+            logging.info(f"Продолжаем синхронизацию {self.node_name} ({stage}), пропускаем завершённых этапов: {len(self._done)}")
+        if stale:
+            logging.info(f"Удалено устаревших контрольных точек {self.node_name} ({stage}): {stale}")
+
+    def is_done(self, phase, key=""):
+        return (phase, key) in self._done
+
+    def mark_done(self, phase, key=""):
+        """
+        Отмечает этап как завершённый. Отметка записывается в ДПМ
+        в одной транзакции с результатами этапа.
+        """
+        self.session.add(SyncCheckpoint(
+            node_id=self.node_id,
+            stage=self.stage,
+            phase=phase,
+            key=key,
+            revision=self.revision))
+        self._done.add((phase, key))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        if self.before_commit is not None:
+            self.before_commit()
+        expire_on_commit = self.session.expire_on_commit
+        self.session.expire_on_commit = self.expire_on_commit
+        try:
+            self.session.commit()
+        finally:
+            self.session.expire_on_commit = expire_on_commit
+        self._pending = 0
+
+    def finish(self):
+        """
+        Удаляет все отметки после успешного завершения синхронизации.
+        Commit не выполняется: отметки должны исчезнуть в одной транзакции
+        с обновлением last_update/last_revision ноды.
+        """
+        self.session.flush()
+        for checkpoint in self._query():
+            self.session.delete(checkpoint)
+        self._done.clear()
+        self._pending = 0
+
+    def _query(self):
+        return self.session.query(SyncCheckpoint).filter(
+            SyncCheckpoint.node_id == self.node_id,
+            SyncCheckpoint.stage == self.stage)
@@ -1,5 +1,6 @@
 import os
 import datetime
+import threading
 import xml.etree.ElementTree as ET
 from dfm import DFMLoader, DFMException
 import binascii
@@ -11,10 +12,86 @@ class DelphiToolsException(Exception):
     pass
 
 
+def normalize_path(path):
+    """
+    Приводит путь к файлу к единому виду, чтобы один и тот же файл,
+    подключённый в разные проекты по разным относительным путям,
+    имел один ключ.
+    Результат годится только как ключ для сравнения: на Windows он
+    в нижнем регистре, поэтому в ДПМ (Form.path) записывается путь
+    в том виде, в каком его собрал проект.
+    """
+    return os.path.normcase(os.path.abspath(path))
+
+
+class FormRegistry:
+    """
+    Общий для всех проектов реестр форм в рамках одной синхронизации.
+
+    Формы, подключённые сразу в несколько АРМов, читаются с диска и
+    парсятся один раз, после чего один и тот же объект DelphiForm
+    отдаётся всем проектам, которые его запрашивают.
+    Реестр потокобезопасен, так как АРМы могут синхронизироваться параллельно.
+    """
+
+    def __init__(self):
+        self._forms = {}
+        self._lock = threading.Lock()
+        # сколько раз формы запрашивались проектами
+        self.requests = 0
+
+    def get_form(self, path):
+        """
+        Возвращает объект формы по пути к файлу; форма создаётся
+        (и файл проверяется на диске) только при первом обращении.
+        Возвращает None, если файл формы не найден.
+        """
+        key = normalize_path(path)
+        with self._lock:
+            self.requests += 1
+            if key not in self._forms:
+                self._forms[key] = DelphiForm(path) if os.path.exists(path) else None
+            return self._forms[key]
+
+    def forget(self, path):
+        """
+        Убирает форму из реестра, чтобы при следующем запросе она
+        была заново прочитана с диска и распарсена.
+        """
+        with self._lock:
+            self._forms.pop(normalize_path(path), None)
+
+    @property
+    def unique_forms(self):
+        return len(self._forms)
+
+    @property
+    def parses(self):
+        return len([form for form in self._forms.values() if form is not None and form.parsed])
+
+    @property
+    def parse_requests(self):
+        return sum(form.parse_requests for form in self._forms.values() if form is not None)
+
+    @property
+    def summary(self):
+        """
+        Сколько работы сэкономлено за счёт того, что общие формы
+        обрабатываются один раз.
+        """
+        return (
+            f"Запросов форм: {self.requests}, уникальных форм: {self.unique_forms}, "
+            f"сэкономлено чтений с диска: {self.requests - self.unique_forms}, "
+            f"сэкономлено парсингов: {self.parse_requests - self.parses}"
+        )
+
+
 class DelphiProject(Original):
 
-    def __init__(self, path_to_dproj):
+    def __init__(self, path_to_dproj, registry=None):
         logging.info(f"Обрабатываем оригинал проекта {path_to_dproj}")
+        # если реестр не передан, то формы не делятся с другими проектами
+        registry = registry or FormRegistry()
         self.forms = {}
         self.last_update = None
         # абсолютный путь к файлу проекта
@@ -43,23 +120,22 @@ class DelphiProject(Original):
                 module_name = item.attrib["Include"]
                 # обрабатываем файл формы, если он указан
                 if len(item) > 0:
-                    form_name = module_name[:module_name.find(".")]
+                    form_name = module_name[:module_name.rfind(".")]
                     logging.debug(f"Обрабатываем файл формы {form_name}")
                     form_path = os.path.join(self.projdir, f"{form_name}.dfm")
                     logging.debug(f"Путь к файлу формы {form_path}")
                     # проверяем доступность файла
-                    # ToDo - починить пути к общим файлам форм в армах
-                    if not os.path.exists(form_path):
+                    form = registry.get_form(form_path)
+                    if form is None:
                         no_errors = False
                         msg = f"Файл с описанием формы {form_path} не найден."
                         logging.error(msg)
                         #raise DelphiToolsException(msg)
                         continue
-                    form_update = datetime.datetime.fromtimestamp(os.path.getmtime(form_path))
                     # по максимальной среди форм дате обновления получаем дату обновления арма
-                    if form_update > self.last_update:
-                        self.last_update = form_update
-                    self.forms[form_path] = DelphiForm(form_path)
+                    if form.last_update > self.last_update:
+                        self.last_update = form.last_update
+                    self.forms[form_path] = form
                     if no_errors:
                         logging.info(f"Обработка проекта {self.path} завершена, все файлы прочитаны")
                     else:
@@ -86,6 +162,10 @@ class DelphiForm(Original):
         self.is_broken = False
         self.parsing_error_message = None
         self.components = []
+        self.parsed = False
+        # сколько раз форму просили распарсить (для статистики реестра форм)
+        self.parse_requests = 0
+        self._parse_lock = threading.Lock()
 
     @property
     def connections(self):
@@ -102,6 +182,18 @@ class DelphiForm(Original):
         return {c.name: c for c in self.components if isinstance(c, DelphiQuery)}
     
     def parse(self):
+        """
+        Парсит файл формы. Повторные вызовы ничего не делают, поэтому
+        форму, общую для нескольких проектов, можно парсить из каждого.
+        """
+        with self._parse_lock:
+            self.parse_requests += 1
+            if self.parsed:
+                return
+            self._parse()
+            self.parsed = True
+
+    def _parse(self):
         logging.debug(f"Парсим форму {self.name}")
         try:
             loader = DFMLoader()
@@ -3,9 +3,33 @@ import binascii
 from .common_classes import Original
 from dataclasses import dataclass, field
 from sqlalchemy.sql import text
+from sqlalchemy import DateTime, bindparam
 from .mixins import SQLProcessorMixin
 
 
+# SQL Server принимает не больше 2100 параметров в одном запросе,
+# поэтому длинные списки object_id разбиваются на части
+IDS_CHUNK_SIZE = 1000
+
+
+def select_by_ids(query, column):
+    """
+    Оборачивает запрос query (результат query_for_all) во внешний запрос,
+    который оставляет только строки, чьё значение column входит в список
+    параметра :ids.
+    """
+    return text(
+        f"""
+        select * from ({query.element.text}) q
+        where q.{column} in :ids""").bindparams(bindparam("ids", expanding=True)).columns(last_update=DateTime)
+
+
+def chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), IDS_CHUNK_SIZE):
+        yield ids[start:start + IDS_CHUNK_SIZE]
+
+
 @dataclass
 class DBOriginal(Original):
     name: str
@@ -63,11 +87,28 @@ class OriginalDatabaseObject(DBOriginal):
         """
         Возвращает оригинал объекта по его object_id в базе данных.
         """
-        record = conn.execute(cls.query_by_id(), id=id)
+        record = conn.execute(cls.query_by_id(), id=id).first()
         if record:
             return cls(**record)
         return None
 
+    @classmethod
+    def get_by_ids(cls, conn, ids):
+        """
+        Возвращает оригиналы объектов по списку их object_id в базе данных;
+        на каждые IDS_CHUNK_SIZE объектов выполняется один запрос.
+
+        Тип коллекции - словарь, ключ - object_id; объектов, которых нет
+        в базе, в словаре нет.
+        """
+        query = select_by_ids(cls.query_for_all(), "database_object_id")
+        result = {}
+        for chunk in chunks(ids):
+            for record in conn.execute(query, ids=chunk):
+                obj = cls(**record)
+                result[obj.database_object_id] = obj
+        return result
+
 
 @dataclass
 class OriginalScript(OriginalDatabaseObject, SQLProcessorMixin):
@@ -107,7 +148,7 @@ class OriginalDatabase(DBOriginal):
                 sys.objects
             where
                 schema_id = 1
-                and type in ('U','TR', 'P', 'V', 'TF', 'FN')""")
+                and type in ('U','TR', 'P', 'V', 'TF', 'FN')""").columns(last_update=DateTime)
         meta = conn.execute(query).first()
         return cls(**meta)
 
@@ -130,7 +171,7 @@ class OriginalTable(OriginalDatabaseObject):
                 DB_NAME() as db_name
             from
                 sys.tables t
-                join sys.schemas s on t.schema_id = s.schema_id""")
+                join sys.schemas s on t.schema_id = s.schema_id""").columns(last_update=DateTime)
 
     @classmethod
     def query_by_id(cls):
@@ -146,7 +187,7 @@ class OriginalTable(OriginalDatabaseObject):
                 sys.tables t
                 join sys.schemas s on t.schema_id = s.schema_id
             where
-                t.object_id = :id""")
+                t.object_id = :id""").columns(last_update=DateTime)
 
 
 @dataclass
@@ -182,7 +223,7 @@ class OriginalTrigger(OriginalScript):
                 join sys.objects o on o.object_id = m.object_id
                 join sys.schemas s on o.schema_id = s.schema_id
             where
-                o.type = 'TR'""")
+                o.type = 'TR'""").columns(last_update=DateTime)
 
     @classmethod
     def query_by_id(cls):
@@ -205,7 +246,7 @@ class OriginalTrigger(OriginalScript):
                 join sys.schemas s on o.schema_id = s.schema_id
             where
                 o.type = 'TR'
-                and m.object_id = :id""")
+                and m.object_id = :id""").columns(last_update=DateTime)
 
     @classmethod
     def get_triggers_for_table(cls, conn, table_id):
@@ -234,7 +275,7 @@ class OriginalTrigger(OriginalScript):
                 join sys.schemas s on o.schema_id = s.schema_id
             where
                 o.type = 'TR'
-                and o.parent_object_id = :table_id""")
+                and o.parent_object_id = :table_id""").columns(last_update=DateTime)
         # dict comprehension
         return {
             obj.long_name: obj
@@ -244,6 +285,23 @@ class OriginalTrigger(OriginalScript):
             ]
         }
 
+    @classmethod
+    def get_triggers_for_tables(cls, conn, table_ids):
+        """
+        Возвращает триггеры сразу для нескольких таблиц по их object_id в БД.
+
+        Тип коллекции - словарь, ключ - object_id таблицы, значение -
+        словарь триггеров этой таблицы с ключом long_name (как у
+        get_triggers_for_table); у таблиц без триггеров словарь пустой.
+        """
+        query = select_by_ids(cls.query_for_all(), "table_id")
+        result = {table_id: {} for table_id in table_ids}
+        for chunk in chunks(table_ids):
+            for record in conn.execute(query, ids=chunk):
+                obj = cls(**record)
+                result[obj.table_id][obj.long_name] = obj
+        return result
+
 
 @dataclass
 class OriginalProcedure(OriginalScript):
@@ -267,7 +325,7 @@ class OriginalProcedure(OriginalScript):
                 join sys.objects o on o.object_id = m.object_id
                 join sys.schemas s on o.schema_id = s.schema_id
             where
-                o.type = 'P'""")
+                o.type = 'P'""").columns(last_update=DateTime)
 
     @classmethod
     def query_by_id(cls):
@@ -286,7 +344,7 @@ class OriginalProcedure(OriginalScript):
                 join sys.schemas s on o.schema_id = s.schema_id
             where
                 o.type = 'P'
-                and m.object_id = :id""")
+                and m.object_id = :id""").columns(last_update=DateTime)
 
 
 @dataclass
@@ -311,7 +369,7 @@ class OriginalView(OriginalScript):
                 join sys.objects o on o.object_id = m.object_id
                 join sys.schemas s on o.schema_id = s.schema_id
             where
-                o.type = 'V'""")
+                o.type = 'V'""").columns(last_update=DateTime)
 
     @classmethod
     def query_by_id(cls):
@@ -330,7 +388,7 @@ class OriginalView(OriginalScript):
                 join sys.schemas s on o.schema_id = s.schema_id
             where
                 o.type = 'V'
-                and m.object_id = :id""")
+                and m.object_id = :id""").columns(last_update=DateTime)
 
 
 @dataclass
@@ -355,7 +413,7 @@ class OriginalTableFunction(OriginalScript):
                 join sys.objects o on o.object_id = m.object_id
                 join sys.schemas s on o.schema_id = s.schema_id
             where
-                o.type = 'TF'""")
+                o.type = 'TF'""").columns(last_update=DateTime)
 
     @classmethod
     def query_by_id(cls):
@@ -374,7 +432,7 @@ class OriginalTableFunction(OriginalScript):
                 join sys.schemas s on o.schema_id = s.schema_id
             where
                 o.type = 'TF'
-                and m.object_id = :id""")
+                and m.object_id = :id""").columns(last_update=DateTime)
 
 
 @dataclass
@@ -399,7 +457,7 @@ class OriginalScalarFunction(OriginalScript):
                 join sys.objects o on o.object_id = m.object_id
                 join sys.schemas s on o.schema_id = s.schema_id
             where
-                o.type ='FN'""")
+                o.type ='FN'""").columns(last_update=DateTime)
 
     @classmethod
     def query_by_id(cls):
@@ -418,7 +476,77 @@ class OriginalScalarFunction(OriginalScript):
                 join sys.schemas s on o.schema_id = s.schema_id
             where
                 o.type ='FN'
-                and m.object_id = :id""")
+                and m.object_id = :id""").columns(last_update=DateTime)
+
+
+class SystemDependencyIndex:
+    """
+    Все системные зависимости между объектами одной базы, прочитанные
+    из sys.sql_expression_dependencies одним запросом.
+
+    Заменяет вызовы sys.dm_sql_referencing_entities и
+    sys.dm_sql_referenced_entities, которые приходилось делать для
+    каждого объекта отдельно.
+
+    Ссылки по имени без схемы SQL Server не разрешает при компиляции
+    (is_caller_dependent): referenced_id у них пустой, поэтому объект
+    ищется в sys.objects по имени в схеме dbo.
+    """
+
+    def __init__(self):
+        # object_id -> object_id объектов, которые на него ссылаются
+        self._referencing = {}
+        # object_id -> object_id объектов, на которые он ссылается
+        self._referenced = {}
+
+    @classmethod
+    def fetch(cls, conn):
+        """
+        Читает зависимости базы, с которой работает соединение conn.
+        Строки обрабатываются по мере получения, без загрузки всего
+        результата в память.
+        """
+        query = text(
+            """
+            select
+                d.referencing_id,
+                coalesce(d.referenced_id, o.object_id) as referenced_id
+            from
+                sys.sql_expression_dependencies d
+                left join sys.schemas s
+                    on d.referenced_id is NULL
+                    and s.name = coalesce(d.referenced_schema_name, 'dbo')
+                left join sys.objects o
+                    on o.schema_id = s.schema_id
+                    and o.name = d.referenced_entity_name
+            where
+                (d.referenced_id is not NULL
+                    or d.referenced_database_name is NULL
+                    or d.referenced_database_name = DB_NAME())
+                and d.referencing_id <> coalesce(d.referenced_id, o.object_id)""")
+        index = cls()
+        for referencing_id, referenced_id in conn.execute(query):
+            index.add(referencing_id, referenced_id)
+        return index
+
+    def add(self, referencing_id, referenced_id):
+        self._referencing.setdefault(referenced_id, set()).add(referencing_id)
+        self._referenced.setdefault(referencing_id, set()).add(referenced_id)
+
+    def referencing(self, object_id):
+        """
+        Возвращает множество object_id объектов, ссылающихся на объект object_id.
+        """
+        return self._referencing.get(object_id, set())
+
+    def referenced(self, object_id):
+        """
+        Возвращает множество object_id объектов, на которые ссылается объект object_id.
+        """
+        return self._referenced.get(object_id, set())
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._referencing.values())
 
 
 @dataclass
@@ -453,3 +581,11 @@ class OriginalSystemReferense(Original):
                 for record in dataset
             ]
         }
+
+    @classmethod
+    def get_references_from_index(cls, index, object_id):
+        """
+        То же, что get_references_for_object, но по заранее прочитанному
+        индексу SystemDependencyIndex, без обращения к базе.
+        """
+        return {referenced_id: cls(referenced_id=referenced_id) for referenced_id in index.referenced(object_id)}
@@ -11,16 +11,31 @@ from dpm.models import (
     DBScript,
     Edge)
 import sync.original_models as original_models
-from .common_functions import sync_subordinate_members
+from .common_functions import sync_subordinate_members, needs_update, get_remaining_objects
+from dpm.identifier_index import refresh_identifier_index
+from .checkpoints import CheckpointJournal
 
 from typing import List, Dict
 import itertools
 import logging
 
 
+# сколько таблиц синхронизировать одной пачкой триггеров
+TRIGGER_BATCH_SIZE = 50
+
+
 def scan_database(base, session, conn):
     """
     Синхронизирует одну базу данных целиком.
+
+    Каждый вид объектов (и триггеры каждой таблицы) синхронизируется
+    отдельным этапом, результаты которого сразу пишутся в ДПМ вместе
+    с контрольной точкой; если синхронизация упадёт, следующий запуск
+    продолжит её с первого незавершённого этапа.
+
+    Оригиналы каждого этапа достаются из боевой базы до того, как этап
+    начнёт писать в ДПМ, поэтому транзакция записи (и блокировка записи
+    ДПМ) не ждёт ответов боевой базы.
     """
     original_db = original_models.OriginalDatabase.fetch_from_metadata(conn)
     if original_db.last_update == base.last_update:
@@ -28,93 +43,145 @@ def scan_database(base, session, conn):
         return
     base = session.query(Database).options(
         selectinload(Database.scripts),
-        selectinload(Database.tables)
+        selectinload(Database.tables).selectinload(DBTable.triggers)
     ).filter(Database.id == base.id).one()
-    
-    logging.debug(f"Достаём оригиналы объектов БД {base.name}")
-    original_proc_data_set = original_models.OriginalProcedure.get_all(conn)
-    original_views_data_set = original_models.OriginalView.get_all(conn)
-    original_tabfunc_data_set = original_models.OriginalTableFunction.get_all(conn)
-    original_sfunc_data_set = original_models.OriginalScalarFunction.get_all(conn)
-    original_tables_data_set = original_models.OriginalTable.get_all(conn)
-    
-    logging.debug(f"Синхронизируем хранимые процедуры БД {base.name}")
-    sync_subordinate_members(original_proc_data_set, DBStoredProcedure, base.procedures, session, base)
-    
-    logging.debug(f"Синхронизируем представления БД {base.name}")
-    sync_subordinate_members(original_views_data_set, DBView, base.views, session, base)
-
-    logging.debug(f"Синхронизируем табличные функции БД {base.name}")
-    sync_subordinate_members(original_tabfunc_data_set, DBTableFunction, base.table_functions, session, base)
-
-    logging.debug(f"Синхронизируем скалярные функции БД {base.name}")
-    sync_subordinate_members(original_sfunc_data_set, DBScalarFunction, base.scalar_functions, session, base)
-
-    logging.debug(f"Синхронизируем таблицы БД {base.name}")
-    sync_subordinate_members(original_tables_data_set, DBTable, base.tables, session, base)
-    persistent_tables = {table.name: table for table in session if isinstance(table, DBTable)}
-    
+    journal = CheckpointJournal(session, base, "scan", original_db.last_update)
+
+    phases = [
+        ("procedures", "хранимые процедуры", original_models.OriginalProcedure, DBStoredProcedure),
+        ("views", "представления", original_models.OriginalView, DBView),
+        ("table_functions", "табличные функции", original_models.OriginalTableFunction, DBTableFunction),
+        ("scalar_functions", "скалярные функции", original_models.OriginalScalarFunction, DBScalarFunction),
+        ("tables", "таблицы", original_models.OriginalTable, DBTable),
+    ]
+    for phase, description, original_class, node_class in phases:
+        if journal.is_done(phase):
+            logging.debug(f"Пропускаем {description} БД {base.name}, они уже синхронизированы")
+            continue
+        logging.debug(f"Достаём {description} БД {base.name}")
+        originals = original_class.get_all(conn)
+        logging.debug(f"Синхронизируем {description} БД {base.name}")
+        sync_subordinate_members(originals, node_class, getattr(base, phase), session, base)
+        if issubclass(node_class, DBScript):
+            refresh_identifier_index(session, get_remaining_objects(session, node_class))
+        journal.mark_done(phase)
+
+    # триггеров много, поэтому они синхронизируются пачками таблиц:
+    # триггеры пачки достаются одним запросом, сопоставляются в памяти
+    # и пишутся вместе с отметками о таблицах одним commit'ом
+    journal.batch_size = TRIGGER_BATCH_SIZE
     logging.debug(f"Сопоставляем триггеры для оставшихся таблиц БД {base.name}")
-    for table_name in persistent_tables:
-        table = persistent_tables[table_name]
-        logging.debug(f"Собираем триггеры для таблицы {table_name} в БД {base.name}")
-        original_triggers_data_set = original_models.OriginalTrigger.get_triggers_for_table(conn, table.database_object_id)
-        sync_subordinate_members(
-            original_triggers_data_set,
-            DBTrigger, 
-            table.triggers, 
-            session,
-            table
-        )
-    
+    tables = [table for table in base.tables.values() if not journal.is_done("triggers", table.long_name)]
+    for start in range(0, len(tables), TRIGGER_BATCH_SIZE):
+        batch = tables[start:start + TRIGGER_BATCH_SIZE]
+        logging.debug(f"Собираем триггеры для {len(batch)} таблиц в БД {base.name}")
+        original_triggers = original_models.OriginalTrigger.get_triggers_for_tables(
+            conn, [table.database_object_id for table in batch])
+        with session.no_autoflush:
+            for table in batch:
+                sync_subordinate_members(
+                    original_triggers[table.database_object_id],
+                    DBTrigger,
+                    table.triggers,
+                    session,
+                    table
+                )
+        refresh_identifier_index(session, get_remaining_objects(session, DBTrigger))
+        for table in batch:
+            journal.mark_done("triggers", table.long_name)
+
     # обновляем метаданные самой базы
     base.update_from(original_db)
+    journal.finish()
     logging.info(f"Обработка базы {base.name} завершена")
 
 
+# классы оригиналов для отдельно синхронизируемых скриптов
+SCRIPT_ORIGINALS = {
+    DBScalarFunction: original_models.OriginalScalarFunction,
+    DBTableFunction: original_models.OriginalTableFunction,
+    DBView: original_models.OriginalView,
+    DBStoredProcedure: original_models.OriginalProcedure,
+    DBTrigger: original_models.OriginalTrigger,
+}
+
+
+def sync_separate_objects(nodes, session, connector):
+    """
+    Синхронизирует произвольный набор таблиц и скриптов, например
+    устаревшие объекты, выбранные в GUI.
+
+    Объекты группируются по базам, для каждой базы используется
+    соединение connector.connect_to(база); внутри базы оригиналы
+    достаются одним запросом на каждый вид объектов.
+    """
+    by_database = {}
+    for node in nodes:
+        by_database.setdefault(node.database, []).append(node)
+    for base, base_nodes in by_database.items():
+        with connector.connect_to(base) as conn:
+            sync_separate_scripts([node for node in base_nodes if isinstance(node, DBScript)], session, conn)
+            sync_separate_tables([node for node in base_nodes if isinstance(node, DBTable)], session, conn)
+
+
+def sync_separate_scripts(scripts, session, conn):
+    """
+    Синхронизирует выполняемые объекты одной боевой БД
+    (представления, функции, процедуры и триггеры).
+    """
+    groups = {}
+    for script in scripts:
+        groups.setdefault(SCRIPT_ORIGINALS[script.__class__], []).append(script)
+    for original_class, group in groups.items():
+        # достаём из базы оригиналы всей группы одним запросом
+        originals = original_class.get_by_ids(conn, [script.database_object_id for script in group])
+        for script in group:
+            original = originals.get(script.database_object_id)
+            if original is None:
+                # если оригинал не найден в боевой базе, то удаляем ноду
+                session.delete(script)
+            elif needs_update(original, script):
+                script.update_from(original)
+
+
 def sync_separate_script(script, session, conn):
     """
     Синхронизирует отдельный выполняемый объект боевой БД
     (представление, функцию, процедуру или триггер)
     """
-    # определяем класс оригинала и запрос, с помощью которого
-    # будем получать оригинализ боевой БД
-    choices = {
-        DBScalarFunction: original_models.OriginalScalarFunction,
-        DBTableFunction: original_models.OriginalTableFunction,
-        DBView: original_models.OriginalView,
-        DBStoredProcedure: original_models.OriginalProcedure,
-        DBTrigger: original_models.OriginalTrigger,
-    }
-    original_class = choices[script.__class__]
-    # достаём из базы оригинал
-    original = original_class.get_by_id(conn, script.database_object_id)
-    if original:
-        # сверяем даты обновления
-        # если оригинал был изменён, синхронизируемся
-        if original.last_update > script.last_update:
-            script.update_from(original)
-    else:
-        # если оригинал не найден в боевой базе, то удаляем ноду
-        session.delete(script)
+    sync_separate_scripts([script], session, conn)
+
+
+def sync_separate_tables(tables, session, conn):
+    """
+    Синхронизирует таблицы одной боевой БД вместе с их триггерами.
+    """
+    if not tables:
+        return
+    originals = original_models.OriginalTable.get_by_ids(conn, [table.database_object_id for table in tables])
+    changed = []
+    for table in tables:
+        original = originals.get(table.database_object_id)
+        if original is None:
+            # если оригинал не найден в боевой базе, то удаляем таблицу
+            session.delete(table)
+        elif needs_update(original, table):
+            changed.append(table)
+    if not changed:
+        return
+    # подгружаем триггеры всех изменившихся таблиц одним запросом к ДПМ
+    # и одним запросом к боевой базе, после чего сопоставляем их в памяти
+    changed = session.query(DBTable).options(selectinload(DBTable.triggers))\
+        .filter(DBTable.id.in_([table.id for table in changed])).all()
+    original_triggers = original_models.OriginalTrigger.get_triggers_for_tables(
+        conn, [table.database_object_id for table in changed])
+    for table in changed:
+        table.update_from(originals[table.database_object_id])
+        sync_subordinate_members(original_triggers[table.database_object_id], DBTrigger, table.triggers, session, table)
 
 
 def sync_separate_table(table, session, conn):
     """
     Синхронизирует отдельную таблицу.
     """
-    # достаём оригинал
-    original = original_models.OriginalTable.get_by_id(conn, table.database_object_id)
-    if original:
-        # сверяем даты обновления
-        # если оригинал был изменён, синхронизируемся
-        if original.last_update > table.last_update:
-            table = session.query(DBTable).options(selectinload(DBTable.triggers))\
-                .filter(DBTable.database_object_id == table.database_object_id).one()
-            table.update_from(original)
-            # тащим из базы все триггеры этой таблицы и сопоставляем их
-            original_triggers = original_models.OriginalTrigger.get_triggers_for_table(conn, table.id)
-            sync_subordinate_members(original_triggers, table.triggers, session, parent=table)
-    # если оригинал не найден в боевой базе, то удаляем таблицу
-    else:
-        session.delete(table)
+    sync_separate_tables([table], session, conn)
@@ -6,74 +6,128 @@ from sqlalchemy.orm import selectinload
 from sqlalchemy import or_
 from dpm.models import Application, Form, ClientQuery, Database
 from .common_functions import sync_subordinate_members
-from .delphi_classes import DelphiProject, DelphiForm
+from .delphi_classes import DelphiProject, DelphiForm, normalize_path
+from .checkpoints import CheckpointJournal
+from dpm.identifier_index import refresh_identifier_index
 
 
-def scan_application(app, session):
-    original_project = DelphiProject(app.path)
+def scan_application(app, session, registry=None):
+    """
+    Синхронизирует один АРМ.
+
+    registry - общий реестр форм (FormRegistry); если передан, то формы,
+    общие для нескольких АРМов, читаются и парсятся один раз за синхронизацию.
+
+    Каждая форма сохраняется в ДПМ вместе с контрольной точкой, поэтому
+    упавшая синхронизация продолжается с первой необработанной формы.
+    Формы разбираются заранее, а индекс идентификаторов компонентов
+    пишется перед commit'ом пачки форм, так что транзакция записи
+    открывается только на время записи.
+    """
+    original_project = DelphiProject(app.path, registry)
     # продолжать только если требуется обновление
     if original_project.last_update <= app.last_update:
         return
+    # компоненты изменившихся форм, ещё не попавшие в индекс идентификаторов
+    changed_components = []
+
+    def index_components():
+        refresh_identifier_index(session, changed_components)
+        changed_components.clear()
+
+    journal = CheckpointJournal(
+        session, app, "scan", original_project.last_update, batch_size=20, before_commit=index_components)
     # достаём из системы список доступных баз, чтобы прицепить к ним компоненты
     available_databases = {db.name: db for db in session.query(Database).all()}
     default_database = app.default_database
     # достаём из базы формы, либо имеющие такой же путь, как в конфиге проекта
     # либо прикреплённые к проекту ранее
-    # это позволяет обойти проблемы, возникающие от того, существуют формы, общие для нескольких проектов
+    # это позволяет обойти проблемы, возникающие от того, существуют формы, общие для нескольких проектов;
+    # пути сравниваются по normalize_path, а в ДПМ остаются в том виде, в каком были записаны
     condition = or_(Form.applications.any(id = app.id), Form.path.in_(original_project.forms.keys()))
     form_nodes = {
-        form.path: form
+        normalize_path(form.path): form
         for form in session.query(Form).options(selectinload(Form.applications),selectinload(Form.components)).filter(condition)
     }
-    # словарь форм, которые надо будет распарсить и залить/перезалить их компоненты в ДПМ
-    dirty_forms = {}
-    # сверяясь с конфигом проекта, ищем формы, которые надо обновить/добавить
-    for form_path in original_project.forms:
-        original_form = original_project.forms[form_path]
-        form_node = form_nodes.get(form_path)
+
+    # парсим все формы и собираем коннекты со всех распарсенных форм;
+    # они нужны, чтобы прицепить компоненты к базам
+    connection_pool = {}
+    for original_form in original_project.forms.values():
+        original_form.parse()
+        connection_pool.update(original_form.connections)
+
+    # сверяясь с конфигом проекта, ищем формы, которые надо обновить/добавить,
+    # и обновляем компоненты только на новых/изменившихся;
+    # форма со своими компонентами сохраняется целиком вместе с контрольной точкой
+    for form_path, original_form in original_project.forms.items():
+        if journal.is_done("forms", form_path):
+            continue
+        form_node = form_nodes.get(normalize_path(form_path))
+        is_dirty = False
         if form_node is not None:
             if not (app in form_node.applications):
                 form_node.applications.append(app)
             if (original_form.last_update > form_node.last_update):
                 form_node.update_from(original_form)
-                dirty_forms[form_path] = form_node
+                is_dirty = True
         else:
-            new_form = Form.create_from(original_form, app)
-            new_form.applications.append(app)
-            dirty_forms[form_path] = new_form
+            form_node = Form.create_from(original_form, app)
+            is_dirty = True
+        if is_dirty:
+            sync_subordinate_members(
+                original_form.queries,
+                ClientQuery,
+                form_node.components,
+                session,
+                form_node
+            )
+            bind_components_to_databases(
+                form_node.components.values(),
+                original_form.queries,
+                connection_pool,
+                available_databases,
+                default_database)
+            changed_components.extend(form_node.components.values())
+        journal.mark_done("forms", form_path)
 
     # выявляем формы, выбывшие из проекта
+    original_paths = {normalize_path(form_path) for form_path in original_project.forms}
     for form_path in form_nodes:
         form_node = form_nodes[form_path]
-        if not (form_path in original_project.forms):
+        if not (form_path in original_paths):
             if form_node.is_shared:
                 app.forms.remove(form_node)
             else:
                 session.delete(form_node)
-    
-    # парсим все формы, обновляем компоненты только на новых/изменившихся
-    connection_pool = {}
-    for form_path in original_project.forms:
-        original_project.forms[form_path].parse()
-        # собираем коннекты со всех распарсенных форм
-        connection_pool.update(original_project.forms[form_path].connections)
-        if form_path in dirty_forms:
-            sync_subordinate_members(
-                original_project.forms[form_path].queries,
-                ClientQuery,
-                dirty_forms[form_path].components,
-                session,
-                dirty_forms[form_path]
-            )
-    persistent_components = [component for component in session if isinstance(component, ClientQuery)]
 
+    persistent_components = [component for component in session if isinstance(component, ClientQuery)]
     original_components = {component[0]: component[1] for component in itertools.chain.from_iterable([form.queries.items() for form in original_project.forms.values()])}
-    
-    for component in persistent_components:
-        original_component = original_components[component.name]
+    bind_components_to_databases(
+        persistent_components,
+        original_components,
+        connection_pool,
+        available_databases,
+        default_database)
+
+    # обновляем дату синхронизации самого АРМа
+    app.update_from(original_project)
+    index_components()
+    journal.finish()
+
+
+def bind_components_to_databases(components, original_components, connection_pool, available_databases, default_database):
+    """
+    Прицепляет компоненты к базам, с которыми работают их соединения
+    (TADOConnection); если соединение не найдено, то компонент
+    работает с базой АРМа по умолчанию.
+    """
+    for component in components:
+        original_component = original_components.get(component.name)
+        if original_component is None:
+            continue
         conn = connection_pool.get(original_component.connection)
         if conn is not None:
             component.database = available_databases.get(conn.database)
         else:
             component.database = default_database
-    
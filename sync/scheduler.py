@@ -0,0 +1,368 @@
+"""
+Планировщик полной синхронизации всех баз и АРМов из конфига.
+
+Синхронизация разбивается на задачи, между которыми есть зависимости:
+сначала обрабатываются базы данных, затем АРМы, которые к ним обращаются,
+и в самом конце - анализ связей для каждой базы. Независимые задачи
+выполняются параллельно в пуле потоков; количество одновременных задач,
+работающих с боевым сервером, ограничено отдельно.
+
+Каждая задача работает в своей сессии ДПМ; транзакции записи в ДПМ идут
+по очереди под блокировкой записи соединений писателя (dpm.sqlite_profile),
+так как SQLite допускает только одного писателя.
+"""
+import os
+import time
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dpm.models import Database, Application
+from dpm.linking import analize_links, stamp_components
+from dpm.scanner import ScanPool
+from dpm.node_stats import update_node_stats
+from .common_classes import SyncException
+from .scan_db import scan_database
+from .scan_source import scan_application
+from .delphi_classes import FormRegistry
+
+
+# дата обновления, которая ставится новым нодам баз и АРМов,
+# чтобы их первая синхронизация гарантированно сработала
+NEVER_UPDATED = datetime.datetime(1970, 1, 1)
+
+
+def referenced_databases(app_config, db_names):
+    """
+    Возвращает имена баз, с которыми работает АРМ: базы из его конфига
+    (databases и default_database), а если они не указаны - все db_names.
+    """
+    referenced = list(app_config.get("databases", []))
+    if "default_database" in app_config:
+        referenced.append(app_config["default_database"])
+    if not referenced:
+        return list(db_names)
+    for db_name in referenced:
+        if db_name not in db_names:
+            raise SyncException(f"База {db_name} из конфига АРМа не указана в списке баз")
+    return referenced
+
+
+class JobStatus:
+    WAITING = "ожидает"
+    RUNNING = "выполняется"
+    DONE = "выполнена"
+    FAILED = "ошибка"
+    SKIPPED = "пропущена"
+
+
+class SyncJob:
+    """
+    Одна задача синхронизации.
+
+    kind - вид задачи (database, application, links, components, stats), от него зависит
+    то, какой лимит параллельности к ней применяется;
+    target - имя базы или АРМа;
+    action - функция, выполняющая работу; получает сессию ДПМ;
+    depends_on - задачи, которые должны успешно завершиться до запуска этой.
+    """
+
+    def __init__(self, kind, target, action, depends_on=None):
+        self.kind = kind
+        self.target = target
+        self.action = action
+        self.depends_on = list(depends_on or [])
+        self.status = JobStatus.WAITING
+        self.attempts = 0
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def name(self):
+        return f"{self.kind}:{self.target}"
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+    def __repr__(self):
+        return f"{self.name} ({self.status})"
+
+
+class SyncProgress:
+    """
+    Сводка о ходе синхронизации; пишется в лог при каждом изменении
+    состояния задач и может передаваться в callback.
+    """
+
+    def __init__(self, jobs, callback=None, form_registry=None, write_lock=None):
+        self.jobs = jobs
+        self.callback = callback
+        self.form_registry = form_registry
+        self.write_lock = write_lock
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def count(self, status):
+        return len([job for job in self.jobs if job.status == status])
+
+    @property
+    def summary(self):
+        running = ", ".join(job.name for job in self.jobs if job.status == JobStatus.RUNNING)
+        return (
+            f"Задач: {len(self.jobs)}, выполнено: {self.count(JobStatus.DONE)}, "
+            f"ошибок: {self.count(JobStatus.FAILED)}, пропущено: {self.count(JobStatus.SKIPPED)}, "
+            f"ожидают: {self.count(JobStatus.WAITING)}; сейчас выполняются: {running or '-'}; "
+            f"прошло {time.monotonic() - self.started:.1f} с"
+        )
+
+    def report(self):
+        with self._lock:
+            summary = self.summary
+            logging.info(summary)
+            if self.callback is not None:
+                self.callback(self)
+
+    def final_report(self):
+        """
+        Итоговый отчёт: длительность каждой задачи и общая длительность.
+        Сумма длительностей задач показывает, сколько шла бы
+        последовательная синхронизация.
+        """
+        lines = [self.summary]
+        for job in sorted(self.jobs, key=lambda j: j.duration, reverse=True):
+            line = f"    {job.name}: {job.status}, {job.duration:.1f} с, попыток: {job.attempts}"
+            if job.error is not None:
+                line += f", ошибка: {job.error}"
+            lines.append(line)
+        total = sum(job.duration for job in self.jobs)
+        lines.append(f"Суммарное время задач: {total:.1f} с")
+        if self.form_registry is not None:
+            lines.append(self.form_registry.summary)
+        if self.write_lock is not None:
+            lines.append(self.write_lock.summary)
+        return "\n".join(lines)
+
+
+class SyncScheduler:
+    """
+    Выполняет граф задач синхронизации с учётом зависимостей.
+
+    cpu_limit - максимальное количество одновременно выполняемых задач;
+    connection_limit - максимальное количество задач, одновременно
+    работающих с боевым сервером (синхронизация баз и анализ связей);
+    retries - сколько раз повторять упавшую задачу;
+    retry_delay - пауза перед повтором в секундах (удваивается с каждой попыткой);
+    link_processes - сколько процессов разбора кода могут использовать
+    все анализы связей вместе (по умолчанию 1 - разбор в потоке задачи);
+    пул процессов (ScanPool) запускается один раз на run() и общий для
+    всех анализов.
+    """
+
+    def __init__(self, connector, cpu_limit=None, connection_limit=4, retries=2, retry_delay=5.0, progress_callback=None, link_processes=None):
+        self.connector = connector
+        self.cpu_limit = cpu_limit or os.cpu_count() or 1
+        self.connection_limit = connection_limit
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.progress_callback = progress_callback
+        self.link_pool = ScanPool(link_processes)
+        self.jobs = []
+        # SQLite допускает только одного писателя: транзакции записи всех
+        # задач идут по очереди под блокировкой соединений писателя ДПМ;
+        # время ожидания блокировки попадает в итоговый отчёт
+        self.write_lock = connector.dpm_write_lock
+        self._connection_slots = threading.BoundedSemaphore(connection_limit)
+        # формы, общие для нескольких АРМов, обрабатываются один раз за запуск
+        self.form_registry = FormRegistry()
+
+    def add_job(self, kind, target, action, depends_on=None):
+        job = SyncJob(kind, target, action, depends_on)
+        self.jobs.append(job)
+        return job
+
+    def build_from_config(self, config):
+        """
+        Строит граф задач по конфигу: задача на каждую базу из
+        config["databases"], задача на каждый АРМ из config["applications"]
+        и задача анализа связей на каждую базу.
+
+        АРМ зависит от баз, перечисленных в его конфиге в полях
+        default_database и databases; если там ничего не указано,
+        считается, что АРМ может обращаться к любой базе.
+        Анализ связей базы запускается после синхронизации самой базы
+        и всех АРМов, которые к ней обращаются; после анализа всех баз
+        компоненты АРМов отмечаются как проверенные, а в самом конце
+        пересчитывается статистика связей нод.
+        """
+        session = self.connector.connect_to_dpm()
+        db_nodes = self._ensure_databases(session, config["databases"])
+        app_nodes = self._ensure_applications(session, config["applications"], db_nodes)
+        session.commit()
+        db_ids = {name: node.id for name, node in db_nodes.items()}
+        app_ids = {name: node.id for name, node in app_nodes.items()}
+        session.close()
+
+        db_jobs = {}
+        for db_name in config["databases"]:
+            db_jobs[db_name] = self.add_job(
+                "database", db_name, self._database_action(db_ids[db_name], db_name))
+
+        app_jobs = {}
+        for app_name, app_config in config["applications"].items():
+            referenced = referenced_databases(app_config, db_jobs.keys())
+            app_jobs[app_name] = self.add_job(
+                "application",
+                app_name,
+                self._application_action(app_ids[app_name]),
+                depends_on=[db_jobs[db_name] for db_name in referenced])
+
+        links_jobs = []
+        for db_name in config["databases"]:
+            dependencies = [db_jobs[db_name]]
+            for app_name, app_config in config["applications"].items():
+                if db_name in referenced_databases(app_config, db_jobs.keys()):
+                    dependencies.append(app_jobs[app_name])
+            links_jobs.append(
+                self.add_job("links", db_name, self._links_action(db_ids[db_name], db_name), depends_on=dependencies))
+        components_job = self.add_job("components", "все АРМы", stamp_components, depends_on=links_jobs)
+        self.add_job("stats", "все ноды", update_node_stats, depends_on=[components_job])
+        return self
+
+    def run(self):
+        """
+        Выполняет все задачи. Задача запускается, как только все её
+        зависимости успешно завершены; если хотя бы одна зависимость
+        упала, задача пропускается.
+        Возвращает объект SyncProgress с итоговым состоянием.
+        """
+        progress = SyncProgress(self.jobs, self.progress_callback, self.form_registry, self.write_lock)
+        pending = {}
+        with self.link_pool, ThreadPoolExecutor(max_workers=self.cpu_limit) as executor:
+            while True:
+                for job in self.jobs:
+                    if job.status != JobStatus.WAITING:
+                        continue
+                    if any(dep.status in (JobStatus.FAILED, JobStatus.SKIPPED) for dep in job.depends_on):
+                        job.status = JobStatus.SKIPPED
+                        logging.warning(f"Задача {job.name} пропущена: не выполнены зависимости")
+                        progress.report()
+                    elif all(dep.status == JobStatus.DONE for dep in job.depends_on):
+                        job.status = JobStatus.RUNNING
+                        pending[executor.submit(self._run_job, job)] = job
+                        progress.report()
+                if not pending:
+                    break
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    job.status = JobStatus.DONE if future.result() else JobStatus.FAILED
+                    progress.report()
+        logging.info(progress.final_report())
+        logging.info(self.connector.dpm_summary())
+        return progress
+
+    # region utility methods
+    def _run_job(self, job):
+        """
+        Выполняет задачу с повторами. Возвращает True в случае успеха.
+        """
+        job.started = time.monotonic()
+        delay = self.retry_delay
+        while job.attempts <= self.retries:
+            job.attempts += 1
+            session = self.connector.connect_to_dpm()
+            # все изменения пишутся в ДПМ только при commit, иначе автофлаш
+            # откроет транзакцию записи и задача будет держать блокировку
+            # записи всё время работы
+            session.autoflush = False
+            try:
+                if job.kind in ("application", "components", "stats"):
+                    job.action(session)
+                else:
+                    with self._connection_slots:
+                        job.action(session)
+                session.commit()
+                job.error = None
+                job.finished = time.monotonic()
+                return True
+            except Exception as e:
+                session.rollback()
+                job.error = e
+                logging.exception(f"Задача {job.name} упала, попытка {job.attempts}")
+                if job.attempts <= self.retries:
+                    time.sleep(delay)
+                    delay *= 2
+            finally:
+                session.close()
+        job.finished = time.monotonic()
+        return False
+
+    def _database_action(self, db_id, db_name):
+        def action(session):
+            base = session.query(Database).filter(Database.id == db_id).one()
+            with self.connector.connect_to(db_name) as conn:
+                scan_database(base, session, conn)
+        return action
+
+    def _application_action(self, app_id):
+        def action(session):
+            app = session.query(Application).filter(Application.id == app_id).one()
+            scan_application(app, session, self.form_registry)
+        return action
+
+    def _links_action(self, db_id, db_name):
+        def action(session):
+            base = session.query(Database).filter(Database.id == db_id).one()
+            with self.connector.connect_to(db_name) as conn:
+                analize_links(
+                    session,
+                    conn,
+                    database=base,
+                    processes=self.link_pool)
+        return action
+
+    @staticmethod
+    def _ensure_databases(session, db_names):
+        """
+        Находит в ДПМ ноды для баз из конфига, недостающие создаёт.
+        """
+        nodes = {db.name: db for db in session.query(Database).filter(Database.name.in_(db_names))}
+        for db_name in db_names:
+            if db_name not in nodes:
+                nodes[db_name] = Database(name=db_name, last_update=NEVER_UPDATED)
+                session.add(nodes[db_name])
+        session.flush()
+        return nodes
+
+    @staticmethod
+    def _ensure_applications(session, apps_config, db_nodes):
+        """
+        Находит в ДПМ ноды для АРМов из конфига, недостающие создаёт.
+        """
+        nodes = {app.name: app for app in session.query(Application).filter(Application.name.in_(apps_config.keys()))}
+        for app_name, app_config in apps_config.items():
+            if app_name not in nodes:
+                nodes[app_name] = Application(name=app_name, path=app_config["path"], last_update=NEVER_UPDATED)
+                session.add(nodes[app_name])
+            app = nodes[app_name]
+            app.path = app_config["path"]
+            if "default_database" in app_config:
+                app.default_database = db_nodes[app_config["default_database"]]
+        session.flush()
+        return nodes
+    # endregion
+
+
+def sync_all(connector, config):
+    """
+    Синхронизирует все базы и АРМы из конфига и строит для них связи.
+    Параметры параллельности берутся из необязательного раздела
+    config["scheduler"] (cpu_limit, connection_limit, retries, retry_delay,
+    link_processes).
+    """
+    scheduler = SyncScheduler(connector, **config.get("scheduler", {}))
+    return scheduler.build_from_config(config).run()
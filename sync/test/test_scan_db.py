@@ -0,0 +1,65 @@
+from sync.scan_db import scan_database
+from sync.scheduler import NEVER_UPDATED
+from dpm.connector import Connector
+from dpm.catalog_generator import generate_catalogs
+from dpm.models import Database, DBScript, DBTrigger, IndexedText
+from unittest import mock
+import unittest
+import tempfile
+import shutil
+import os
+
+
+class RecordingConnection:
+    """
+    Соединение с боевой базой, которое запоминает, была ли захвачена
+    блокировка записи ДПМ во время каждого запроса.
+    """
+
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+        self.locked = []
+
+    def execute(self, *args, **kwargs):
+        self.locked.append(self.lock.locked())
+        return self.conn.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class TestScanDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        generate_catalogs(
+            self.directory, ["Bank"], tables=60, procedures=30, views=10, triggers=40,
+            table_functions=5, scalar_functions=5)
+        self.connector = Connector(
+            host_dpm=f"sqlite:///{os.path.join(self.directory, 'dpm.sqlite')}",
+            offline=True,
+            catalog_snapshots=self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_remote_queries_while_writing(self):
+        session = self.connector.connect_to_dpm()
+        base = Database(name="Bank", last_update=NEVER_UPDATED)
+        session.add(base)
+        session.commit()
+        lock = self.connector.dpm_write_lock
+        with mock.patch("sync.scan_db.TRIGGER_BATCH_SIZE", 20), self.connector.connect_to("Bank") as conn:
+            recording = RecordingConnection(conn, lock)
+            scan_database(base, session, recording)
+        session.commit()
+        # метаданные, пять видов объектов и по запросу на пачку из 20 таблиц
+        self.assertEqual(len(recording.locked), 1 + 5 + 3)
+        self.assertNotIn(True, recording.locked)
+        self.assertFalse(lock.locked())
+        # все триггеры пачек попали в индекс идентификаторов
+        self.assertGreater(session.query(DBTrigger).count(), 0)
+        indexed = {node_id for node_id, in session.query(IndexedText.node_id)}
+        self.assertEqual(indexed, {node_id for node_id, in session.query(DBScript.id)})
+        session.close()
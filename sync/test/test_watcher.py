@@ -0,0 +1,193 @@
+from sync.watcher import SourceWatcher, take_snapshot, refresh_snapshot
+from sync.scheduler import NEVER_UPDATED
+from sync.delphi_classes import normalize_path
+from dpm.models import Application, Database, Form
+from dpm.migrations import prepare_dpm
+from dpm.sqlite_profile import create_dpm_engine, TimedLock
+from sqlalchemy.orm import sessionmaker
+from unittest import mock
+import unittest
+import tempfile
+import shutil
+import time
+import os
+
+
+PROJECT = """<Project xmlns="http://schemas.microsoft.com/developer/msbuild/2003">
+  <ItemGroup>
+{}
+  </ItemGroup>
+</Project>"""
+UNIT = """    <DCCReference Include="{0}.pas">
+      <Form>{0}</Form>
+    </DCCReference>"""
+FORM = "object {0}: T{0}\r\n  Caption = '{0}'\r\nend\r\n"
+
+
+def write_project(directory, forms):
+    for name in forms:
+        with open(os.path.join(directory, f"{name}.dfm"), "w") as f:
+            f.write(FORM.format(name))
+    path = os.path.join(directory, "App.dproj")
+    with open(path, "w") as f:
+        f.write(PROJECT.format("\n".join(UNIT.format(name) for name in forms)))
+    # даты изменения должны быть заведомо новее прошлой синхронизации
+    stamp = time.time() + len(forms)
+    for name in [f"{name}.dfm" for name in forms] + ["App.dproj"]:
+        os.utime(os.path.join(directory, name), (stamp, stamp))
+    return path
+
+
+class DpmConnector:
+
+    def __init__(self, path):
+        self.dpm_write_lock = TimedLock()
+        engine = create_dpm_engine(f"sqlite:///{path}", write_lock=self.dpm_write_lock)
+        prepare_dpm(engine)
+        self.sessionmaker = sessionmaker(bind=engine)
+
+    def connect_to_dpm(self):
+        return self.sessionmaker()
+
+
+class ScriptedWatcher(SourceWatcher):
+    """
+    Наблюдатель, который вместо ожидания выполняет очередное действие
+    из списка changes (изменение файлов) и опрашивает папки.
+    """
+
+    def __init__(self, changes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changes = list(changes)
+
+    def _sleep(self, timeout):
+        if self.changes:
+            self.changes.pop(0)()
+        return None
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def touch(self, *parts):
+        path = os.path.join(self.root, *parts)
+        with open(path, "w") as f:
+            f.write("x")
+        return normalize_path(path)
+
+    def test_only_watched_extensions(self):
+        form = self.touch("Form1.dfm")
+        self.touch("Unit1.pas")
+        self.assertEqual(set(take_snapshot([self.root])), {form})
+
+    def test_file_removed_while_scanning(self):
+        self.touch("Form1.dfm")
+        entry = mock.Mock()
+        entry.name = "Gone.dfm"
+        entry.path = os.path.join(self.root, "Gone.dfm")
+        entry.is_dir.return_value = False
+        entry.stat.side_effect = FileNotFoundError
+        entries = list(os.scandir(self.root)) + [entry]
+        with mock.patch("sync.watcher.os.scandir", return_value=entries):
+            snapshot = take_snapshot([self.root])
+        self.assertEqual(set(snapshot), {normalize_path(os.path.join(self.root, "Form1.dfm"))})
+
+    def test_new_directory_is_watched(self):
+        directories = {}
+        snapshot = take_snapshot([self.root], directories=directories)
+        os.mkdir(os.path.join(self.root, "forms"))
+        form = self.touch("forms", "Form1.dfm")
+        self.assertEqual(refresh_snapshot(snapshot, directories), {form})
+        self.assertIn(os.path.dirname(form), directories)
+        # файл в новой папке виден при следующем опросе
+        os.utime(form, (time.time() + 10, time.time() + 10))
+        self.assertEqual(refresh_snapshot(snapshot, directories), {form})
+
+    def test_removed_directory(self):
+        os.mkdir(os.path.join(self.root, "forms"))
+        form = self.touch("forms", "Form1.dfm")
+        directories = {}
+        snapshot = take_snapshot([self.root], directories=directories)
+        shutil.rmtree(os.path.join(self.root, "forms"))
+        self.assertEqual(refresh_snapshot(snapshot, directories), {form})
+        self.assertEqual(snapshot, {})
+        self.assertEqual(set(directories), {normalize_path(self.root)})
+
+    def test_dirty_directories_only(self):
+        os.mkdir(os.path.join(self.root, "a"))
+        os.mkdir(os.path.join(self.root, "b"))
+        directories = {}
+        snapshot = take_snapshot([self.root], directories=directories)
+        form_a = self.touch("a", "Form1.dfm")
+        self.touch("b", "Form2.dfm")
+        self.assertEqual(refresh_snapshot(snapshot, directories, {os.path.dirname(form_a)}), {form_a})
+
+    def test_modified_file(self):
+        form = self.touch("Form1.dfm")
+        directories = {}
+        snapshot = take_snapshot([self.root], directories=directories)
+        with open(form, "a") as f:
+            f.write("y")
+        self.assertEqual(refresh_snapshot(snapshot, directories), {form})
+        self.assertEqual(refresh_snapshot(snapshot, directories), set())
+
+
+class TestSourceWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.project = os.path.join(self.directory, "app")
+        os.mkdir(self.project)
+        self.path = write_project(self.project, ["Form1"])
+        self.connector = DpmConnector(os.path.join(self.directory, "dpm.sqlite"))
+        self.config = {
+            "applications": {"App": {"path": self.path, "default_database": "Bank"}},
+            "databases": ["Bank", "Other"],
+        }
+        session = self.connector.connect_to_dpm()
+        bank = Database(name="Bank", last_update=NEVER_UPDATED)
+        session.add_all([bank, Database(name="Other", last_update=NEVER_UPDATED)])
+        session.add(Application(name="App", path=self.path, last_update=NEVER_UPDATED, default_database=bank))
+        session.commit()
+        session.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def form_names(self):
+        session = self.connector.connect_to_dpm()
+        try:
+            return sorted(form.name for form in session.query(Form))
+        finally:
+            session.close()
+
+    def test_changed_application_is_synced(self):
+        changes = [lambda: write_project(self.project, ["Form1", "Form2"])]
+        watcher = ScriptedWatcher(changes, self.connector, self.config, link=False)
+        watcher.run(iterations=1)
+        self.assertEqual(self.form_names(), ["Form1.dfm", "Form2.dfm"])
+
+    def test_without_changes(self):
+        watcher = ScriptedWatcher([], self.connector, self.config, link=False)
+        with mock.patch("sync.watcher.scan_application") as scan:
+            watcher.run(iterations=2)
+        # синхронизация всех АРМов при запуске, дальше изменений нет
+        self.assertEqual(scan.call_count, 1)
+
+    def test_links_only_for_databases_of_changed_applications(self):
+        watcher = ScriptedWatcher([], self.connector, self.config)
+        watcher.connector.connect_to = mock.MagicMock()
+        linked = []
+
+        def analize_links(session, conn, database):
+            linked.append(database.name)
+            return {"added": [], "updated": [], "deleted": []}
+
+        with mock.patch("sync.watcher.analize_links", analize_links):
+            watcher.run(iterations=0)
+        self.assertEqual(linked, ["Bank"])
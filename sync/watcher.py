@@ -0,0 +1,375 @@
+"""
+Режим постоянной синхронизации исходников Delphi.
+
+Наблюдатель хранит снимок дат изменения и размеров всех файлов .dproj и
+.dfm в папках проектов и синхронизирует только те АРМы, чьи файлы
+изменились. Формы, которые не менялись, берутся из общего реестра форм
+без повторного чтения и парсинга. После синхронизации связи строятся
+только для баз, с которыми работают изменившиеся АРМы.
+
+Если установлен пакет inotify_simple (Linux), то наблюдатель спит до
+прихода события от файловой системы и перечитывает только папки, из
+которых пришли события; на новые папки наблюдение ставится сразу.
+Иначе папки опрашиваются раз в poll_interval секунд: перечитываются
+только папки, у которых поменялась дата изменения, у остальных
+проверяются даты и размеры уже известных файлов.
+"""
+import os
+import time
+import logging
+from dpm.models import Application, Database, Form, ClientQuery
+from dpm.linking import analize_links, stamp_components
+from dpm.node_stats import update_node_stats
+from .delphi_classes import FormRegistry, normalize_path
+from .scan_source import scan_application
+from .scheduler import referenced_databases
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+
+WATCHED_EXTENSIONS = (".dproj", ".dfm")
+
+
+def take_snapshot(roots, extra_dirs=(), directories=None):
+    """
+    Возвращает словарь {путь: (mtime_ns, размер)} для всех файлов
+    проектов и форм: папки roots обходятся рекурсивно, extra_dirs - без
+    захода во вложенные папки.
+    directories - словарь, в который записываются обойдённые папки
+    {путь: (mtime_ns, рекурсивно ли)}; он нужен для refresh_snapshot.
+    """
+    snapshot = {}
+    if directories is None:
+        directories = {}
+    for root in roots:
+        scan_directory(normalize_path(root), True, snapshot, directories)
+    for directory in extra_dirs:
+        directory = normalize_path(directory)
+        # папка уже обойдена вместе с одним из проектов
+        if directory not in directories:
+            scan_directory(directory, False, snapshot, directories)
+    return snapshot
+
+
+def scan_directory(directory, recursive, snapshot, directories):
+    """
+    Добавляет в снимок файлы проектов и форм из папки directory
+    (и из вложенных папок, если recursive), а саму папку - в directories.
+    """
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+        entries = list(os.scandir(directory))
+    except OSError as e:
+        logging.warning(f"Не удалось прочитать папку {directory}: {e}")
+        return
+    directories[directory] = (mtime, recursive)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if recursive:
+                scan_directory(normalize_path(entry.path), True, snapshot, directories)
+        elif entry.name.lower().endswith(WATCHED_EXTENSIONS):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # файл удалили, пока папка обходилась
+                continue
+            snapshot[normalize_path(entry.path)] = (stat.st_mtime_ns, stat.st_size)
+
+
+def refresh_snapshot(snapshot, directories, dirty=None):
+    """
+    Обновляет снимок и словарь папок на месте и возвращает множество
+    путей, которые появились, исчезли или изменились.
+
+    dirty - папки, из которых пришли события inotify; перечитываются только
+    они. Если dirty равно None (опрос), перечитываются папки, у которых
+    поменялась дата изменения (в них появились, исчезли или переименованы
+    файлы или папки), а у файлов остальных папок проверяются даты и размеры.
+    """
+    old = dict(snapshot)
+    if dirty is None:
+        dirty = set()
+        for directory, (mtime, _) in directories.items():
+            try:
+                if os.stat(directory).st_mtime_ns != mtime:
+                    dirty.add(directory)
+            except OSError:
+                dirty.add(directory)
+        for path in list(snapshot):
+            if os.path.dirname(path) in dirty:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del snapshot[path]
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    for directory in dirty:
+        if directory in directories:
+            _rescan_directory(directory, snapshot, directories)
+    return diff_snapshots(old, snapshot)
+
+
+def _rescan_directory(directory, snapshot, directories):
+    """
+    Перечитывает одну папку из directories: файлы в ней, новые вложенные
+    папки (целиком, если папка обходится рекурсивно) и пропавшие вложенные папки.
+    """
+    _, recursive = directories[directory]
+    for path in [path for path in snapshot if os.path.dirname(path) == directory]:
+        del snapshot[path]
+    subdirectories = {path for path in directories if os.path.dirname(path) == directory}
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+        entries = list(os.scandir(directory))
+    except OSError:
+        # папку удалили вместе со всем содержимым
+        _forget_tree(directory, snapshot, directories)
+        return
+    directories[directory] = (mtime, recursive)
+    for entry in entries:
+        path = normalize_path(entry.path)
+        if entry.is_dir(follow_symlinks=False):
+            if recursive and path not in directories:
+                scan_directory(path, True, snapshot, directories)
+            subdirectories.discard(path)
+        elif entry.name.lower().endswith(WATCHED_EXTENSIONS):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    for path in subdirectories:
+        _forget_tree(path, snapshot, directories)
+
+
+def _forget_tree(directory, snapshot, directories):
+    prefix = directory + os.sep
+    for path in [path for path in snapshot if path.startswith(prefix)]:
+        del snapshot[path]
+    for path in [path for path in directories if path == directory or path.startswith(prefix)]:
+        del directories[path]
+
+
+def diff_snapshots(old, new):
+    """
+    Возвращает множество путей, которые появились, исчезли или изменились.
+    """
+    changed = set(old.keys()) ^ set(new.keys())
+    changed.update(path for path in old.keys() & new.keys() if old[path] != new[path])
+    return changed
+
+
+class SourceWatcher:
+    """
+    Следит за исходниками АРМов из конфига и синхронизирует изменившиеся.
+
+    poll_interval - период опроса папок, если inotify недоступен;
+    debounce - сколько секунд после последнего изменения ждать перед
+    синхронизацией, чтобы серия сохранений обрабатывалась один раз;
+    link - строить ли связи после синхронизации АРМов.
+    """
+
+    def __init__(self, connector, config, poll_interval=5.0, debounce=2.0, link=True):
+        self.connector = connector
+        self.config = config
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.link = link
+        # реестр живёт всё время работы наблюдателя: неизменившиеся
+        # формы не перечитываются и не перепарсиваются
+        self.registry = FormRegistry()
+        self.snapshot = {}
+        # наблюдаемые папки {путь: (mtime_ns, рекурсивно ли)}
+        self.directories = {}
+        self._roots = None
+        self._extra_dirs = None
+        self._inotify = None
+        # наблюдения inotify: {папка: дескриптор} и обратно
+        self._watches = {}
+        self._watched_dirs = {}
+
+    # region public methods
+    def run(self, iterations=None):
+        """
+        Основной цикл; iterations ограничивает количество циклов ожидания
+        (нужно для тестов), по умолчанию работает бесконечно.
+        """
+        logging.info("Запускаем наблюдение за исходниками АРМов")
+        if INotify is not None:
+            self._inotify = INotify()
+        else:
+            logging.info(f"inotify недоступен, опрашиваем папки раз в {self.poll_interval} с")
+        self.sync_changes(None)
+        while iterations is None or iterations > 0:
+            if iterations is not None:
+                iterations -= 1
+            changed = self.wait_for_changes()
+            if changed:
+                self.sync_changes(changed)
+
+    def wait_for_changes(self):
+        """
+        Ждёт изменений в файлах и возвращает множество изменившихся путей;
+        после первого изменения ждёт, пока файлы не перестанут меняться
+        в течение debounce секунд.
+        """
+        changed = self._refresh_snapshot(self._sleep(None))
+        if not changed:
+            return changed
+        while True:
+            more = self._refresh_snapshot(self._sleep(self.debounce))
+            if not more:
+                return changed
+            changed.update(more)
+
+    def sync_changes(self, changed):
+        """
+        Синхронизирует АРМы, затронутые изменёнными файлами; если changed
+        равно None, синхронизирует все АРМы.
+        """
+        session = self.connector.connect_to_dpm()
+        try:
+            apps = session.query(Application).filter(Application.name.in_(self.config["applications"].keys())).all()
+            if changed is not None:
+                for path in changed:
+                    self.registry.forget(path)
+                apps = [app for app in apps if self._is_affected(session, app, changed)]
+                logging.info(f"Изменено файлов: {len(changed)}, затронуто АРМов: {len(apps)}")
+            # ноды, статистику которых (и их предков и потомков) надо пересчитать:
+            # АРМы с формами и компонентами до и после синхронизации
+            # и концы изменившихся связей
+            touched = self._app_nodes(session, apps)
+            for app in apps:
+                try:
+                    scan_application(app, session, self.registry)
+                    session.commit()
+                except Exception:
+                    session.rollback()
+                    logging.exception(f"Не удалось синхронизировать АРМ {app.name}")
+            if apps and self.link:
+                touched.update(self._link(session, apps))
+            if apps:
+                touched.update(self._app_nodes(session, apps))
+                update_node_stats(session, ids=touched)
+                session.commit()
+            self._update_watched_dirs(session)
+        finally:
+            session.close()
+    # endregion
+
+    # region utility methods
+    def _is_affected(self, session, app, changed):
+        if normalize_path(app.path) in changed:
+            return True
+        form_paths = {normalize_path(path) for (path,) in session.query(Form.path).filter(Form.applications.any(id=app.id))}
+        project_dir = normalize_path(os.path.dirname(app.path))
+        # новые формы ещё не записаны в ДПМ, но лежат в папке проекта
+        return any(path in form_paths or path.startswith(project_dir + os.sep) for path in changed)
+
+    @staticmethod
+    def _app_nodes(session, apps):
+        """
+        Возвращает множество id АРМов apps, их форм и компонентов этих форм.
+        """
+        ids = {app.id for app in apps}
+        form_ids = {
+            form_id
+            for (form_id,) in session.query(Form.id).filter(Form.applications.any(Application.id.in_(ids)))}
+        ids.update(form_ids)
+        if form_ids:
+            ids.update(
+                component_id
+                for (component_id,) in session.query(ClientQuery.id).filter(ClientQuery.form_id.in_(form_ids)))
+        return ids
+
+    def _link(self, session, apps):
+        """
+        Строит связи для баз, с которыми работают АРМы apps.
+        Возвращает множество id нод на концах изменившихся связей.
+        """
+        db_names = set()
+        for app in apps:
+            db_names.update(referenced_databases(self.config["applications"][app.name], self.config["databases"]))
+        touched = set()
+        for base in session.query(Database).filter(Database.name.in_(db_names)):
+            try:
+                with self.connector.connect_to(base.name) as conn:
+                    changes = analize_links(session, conn, database=base)
+                session.commit()
+            except Exception:
+                session.rollback()
+                logging.exception(f"Не удалось построить связи для базы {base.name}")
+                continue
+            for key in ("added", "updated", "deleted"):
+                touched.update(node_id for change in changes[key] for node_id in change[:2])
+        stamp_components(session)
+        session.commit()
+        return touched
+
+    def _update_watched_dirs(self, session):
+        """
+        Обновляет список наблюдаемых папок: папки проектов и папки,
+        в которых лежат формы (общие формы могут лежать вне папок проектов).
+        Снимок снимается заново, только если список поменялся.
+        """
+        roots = {normalize_path(os.path.dirname(app["path"])) for app in self.config["applications"].values()}
+        extra_dirs = {os.path.dirname(normalize_path(path)) for (path,) in session.query(Form.path)}
+        if roots != self._roots or extra_dirs != self._extra_dirs:
+            self._roots, self._extra_dirs = roots, extra_dirs
+            self.directories = {}
+            self.snapshot = take_snapshot(roots, extra_dirs, self.directories)
+        self._update_watches()
+
+    def _update_watches(self):
+        """
+        Ставит наблюдение inotify на новые папки и забывает пропавшие.
+        """
+        if self._inotify is None:
+            return
+        mask = (inotify_flags.CLOSE_WRITE | inotify_flags.CREATE | inotify_flags.DELETE |
+                inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM)
+        for directory in set(self._watches) - set(self.directories):
+            # при удалении папки наблюдение снимается само
+            self._watched_dirs.pop(self._watches.pop(directory), None)
+        for directory in set(self.directories) - set(self._watches):
+            try:
+                descriptor = self._inotify.add_watch(directory, mask)
+            except OSError as e:
+                logging.warning(f"Не удалось поставить наблюдение на папку {directory}: {e}")
+                continue
+            self._watches[directory] = descriptor
+            self._watched_dirs[descriptor] = directory
+
+    def _refresh_snapshot(self, dirty):
+        changed = refresh_snapshot(self.snapshot, self.directories, dirty)
+        self._update_watches()
+        return changed
+
+    def _sleep(self, timeout):
+        """
+        Ждёт события файловой системы (не дольше timeout секунд, None -
+        без ограничения) и возвращает множество папок, из которых пришли
+        события; если inotify недоступен, просто спит и возвращает None.
+        """
+        if self._inotify is None:
+            time.sleep(self.poll_interval if timeout is None else timeout)
+            return None
+        events = self._inotify.read(timeout=None if timeout is None else int(timeout * 1000))
+        if any(event.mask & inotify_flags.Q_OVERFLOW for event in events):
+            # часть событий потеряна, проверяем все папки
+            return None
+        return {self._watched_dirs[event.wd] for event in events if event.wd in self._watched_dirs}
+    # endregion
+
+
+def watch(connector, config):
+    """
+    Запускает бесконечную синхронизацию исходников АРМов из конфига.
+    Параметры берутся из необязательного раздела config["watcher"]
+    (poll_interval, debounce, link).
+    """
+    SourceWatcher(connector, config, **config.get("watcher", {})).run()